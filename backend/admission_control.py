@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""ルート種別ごとの同時実行制御（アドミッションコントロール）
+
+Fly の hard_limit はアプリ全体で共通なので、5〜10秒かかる画像認識が集中すると
+枠を使い切ってマスタ・請求書画面の短いリクエストまで待たされる。
+リクエストを種別（画像認識・PDF・通常CRUD）に分け、
+種別ごとのセマフォで同時実行数を、待ち行列の長さで待機数を制限する。
+画像認識は1リクエストで最大 RECOGNITION_BATCH_CONCURRENCY 回 Gemini を並列に呼ぶので、
+呼び出し数は genai_wrapper が GEMINI_MAX_CONCURRENT_CALLS で別に制限する。
+
+- 待ち行列が満杯: 429 Too Many Requests（すぐ返す）
+- 待ち時間が上限を超えた: 503 Service Unavailable
+どちらも Retry-After を付ける。
+"""
+import asyncio
+import json
+import re
+from typing import List, Optional, Pattern, Tuple
+
+from config import settings
+
+CLASS_RECOGNITION = "recognition"
+CLASS_PDF = "pdf"
+CLASS_DEFAULT = "default"
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionClass:
+    """Concurrency limit plus a bounded wait queue for one kind of request"""
+
+    def __init__(self, name: str, limit: int, queue_depth: int, queue_timeout: float, retry_after: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.queue_depth = max(0, queue_depth)
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(self.limit)
+
+    async def acquire(self) -> None:
+        if self._semaphore.locked() or self.waiting:
+            if self.waiting >= self.queue_depth:
+                raise AdmissionRejected(429, f"Too many concurrent {self.name} requests", self.retry_after)
+            self.waiting += 1
+            try:
+                # asyncio.timeout cancels the acquire itself, so a permit granted at the
+                # deadline is handed back by the semaphore instead of leaking (wait_for could)
+                async with asyncio.timeout(self.queue_timeout):
+                    await self._semaphore.acquire()
+            except TimeoutError:
+                raise AdmissionRejected(503, f"Timed out waiting for a {self.name} slot", self.retry_after)
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+
+def _default_rules() -> List[Tuple[Optional[str], Pattern, AdmissionClass]]:
+    timeout = settings.ADMISSION_QUEUE_TIMEOUT_SECONDS
+    recognition = AdmissionClass(
+        CLASS_RECOGNITION, settings.ADMISSION_RECOGNITION_CONCURRENCY, settings.ADMISSION_RECOGNITION_QUEUE, timeout, 10
+    )
+    pdf = AdmissionClass(CLASS_PDF, settings.ADMISSION_PDF_CONCURRENCY, settings.ADMISSION_PDF_QUEUE, timeout, 5)
+    # (HTTPメソッド（Noneは全て）, パス, 種別) 先に一致したものを使う。どれにも一致しなければ通常CRUD
+    return [
+        ("POST", re.compile(r"^/api/delivery-notes/recognize"), recognition),
+        ("GET", re.compile(r"^/api/sales-invoices/\d+/pdf$"), pdf),
+    ]
+
+
+class AdmissionControlMiddleware:
+    """ASGI middleware; a slot is held until the response has been fully sent"""
+
+    # ヘルスチェックとCORSのプリフライトは制限しない
+    EXEMPT_PATHS = ("/", "/health")
+
+    def __init__(self, app):
+        self.app = app
+        self.rules = _default_rules()
+        self.default = AdmissionClass(
+            CLASS_DEFAULT, settings.ADMISSION_DEFAULT_CONCURRENCY, settings.ADMISSION_DEFAULT_QUEUE,
+            settings.ADMISSION_QUEUE_TIMEOUT_SECONDS, 2
+        )
+
+    def classify(self, method: str, path: str) -> AdmissionClass:
+        for rule_method, pattern, admission in self.rules:
+            if (rule_method is None or rule_method == method) and pattern.match(path):
+                return admission
+        return self.default
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] == "OPTIONS"
+            or scope["path"] in self.EXEMPT_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        admission = self.classify(scope["method"], scope["path"])
+        try:
+            await admission.acquire()
+        except AdmissionRejected as e:
+            print(f"[admission] Rejected {scope['method']} {scope['path']} ({admission.name}): {e.status_code}")
+            await _send_rejection(send, e)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release()
+
+
+async def _send_rejection(send, rejection: AdmissionRejected) -> None:
+    body = json.dumps({"detail": rejection.detail}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": rejection.status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("ascii")),
+            (b"retry-after", str(rejection.retry_after).encode("ascii")),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
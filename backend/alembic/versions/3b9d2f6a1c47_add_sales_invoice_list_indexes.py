@@ -0,0 +1,35 @@
+"""add_sales_invoice_list_indexes
+
+Revision ID: 3b9d2f6a1c47
+Revises: e719581c8f23
+Create Date: 2026-10-17 10:12:31.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b9d2f6a1c47'
+down_revision: Union[str, Sequence[str], None] = 'e719581c8f23'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 請求書一覧のキーセットページング（created_at desc, id desc）と絞り込み用
+    op.create_index('ix_sales_invoices_created_at_id', 'sales_invoices', ['created_at', 'id'], unique=False)
+    op.create_index('ix_sales_invoices_sales_person_period', 'sales_invoices', ['sales_person_id', 'start_date', 'end_date'], unique=False)
+    op.create_index('ix_sales_invoices_period', 'sales_invoices', ['start_date', 'end_date'], unique=False)
+    op.create_index('ix_sales_invoices_total_amount_inc_tax', 'sales_invoices', ['total_amount_inc_tax'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sales_invoices_total_amount_inc_tax', table_name='sales_invoices')
+    op.drop_index('ix_sales_invoices_period', table_name='sales_invoices')
+    op.drop_index('ix_sales_invoices_sales_person_period', table_name='sales_invoices')
+    op.drop_index('ix_sales_invoices_created_at_id', table_name='sales_invoices')
@@ -0,0 +1,38 @@
+"""add_genai_key_quotas
+
+Revision ID: 5e2b7c9d1f03
+Revises: 8c4e1a7d5b20
+Create Date: 2026-10-17 18:21:09.402115
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e2b7c9d1f03'
+down_revision: Union[str, Sequence[str], None] = '8c4e1a7d5b20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('genai_key_quotas',
+        sa.Column('key_id', sa.String(length=16), nullable=False),
+        sa.Column('minute_requests', sa.Float(), nullable=False),
+        sa.Column('minute_tokens', sa.Float(), nullable=False),
+        sa.Column('day_requests', sa.Float(), nullable=False),
+        sa.Column('refilled_at', sa.Float(), nullable=False),
+        sa.Column('cooldown_until', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('consecutive_rate_limits', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.TIMESTAMP(), server_default=sa.text('now()'), nullable=True),
+        sa.PrimaryKeyConstraint('key_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('genai_key_quotas')
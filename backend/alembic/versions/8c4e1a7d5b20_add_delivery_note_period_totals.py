@@ -0,0 +1,67 @@
+"""add_delivery_note_period_totals
+
+Revision ID: 8c4e1a7d5b20
+Revises: 3b9d2f6a1c47
+Create Date: 2026-10-17 14:03:52.718340
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c4e1a7d5b20'
+down_revision: Union[str, Sequence[str], None] = '3b9d2f6a1c47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('delivery_note_period_totals',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sales_person_id', sa.Integer(), nullable=False),
+        sa.Column('period_end', sa.Date(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('unit_price', sa.Integer(), nullable=False),
+        sa.Column('total_quantity', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('total_amount', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.TIMESTAMP(), server_default=sa.text('now()'), nullable=True),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id'], ),
+        sa.ForeignKeyConstraint(['sales_person_id'], ['sales_persons.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('sales_person_id', 'period_end', 'product_id', 'unit_price', name='uq_delivery_note_period_totals_key')
+    )
+    op.create_index(op.f('ix_delivery_note_period_totals_id'), 'delivery_note_period_totals', ['id'], unique=False)
+    op.create_index('ix_delivery_note_period_totals_period_sales_person', 'delivery_note_period_totals', ['period_end', 'sales_person_id'], unique=False)
+
+    # 既存の納品書明細から集計を作成（21日〜翌月20日 → 締め日20日）
+    op.execute("""
+        INSERT INTO delivery_note_period_totals
+            (sales_person_id, period_end, product_id, unit_price, total_quantity, total_amount)
+        SELECT
+            dn.sales_person_id,
+            CASE
+                WHEN EXTRACT(DAY FROM dn.delivery_date) <= 20
+                    THEN (date_trunc('month', dn.delivery_date) + interval '19 days')::date
+                ELSE (date_trunc('month', dn.delivery_date) + interval '1 month' + interval '19 days')::date
+            END AS period_end,
+            d.product_id,
+            d.unit_price,
+            SUM(d.quantity),
+            SUM(d.quantity * d.unit_price)
+        FROM delivery_notes dn
+        JOIN delivery_note_details d ON d.delivery_note_id = dn.id
+        WHERE dn.sales_person_id IS NOT NULL
+          AND d.product_id IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_delivery_note_period_totals_period_sales_person', table_name='delivery_note_period_totals')
+    op.drop_index(op.f('ix_delivery_note_period_totals_id'), table_name='delivery_note_period_totals')
+    op.drop_table('delivery_note_period_totals')
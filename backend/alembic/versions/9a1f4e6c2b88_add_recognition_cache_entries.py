@@ -0,0 +1,35 @@
+"""add_recognition_cache_entries
+
+Revision ID: 9a1f4e6c2b88
+Revises: 5e2b7c9d1f03
+Create Date: 2026-10-17 19:02:44.118305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a1f4e6c2b88'
+down_revision: Union[str, Sequence[str], None] = '5e2b7c9d1f03'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('recognition_cache_entries',
+        sa.Column('cache_key', sa.String(length=64), nullable=False),
+        sa.Column('result', sa.JSON(), nullable=False),
+        sa.Column('created_at', sa.TIMESTAMP(), nullable=False),
+        sa.PrimaryKeyConstraint('cache_key')
+    )
+    op.create_index(op.f('ix_recognition_cache_entries_created_at'), 'recognition_cache_entries', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_recognition_cache_entries_created_at'), table_name='recognition_cache_entries')
+    op.drop_table('recognition_cache_entries')
@@ -0,0 +1,38 @@
+"""sales_invoices_created_at_desc_index
+
+Revision ID: d6b3f8a2e417
+Revises: 9a1f4e6c2b88
+Create Date: 2026-10-18 09:21:07.530142
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd6b3f8a2e417'
+down_revision: Union[str, Sequence[str], None] = '9a1f4e6c2b88'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 請求書一覧は created_at desc, id desc のキーセットページング。
+    # created_at を NOT NULL にして NULL 用の分岐をなくし、同じ並びのインデックスを範囲走査できるようにする
+    op.execute("UPDATE sales_invoices SET created_at = COALESCE(updated_at, CURRENT_TIMESTAMP) WHERE created_at IS NULL")
+    op.alter_column('sales_invoices', 'created_at', existing_type=sa.TIMESTAMP(),
+                    existing_server_default=sa.text('now()'), nullable=False)
+    op.drop_index('ix_sales_invoices_created_at_id', table_name='sales_invoices')
+    op.create_index('ix_sales_invoices_created_at_id', 'sales_invoices',
+                    [sa.text('created_at DESC'), sa.text('id DESC')], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_sales_invoices_created_at_id', table_name='sales_invoices')
+    op.create_index('ix_sales_invoices_created_at_id', 'sales_invoices', ['created_at', 'id'], unique=False)
+    op.alter_column('sales_invoices', 'created_at', existing_type=sa.TIMESTAMP(),
+                    existing_server_default=sa.text('now()'), nullable=True)
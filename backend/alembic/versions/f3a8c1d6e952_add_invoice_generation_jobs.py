@@ -0,0 +1,43 @@
+"""add_invoice_generation_jobs
+
+Revision ID: f3a8c1d6e952
+Revises: d6b3f8a2e417
+Create Date: 2026-10-17 21:14:09.527310
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a8c1d6e952'
+down_revision: Union[str, Sequence[str], None] = 'd6b3f8a2e417'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('invoice_generation_jobs',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('start_date', sa.Date(), nullable=False),
+        sa.Column('end_date', sa.Date(), nullable=False),
+        sa.Column('regeneration_mode', sa.String(length=20), nullable=False),
+        sa.Column('sales_persons', sa.JSON(), nullable=False),
+        sa.Column('invoices', sa.JSON(), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.TIMESTAMP(), nullable=False),
+        sa.Column('heartbeat_at', sa.TIMESTAMP(), nullable=False),
+        sa.Column('finished_at', sa.TIMESTAMP(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_invoice_generation_jobs_heartbeat_at'), 'invoice_generation_jobs', ['heartbeat_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_invoice_generation_jobs_heartbeat_at'), table_name='invoice_generation_jobs')
+    op.drop_table('invoice_generation_jobs')
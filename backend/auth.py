@@ -2,9 +2,11 @@ from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 import bcrypt
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import User
 import config
+from executors import run_cpu
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -13,11 +15,11 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = db.query(User).filter(User.username == username).first()
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await run_cpu(verify_password, password, user.hashed_password):
         return False
     return user
 
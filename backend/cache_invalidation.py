@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""プロセス間のキャッシュ無効化（Postgres LISTEN/NOTIFY）
+
+書き込み処理は publish_invalidation(db, scope) をコミット前に呼ぶ。
+同じトランザクションで pg_notify を発行するので、コミットされた変更だけが通知される。
+各ワーカーはバックグラウンドスレッドでチャンネルを LISTEN し、
+受け取った scope に subscribe() されたハンドラでキャッシュを破棄する。
+自プロセスのハンドラはコミット直後に直接呼ぶ（自分の通知は無視する）。
+ロールバックされたトランザクションの分は呼ばない。
+
+購読しているキャッシュはマスタ（master_cache）だけ。購読者のいないスコープは
+通知の往復が無駄になるので、キャッシュを追加するときにスコープも追加する。
+"""
+import json
+import os
+import select
+import threading
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config import settings
+
+SCOPE_MASTERS = "masters"
+# 再接続時など通知を取りこぼした可能性があるときは全スコープを破棄する
+SCOPE_ALL = "*"
+
+# LISTEN 接続が切れたときの再接続間隔（秒）
+LISTENER_RETRY_SECONDS = 5
+# select() の待ち時間（停止要求の確認間隔）
+LISTENER_POLL_SECONDS = 5
+
+# 自プロセスが発行した通知を見分けるためのID
+_ORIGIN = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+InvalidationHandler = Callable[[Optional[List[int]]], None]
+
+_HANDLERS: Dict[str, List[InvalidationHandler]] = {}
+_LOCK = threading.Lock()
+_listener: Optional[threading.Thread] = None
+_stop = threading.Event()
+
+
+def subscribe(scope: str, handler: InvalidationHandler) -> None:
+    """Register `handler(ids)` for a scope; ids is None when everything is affected"""
+    with _LOCK:
+        _HANDLERS.setdefault(scope, []).append(handler)
+
+
+def dispatch(scope: str, ids: Optional[List[int]] = None) -> None:
+    """Run local handlers for a scope (all scopes for SCOPE_ALL)"""
+    with _LOCK:
+        if scope == SCOPE_ALL:
+            handlers = [h for hs in _HANDLERS.values() for h in hs]
+        else:
+            handlers = list(_HANDLERS.get(scope, []))
+    for handler in handlers:
+        try:
+            handler(None if scope == SCOPE_ALL else ids)
+        except Exception as e:
+            print(f"[cache-invalidation] Handler for {scope} failed: {e}")
+
+
+def _notify_params(scope: str, id_list: Optional[List[int]]) -> dict:
+    payload = json.dumps({"origin": _ORIGIN, "scope": scope, "ids": id_list})
+    return {"channel": settings.CACHE_INVALIDATION_CHANNEL, "payload": payload}
+
+
+_NOTIFY = text("SELECT pg_notify(:channel, :payload)")
+
+
+# session.info のキー: コミット後に自プロセスで dispatch する (scope, ids) の一覧
+_PENDING_KEY = "cache_invalidation_pending"
+
+
+def _dispatch_pending(session: Session) -> None:
+    for scope, id_list in session.info.pop(_PENDING_KEY, []):
+        dispatch(scope, id_list)
+
+
+def _discard_pending(session: Session, previous_transaction) -> None:
+    # Savepoint rollbacks leave the outer transaction (and its NOTIFY) to commit
+    if not session.in_transaction():
+        session.info.pop(_PENDING_KEY, None)
+
+
+def _queue_local_dispatch(session: Session, scope: str, id_list: Optional[List[int]]) -> None:
+    """Run the local handlers after the transaction commits; forget them if it rolls back"""
+    if not session.in_transaction():
+        # ロールバックのイベントはトランザクションが始まっていないと発生しない
+        session.begin()
+    session.info.setdefault(_PENDING_KEY, []).append((scope, id_list))
+    if not event.contains(session, "after_commit", _dispatch_pending):
+        event.listen(session, "after_commit", _dispatch_pending)
+        event.listen(session, "after_soft_rollback", _discard_pending)
+
+
+def publish_invalidation(db: Session, scope: str, ids: Optional[Iterable[int]] = None) -> None:
+    """Queue an invalidation event on the current transaction; does not commit
+
+    Other workers receive it through NOTIFY when the transaction commits;
+    this process runs its handlers right after the commit.
+    """
+    id_list = sorted(set(ids)) if ids is not None else None
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(_NOTIFY, _notify_params(scope, id_list))
+    _queue_local_dispatch(db, scope, id_list)
+
+
+async def publish_invalidation_async(db: AsyncSession, scope: str, ids: Optional[Iterable[int]] = None) -> None:
+    """publish_invalidation for an AsyncSession"""
+    id_list = sorted(set(ids)) if ids is not None else None
+    if db.sync_session.get_bind().dialect.name == "postgresql":
+        await db.execute(_NOTIFY, _notify_params(scope, id_list))
+    _queue_local_dispatch(db.sync_session, scope, id_list)
+
+
+def _handle_notification(payload: str) -> None:
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        print(f"[cache-invalidation] Ignoring malformed payload: {payload[:200]}")
+        return
+    if message.get("origin") == _ORIGIN:
+        return
+    dispatch(message.get("scope", SCOPE_ALL), message.get("ids"))
+
+
+def _listen_forever(database_url: str) -> None:
+    import psycopg2
+    import psycopg2.extensions
+
+    connected_before = False
+    while not _stop.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(database_url)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN "{settings.CACHE_INVALIDATION_CHANNEL}"')
+            print(f"[cache-invalidation] Listening on {settings.CACHE_INVALIDATION_CHANNEL}")
+            if connected_before:
+                # Events sent while we were disconnected are lost
+                dispatch(SCOPE_ALL)
+            connected_before = True
+
+            while not _stop.is_set():
+                if select.select([conn], [], [], LISTENER_POLL_SECONDS) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _handle_notification(conn.notifies.pop(0).payload)
+        except Exception as e:
+            print(f"[cache-invalidation] Listener error: {e}")
+            _stop.wait(LISTENER_RETRY_SECONDS)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+
+def start_invalidation_listener(database_url: Optional[str]) -> None:
+    """Start the LISTEN thread of this worker (Postgres only)"""
+    global _listener
+    if not database_url or not database_url.startswith(("postgres://", "postgresql")):
+        return
+    if _listener is not None and _listener.is_alive():
+        return
+    _stop.clear()
+    _listener = threading.Thread(
+        target=_listen_forever, args=(database_url,), name="cache-invalidation", daemon=True
+    )
+    _listener.start()
+
+
+def stop_invalidation_listener() -> None:
+    _stop.set()
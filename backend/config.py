@@ -9,6 +9,79 @@ class Settings:
     ACCESS_TOKEN_EXPIRE_MINUTES: int = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60))
     REFRESH_TOKEN_EXPIRE_DAYS: int = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 7))
     GEMINI_API_KEY: str = os.getenv("GEMINI_KEY", "")
+    # 請求書一括生成の並列ワーカー数（各ワーカーが同期エンジンのDB接続を1本使用。DB_SYNC_POOL_SIZE + DB_SYNC_MAX_OVERFLOW - 2 が上限）
+    INVOICE_GENERATION_WORKERS: int = int(os.getenv("INVOICE_GENERATION_WORKERS", 4))
+    # bcrypt・PDF生成用のワーカースレッド数（CPU処理。イベントループを塞がないよう別スレッドで実行）
+    CPU_EXECUTOR_WORKERS: int = int(os.getenv("CPU_EXECUTOR_WORKERS", 2))
+    # ブロッキングI/O（画像ファイルの読み書き、非同期APIのない旧SDKでのGemini呼び出し）用のワーカースレッド数
+    GENAI_EXECUTOR_WORKERS: int = int(os.getenv("GENAI_EXECUTOR_WORKERS", 8))
+    # ルート種別ごとの同時実行数と待ち行列の上限（admission_control.py）
+    # 長い処理（画像認識・PDF）が枠を使い切ってもCRUDが詰まらないよう種別ごとに分ける
+    # 一括生成はジョブ登録だけですぐ返るので対象外（生成自体は invoice_jobs の1本のワーカーで順に実行）
+    ADMISSION_RECOGNITION_CONCURRENCY: int = int(os.getenv("ADMISSION_RECOGNITION_CONCURRENCY", 4))
+    ADMISSION_RECOGNITION_QUEUE: int = int(os.getenv("ADMISSION_RECOGNITION_QUEUE", 4))
+    ADMISSION_PDF_CONCURRENCY: int = int(os.getenv("ADMISSION_PDF_CONCURRENCY", 2))
+    ADMISSION_PDF_QUEUE: int = int(os.getenv("ADMISSION_PDF_QUEUE", 4))
+    ADMISSION_DEFAULT_CONCURRENCY: int = int(os.getenv("ADMISSION_DEFAULT_CONCURRENCY", 16))
+    ADMISSION_DEFAULT_QUEUE: int = int(os.getenv("ADMISSION_DEFAULT_QUEUE", 32))
+    # 待ち行列で待てる最大秒数（超えたら503）
+    ADMISSION_QUEUE_TIMEOUT_SECONDS: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", 10))
+    # DB接続プール（プロセスごと）。非同期エンジン: APIハンドラ用
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    # 同期エンジン: 請求書一括生成ジョブ・Geminiクォータ台帳・管理スクリプト用
+    DB_SYNC_POOL_SIZE: int = int(os.getenv("DB_SYNC_POOL_SIZE", 2))
+    DB_SYNC_MAX_OVERFLOW: int = int(os.getenv("DB_SYNC_MAX_OVERFLOW", 4))
+    DB_POOL_TIMEOUT: int = int(os.getenv("DB_POOL_TIMEOUT", 30))
+    # サーバー・プーラー側のアイドル切断より短くする（秒）
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", 300))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+    # PgBouncer（Neon pooler）のトランザクションモード向け: プリペアドステートメントのキャッシュを無効化
+    DB_PGBOUNCER_TRANSACTION_MODE: bool = os.getenv("DB_PGBOUNCER_TRANSACTION_MODE", "false").lower() in ("1", "true", "yes")
+    # 起動時に確立しておく接続数（エンジンごと、プールサイズまで）
+    DB_POOL_WARMUP: int = int(os.getenv("DB_POOL_WARMUP", 2))
+    # アイドル時に確立済みの接続（DB_POOL_WARMUP 本）を維持するための SELECT 1 の間隔（秒、0で無効）
+    DB_KEEPALIVE_SECONDS: int = int(os.getenv("DB_KEEPALIVE_SECONDS", 240))
+    # キャッシュ無効化通知（LISTEN/NOTIFY）のチャンネル名
+    CACHE_INVALIDATION_CHANNEL: str = os.getenv("CACHE_INVALIDATION_CHANNEL", "bizpilot_cache_invalidation")
+    # LISTEN用の接続先（PgBouncerのトランザクションモードではLISTENできないため直接接続を指定）
+    CACHE_INVALIDATION_DATABASE_URL: str = os.getenv("CACHE_INVALIDATION_DATABASE_URL", "") or os.getenv("DATABASE_URL", "")
+    
+    # Gemini APIキー1本あたりのクォータ（既定は gemini-2.5-flash 無料枠）
+    GEMINI_RPM: int = int(os.getenv("GEMINI_RPM", 10))
+    GEMINI_TPM: int = int(os.getenv("GEMINI_TPM", 250000))
+    GEMINI_RPD: int = int(os.getenv("GEMINI_RPD", 250))
+    # クォータ残量の共有先: auto（DATABASE_URLがPostgresならpostgres）/ postgres / memory（プロセス内のみ）
+    GEMINI_QUOTA_LEDGER: str = os.getenv("GEMINI_QUOTA_LEDGER", "auto").lower()
+    # 全キーのクォータが尽きているとき、空きを待つ最大秒数（超えたらエラーを返す）
+    GEMINI_MAX_QUOTA_WAIT_SECONDS: float = float(os.getenv("GEMINI_MAX_QUOTA_WAIT_SECONDS", 20))
+    # プロセス全体で同時に実行するGemini呼び出しの上限（一括認識は1リクエストで複数回呼ぶので、リクエスト数とは別に制限）
+    GEMINI_MAX_CONCURRENT_CALLS: int = int(os.getenv("GEMINI_MAX_CONCURRENT_CALLS", 6))
+    
+    # 画像認識結果キャッシュ: 保持秒数（既定7日）とプロセス内の最大件数
+    RECOGNITION_CACHE_TTL_SECONDS: int = int(os.getenv("RECOGNITION_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+    RECOGNITION_CACHE_MAX_ENTRIES: int = int(os.getenv("RECOGNITION_CACHE_MAX_ENTRIES", 256))
+    
+    # 認識プロンプトのマスタ一覧の形式: full=「ID: 名前」を1行ずつ / compact=短いID・同系列の商品をまとめて入力トークンを削減
+    RECOGNITION_PROMPT_MODE: str = os.getenv("RECOGNITION_PROMPT_MODE", "full").lower()
+    
+    # 認識前の画像前処理（EXIFの向き補正・長辺の縮小・グレースケール化・JPEG再圧縮。Pillowが必要）
+    IMAGE_PREPROCESS_ENABLED: bool = os.getenv("IMAGE_PREPROCESS_ENABLED", "true").lower() in ("1", "true", "yes")
+    IMAGE_MAX_LONG_EDGE: int = int(os.getenv("IMAGE_MAX_LONG_EDGE", 1600))
+    IMAGE_GRAYSCALE: bool = os.getenv("IMAGE_GRAYSCALE", "true").lower() in ("1", "true", "yes")
+    IMAGE_JPEG_QUALITY: int = int(os.getenv("IMAGE_JPEG_QUALITY", 80))
+    
+    # 認識前の画像品質チェック: reject=不良画像はGeminiに送らず失敗を返す / flag=警告だけ付けて送る / off
+    IMAGE_QUALITY_GATE: str = os.getenv("IMAGE_QUALITY_GATE", "reject").lower()
+    IMAGE_MIN_SHORT_EDGE: int = int(os.getenv("IMAGE_MIN_SHORT_EDGE", 480))
+    IMAGE_MIN_SHARPNESS: float = float(os.getenv("IMAGE_MIN_SHARPNESS", 20))
+    # 直近に認識した画像との知覚ハッシュの距離（64ビット中）がこれ以下なら重複の可能性として警告
+    IMAGE_DUPLICATE_MAX_DISTANCE: int = int(os.getenv("IMAGE_DUPLICATE_MAX_DISTANCE", 4))
+    
+    # 複数画像の一括認識: 1リクエストの最大枚数、同時に認識する最大数、健全なAPIキー1本あたりの同時認識数
+    RECOGNITION_BATCH_MAX_FILES: int = int(os.getenv("RECOGNITION_BATCH_MAX_FILES", 30))
+    RECOGNITION_BATCH_CONCURRENCY: int = int(os.getenv("RECOGNITION_BATCH_CONCURRENCY", 6))
+    RECOGNITION_CONCURRENCY_PER_KEY: int = int(os.getenv("RECOGNITION_CONCURRENCY_PER_KEY", 2))
     
     # Support multiple Gemini API keys (comma-separated in environment variable)
     @property
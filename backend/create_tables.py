@@ -27,7 +27,7 @@ def create_sales_invoices():
                 total_amount_ex_tax INTEGER DEFAULT 0 NOT NULL,
                 tax_amount INTEGER DEFAULT 0 NOT NULL,
                 total_amount_inc_tax INTEGER DEFAULT 0 NOT NULL,
-                created_at TIMESTAMP DEFAULT NOW(),
+                created_at TIMESTAMP DEFAULT NOW() NOT NULL,
                 updated_at TIMESTAMP DEFAULT NOW()
             )
         """))
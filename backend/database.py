@@ -1,4 +1,9 @@
-from sqlalchemy import create_engine
+import asyncio
+import uuid
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -6,11 +11,67 @@ from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
 
+from config import settings
+from executors import run_io
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+
+def _pool_options(pool_size: int, max_overflow: int) -> dict:
+    """Pool settings of one engine (see config.Settings.DB_*)"""
+    return dict(
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+    )
+
+
+# 同期エンジン: バックグラウンドジョブ・Geminiクォータ台帳・LISTEN・管理スクリプト用
+# psycopg2 はサーバー側のプリペアドステートメントを使わないので、PgBouncer のトランザクションモードでも設定不要
+engine = create_engine(DATABASE_URL, **_pool_options(settings.DB_SYNC_POOL_SIZE, settings.DB_SYNC_MAX_OVERFLOW))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# libpq形式のクエリパラメータのうち asyncpg の connect() が受け付けないもの
+_LIBPQ_ONLY_PARAMS = ("sslmode", "channel_binding", "connect_timeout", "options", "target_session_attrs")
+
+
+def _async_database_url(url: str):
+    """Same database as DATABASE_URL through an async driver
+
+    postgresql(+psycopg2):// becomes postgresql+asyncpg://, with libpq-only
+    options such as sslmode translated or dropped; sqlite uses aiosqlite.
+    """
+    url = make_url(url)
+    connect_args = {}
+    if url.get_backend_name() == "postgresql":
+        query = dict(url.query)
+        sslmode = query.get("sslmode")
+        if sslmode and sslmode != "disable":
+            connect_args["ssl"] = "require" if sslmode in ("require", "prefer", "allow") else True
+        url = url.set(
+            drivername="postgresql+asyncpg",
+            query={k: v for k, v in query.items() if k not in _LIBPQ_ONLY_PARAMS}
+        )
+        if settings.DB_PGBOUNCER_TRANSACTION_MODE:
+            # Consecutive transactions may land on different server connections:
+            # never reuse prepared statements, and give each one a unique name
+            connect_args["statement_cache_size"] = 0
+            connect_args["prepared_statement_cache_size"] = 0
+            connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid.uuid4().hex}__"
+    elif url.get_backend_name() == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    return url, connect_args
+
+
+# 非同期エンジン: APIハンドラ用（DB待ちの間イベントループを塞がない）
+_async_url, _async_connect_args = _async_database_url(DATABASE_URL)
+async_engine = create_async_engine(
+    _async_url, connect_args=_async_connect_args, **_pool_options(settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -18,4 +79,85 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def _open_async_connections(count: int) -> int:
+    """Open and ping `count` async pooled connections at once; returns how many succeeded"""
+    count = min(count, settings.DB_POOL_SIZE)
+    if count <= 0:
+        return 0
+
+    async def _open(connected: asyncio.Event, release: asyncio.Event):
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            connected.set()
+            # Hold the connection until all are open, otherwise the pool hands back the same one
+            await release.wait()
+
+    release = asyncio.Event()
+    events = [asyncio.Event() for _ in range(count)]
+    tasks = [asyncio.create_task(_open(connected, release)) for connected in events]
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(connected.wait() for connected in events)),
+            timeout=settings.DB_POOL_TIMEOUT
+        )
+    except Exception as e:
+        print(f"[db-pool] Async connections failed: {e}")
+    finally:
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    return sum(1 for result in results if not isinstance(result, BaseException))
+
+
+def _open_sync_connections(count: int) -> int:
+    """Sync counterpart of _open_async_connections (connections are held until all are open)"""
+    connections = []
+    opened = 0
+    try:
+        for _ in range(min(count, settings.DB_SYNC_POOL_SIZE)):
+            conn = engine.connect()
+            connections.append(conn)
+            conn.execute(text("SELECT 1"))
+            opened += 1
+    except Exception as e:
+        print(f"[db-pool] Sync connections failed: {e}")
+    finally:
+        for conn in connections:
+            conn.close()
+    return opened
+
+
+async def warm_up_pool(count: int = settings.DB_POOL_WARMUP) -> None:
+    """Open `count` connections per engine up front so the first requests and jobs skip the TCP/TLS handshake"""
+    if count <= 0:
+        return
+    opened_async, opened_sync = await asyncio.gather(
+        _open_async_connections(count),
+        run_io(_open_sync_connections, count)
+    )
+    print(f"[db-pool] Warmed up {opened_async} async / {opened_sync} sync connection(s)")
+
+
+async def keep_pool_alive(interval: int = settings.DB_KEEPALIVE_SECONDS, count: int = settings.DB_POOL_WARMUP) -> None:
+    """Ping the warmed-up connections of both engines every `interval` seconds
+
+    All `count` connections are checked out together, so each one is pinged
+    rather than the same connection every time. Connections beyond that are
+    left to pool_pre_ping / pool_recycle.
+    """
+    if interval <= 0:
+        return
+    count = max(1, count)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.gather(_open_async_connections(count), run_io(_open_sync_connections, count))
+        except Exception as e:
+            print(f"[db-pool] Keepalive failed: {e}")
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""割引率テーブルの索引
+
+販売員向け（customer_flag=True）と委託先向け（customer_flag=False）の割引率を
+下限額でソートして保持し、合計金額から二分探索で割引率を引く。
+索引はマスタキャッシュ（master_cache）がマスタのバージョンごとに作り直す。
+"""
+from bisect import bisect_right
+from decimal import Decimal
+from typing import List, NamedTuple, Optional
+
+
+class DiscountTier(NamedTuple):
+    """Immutable copy of one discount_rates row"""
+    id: int
+    rate: Decimal
+    threshold_amount: int
+    customer_flag: bool
+    deleted_flag: bool = False
+
+
+class DiscountTierIndex:
+    """Discount tiers sorted by threshold for bisect lookups
+
+    lookup() applies the same rule the invoice generator always used:
+    the positive tier with the highest threshold <= total, otherwise the
+    0% tier with the highest threshold, otherwise None.
+    """
+
+    def __init__(self, tiers: List[DiscountTier]):
+        positive = sorted(
+            (tier for tier in tiers if tier.rate > 0),
+            key=lambda tier: tier.threshold_amount
+        )
+        zero = [tier for tier in tiers if tier.rate == 0]
+        self._positive = positive
+        self._thresholds = [tier.threshold_amount for tier in positive]
+        self._zero_tier = max(zero, key=lambda tier: tier.threshold_amount) if zero else None
+
+    def __len__(self) -> int:
+        return len(self._positive) + (1 if self._zero_tier else 0)
+
+    def lookup(self, total_amount: int) -> Optional[DiscountTier]:
+        position = bisect_right(self._thresholds, total_amount)
+        if position:
+            return self._positive[position - 1]
+        return self._zero_tier
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""ブロッキング処理用のスレッドプール
+
+async ハンドラ内で同期処理（bcrypt、ReportLab、Gemini SDK）を直接呼ぶと
+その間イベントループ全体が止まり、ログインや一覧取得まで待たされる。
+CPU処理と外部API待ちを別々の上限付きプールで実行し、ハンドラは await する。
+
+- run_cpu: bcrypt・PDF描画（bcrypt と zlib は GIL を解放するのでスレッドで並列化できる）
+- run_io: ファイルI/O、非同期APIのない旧SDKでの Gemini 呼び出し（待ちが長いので多めのスレッド数）
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from config import settings
+
+T = TypeVar("T")
+
+_cpu_executor = ThreadPoolExecutor(max_workers=max(1, settings.CPU_EXECUTOR_WORKERS), thread_name_prefix="cpu")
+_io_executor = ThreadPoolExecutor(max_workers=max(1, settings.GENAI_EXECUTOR_WORKERS), thread_name_prefix="genai")
+
+
+async def _run(executor: ThreadPoolExecutor, fn: Callable[..., T], *args, **kwargs) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_cpu(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run CPU-bound `fn` on the bounded CPU pool"""
+    return await _run(_cpu_executor, fn, *args, **kwargs)
+
+
+async def run_io(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Run blocking I/O `fn` (file access, legacy GenAI SDK calls) on the I/O pool"""
+    return await _run(_io_executor, fn, *args, **kwargs)
+
+
+def shutdown_executors() -> None:
+    _cpu_executor.shutdown(wait=False, cancel_futures=True)
+    _io_executor.shutdown(wait=False, cancel_futures=True)
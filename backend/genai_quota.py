@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""Gemini APIキーごとのクォータ管理（トークンバケット）
+
+キーごとに RPM（分間リクエスト数）・TPM（分間トークン数）・RPD（日間リクエスト数）を
+トークンバケットで管理し、呼び出しごとに余裕が最も大きいキーを選ぶ。
+429 を受けたキーは Retry-After（なければ指数バックオフ＋ジッター）の間だけ休ませ、
+期限が来たら個別に復帰させる。
+
+残量と休止状態は台帳（ledger）に置く。
+- PostgresQuotaLedger: genai_key_quotas テーブル。全ワーカー・全マシンで共有し、
+  行ロック（SELECT ... FOR UPDATE）の中で選択と消費を行う
+- InMemoryQuotaLedger: プロセス内（SQLite での開発用。genai_key_quotas が無いときもこちら）
+RPD は日付での一斉リセットではなく24時間かけて連続的に回復するものとして近似する。
+"""
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import inspect, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from config import settings
+from executors import run_io
+from models import GenAIKeyQuota
+
+# 連続で429を受けたキーの休止時間（秒）: BASE * 2^(連続回数-1)、上限あり
+COOLDOWN_BASE_SECONDS = 2.0
+COOLDOWN_MAX_SECONDS = 300.0
+# 休止時間に加えるジッター（割合）。複数リクエストが同時に復帰して再度429になるのを防ぐ
+COOLDOWN_JITTER = 0.25
+
+
+class QuotaExhausted(RuntimeError):
+    """No API key can take the request within the allowed wait"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"All Gemini API keys are out of quota (retry in {retry_after:.0f}s)")
+        self.retry_after = retry_after
+
+
+class QuotaLimits(NamedTuple):
+    requests_per_minute: int
+    tokens_per_minute: int
+    requests_per_day: int
+
+
+def key_id(api_key: str) -> str:
+    """Stable, non-secret identifier of an API key (stored instead of the key)"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+# ---- Bucket arithmetic ----
+# State objects are GenAIKeyQuota rows or KeyQuotaState instances (same attributes).
+
+class KeyQuotaState:
+    def __init__(self, key_id: str, limits: QuotaLimits, now: float):
+        self.key_id = key_id
+        self.minute_requests = float(limits.requests_per_minute)
+        self.minute_tokens = float(limits.tokens_per_minute)
+        self.day_requests = float(limits.requests_per_day)
+        self.refilled_at = now
+        self.cooldown_until = 0.0
+        self.consecutive_rate_limits = 0
+
+
+def _refill(state, limits: QuotaLimits, now: float) -> None:
+    elapsed = max(0.0, now - state.refilled_at)
+    state.minute_requests = min(limits.requests_per_minute, state.minute_requests + elapsed * limits.requests_per_minute / 60)
+    state.minute_tokens = min(limits.tokens_per_minute, state.minute_tokens + elapsed * limits.tokens_per_minute / 60)
+    state.day_requests = min(limits.requests_per_day, state.day_requests + elapsed * limits.requests_per_day / 86400)
+    state.refilled_at = now
+
+
+def _headroom(state, limits: QuotaLimits) -> float:
+    """Smallest remaining fraction of the three buckets (call after _refill)"""
+    return min(
+        max(0.0, state.minute_requests) / limits.requests_per_minute,
+        max(0.0, state.minute_tokens) / limits.tokens_per_minute,
+        max(0.0, state.day_requests) / limits.requests_per_day,
+    )
+
+
+def _wait_time(state, limits: QuotaLimits, tokens: int, now: float) -> float:
+    """Seconds until the key may take a request of `tokens` (call after _refill)"""
+    tokens = min(tokens, limits.tokens_per_minute)
+    return max(
+        state.cooldown_until - now,
+        (1 - state.minute_requests) * 60 / limits.requests_per_minute,
+        (tokens - state.minute_tokens) * 60 / limits.tokens_per_minute,
+        (1 - state.day_requests) * 86400 / limits.requests_per_day,
+        0.0,
+    )
+
+
+def _reserve(states: Iterable, limits: QuotaLimits, tokens: int, now: float) -> Tuple[Optional[str], float]:
+    """Take one request and `tokens` from the state with the most headroom
+
+    Returns (key_id, 0) on success, else (None, seconds until a key may be free).
+    """
+    best = None
+    best_headroom = -1.0
+    soonest = float("inf")
+    for state in states:
+        _refill(state, limits, now)
+        wait = _wait_time(state, limits, tokens, now)
+        if wait > 0:
+            soonest = min(soonest, wait)
+            continue
+        headroom = _headroom(state, limits)
+        if headroom > best_headroom:
+            best, best_headroom = state, headroom
+    if best is None:
+        return None, soonest
+    best.minute_requests -= 1
+    best.minute_tokens -= tokens
+    best.day_requests -= 1
+    return best.key_id, 0.0
+
+
+def _count_available(states: Iterable, limits: QuotaLimits, tokens: int, now: float) -> int:
+    """Number of keys that could take a request of `tokens` right now (nothing is consumed)"""
+    count = 0
+    for state in states:
+        _refill(state, limits, now)
+        if _wait_time(state, limits, tokens, now) <= 0:
+            count += 1
+    return count
+
+
+def _record_rate_limited(state, limits: QuotaLimits, retry_after: Optional[float], now: float) -> float:
+    _refill(state, limits, now)
+    state.consecutive_rate_limits += 1
+    backoff = min(COOLDOWN_MAX_SECONDS, COOLDOWN_BASE_SECONDS * 2 ** (state.consecutive_rate_limits - 1))
+    cooldown = _jittered(max(retry_after or 0.0, backoff))
+    state.cooldown_until = now + cooldown
+    # The server says the bucket is empty, whatever our estimate was
+    state.minute_requests = min(state.minute_requests, 0.0)
+    return cooldown
+
+
+def _record_success(state, limits: QuotaLimits, token_correction: float) -> None:
+    state.consecutive_rate_limits = 0
+    state.minute_tokens = min(limits.tokens_per_minute, state.minute_tokens - token_correction)
+
+
+def _jittered(seconds: float) -> float:
+    return seconds * (1 + random.uniform(0, COOLDOWN_JITTER))
+
+
+# ---- Ledgers ----
+
+class InMemoryQuotaLedger:
+    """Quota state of this process only"""
+
+    def __init__(self):
+        self._states: Dict[str, KeyQuotaState] = {}
+        self._lock = threading.Lock()
+
+    def _state(self, key_id: str, limits: QuotaLimits) -> KeyQuotaState:
+        state = self._states.get(key_id)
+        if state is None:
+            state = self._states[key_id] = KeyQuotaState(key_id, limits, time.time())
+        return state
+
+    def reserve(self, key_ids: List[str], limits: QuotaLimits, tokens: int) -> Tuple[Optional[str], float]:
+        with self._lock:
+            return _reserve([self._state(k, limits) for k in key_ids], limits, tokens, time.time())
+
+    def count_available(self, key_ids: List[str], limits: QuotaLimits, tokens: int) -> int:
+        with self._lock:
+            return _count_available([self._state(k, limits) for k in key_ids], limits, tokens, time.time())
+
+    def record_success(self, key_id: str, limits: QuotaLimits, token_correction: float) -> None:
+        with self._lock:
+            _record_success(self._state(key_id, limits), limits, token_correction)
+
+    def record_rate_limited(self, key_id: str, limits: QuotaLimits, retry_after: Optional[float]) -> float:
+        with self._lock:
+            return _record_rate_limited(self._state(key_id, limits), limits, retry_after, time.time())
+
+
+class PostgresQuotaLedger:
+    """Quota state shared by every process through the genai_key_quotas table
+
+    Each operation is one short transaction holding row locks on the keys
+    involved; time comes from the database so machine clocks need not agree.
+    """
+
+    _NOW = text("SELECT EXTRACT(EPOCH FROM clock_timestamp())")
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._known_keys = set()
+
+    def _lock_states(self, db: Session, key_ids: List[str], limits: QuotaLimits):
+        missing = [k for k in key_ids if k not in self._known_keys]
+        if missing:
+            now = float(db.execute(self._NOW).scalar())
+            db.execute(insert(GenAIKeyQuota).values([
+                dict(
+                    key_id=k,
+                    minute_requests=limits.requests_per_minute,
+                    minute_tokens=limits.tokens_per_minute,
+                    day_requests=limits.requests_per_day,
+                    refilled_at=now,
+                    cooldown_until=0,
+                    consecutive_rate_limits=0
+                )
+                for k in missing
+            ]).on_conflict_do_nothing(index_elements=["key_id"]))
+            self._known_keys.update(missing)
+        states = db.execute(
+            select(GenAIKeyQuota)
+            .where(GenAIKeyQuota.key_id.in_(key_ids))
+            .order_by(GenAIKeyQuota.key_id)  # 一定の順序でロックしてデッドロックを避ける
+            .with_for_update()
+        ).scalars().all()
+        # ロック取得後の時刻（待っている間に他プロセスが refilled_at を進めている場合がある）
+        return states, float(db.execute(self._NOW).scalar())
+
+    def reserve(self, key_ids: List[str], limits: QuotaLimits, tokens: int) -> Tuple[Optional[str], float]:
+        with Session(self._engine) as db, db.begin():
+            states, now = self._lock_states(db, key_ids, limits)
+            return _reserve(states, limits, tokens, now)
+
+    def count_available(self, key_ids: List[str], limits: QuotaLimits, tokens: int) -> int:
+        # 読み取りのみ（refill の計算結果はコミットしない）
+        with Session(self._engine) as db:
+            states = db.execute(select(GenAIKeyQuota).where(GenAIKeyQuota.key_id.in_(key_ids))).scalars().all()
+            now = float(db.execute(self._NOW).scalar())
+            unseen = len(set(key_ids) - {state.key_id for state in states})
+            count = _count_available(states, limits, tokens, now) + unseen
+            db.rollback()
+            return count
+
+    def record_success(self, key_id: str, limits: QuotaLimits, token_correction: float) -> None:
+        with Session(self._engine) as db, db.begin():
+            states, _ = self._lock_states(db, [key_id], limits)
+            for state in states:
+                _record_success(state, limits, token_correction)
+
+    def record_rate_limited(self, key_id: str, limits: QuotaLimits, retry_after: Optional[float]) -> float:
+        with Session(self._engine) as db, db.begin():
+            states, now = self._lock_states(db, [key_id], limits)
+            return max((_record_rate_limited(state, limits, retry_after, now) for state in states), default=0.0)
+
+
+def make_quota_ledger():
+    """Ledger selected by GEMINI_QUOTA_LEDGER (auto: Postgres when DATABASE_URL is Postgres)"""
+    from database import engine
+
+    backend = settings.GEMINI_QUOTA_LEDGER
+    if backend == "auto":
+        backend = "postgres" if engine.dialect.name == "postgresql" else "memory"
+    if backend == "postgres":
+        if _has_quota_table(engine):
+            return PostgresQuotaLedger(engine)
+        # マイグレーション未適用で全ての認識が失敗するより、プロセス内の台帳で動かす
+        print(
+            f"[WARN] Table {GenAIKeyQuota.__tablename__} does not exist (run `alembic upgrade head`); "
+            "Gemini quotas are tracked per process until the next restart"
+        )
+    return InMemoryQuotaLedger()
+
+
+def _has_quota_table(engine) -> bool:
+    try:
+        return inspect(engine).has_table(GenAIKeyQuota.__tablename__)
+    except Exception as e:
+        # DBに一時的に繋がらないだけなら共有の台帳を使う（呼び出し時に再接続する）
+        print(f"[WARN] Could not check for table {GenAIKeyQuota.__tablename__}: {e}")
+        return True
+
+
+class QuotaScheduler:
+    """Key selection over the ledger's per-key token buckets
+
+    acquire() reserves one request and the estimated tokens on the key with the
+    most headroom. Callers report the outcome with report_success() (actual
+    token usage) or report_rate_limited() (429; the key cools down). The
+    *_async variants run ledger access on the I/O executor.
+    """
+
+    def __init__(self, api_keys: List[str], limits: QuotaLimits, ledger=None):
+        self._keys_by_id = {key_id(key): key for key in api_keys}
+        self._limits = limits
+        self._ledger = ledger if ledger is not None else InMemoryQuotaLedger()
+
+    def __len__(self) -> int:
+        return len(self._keys_by_id)
+
+    def try_acquire(self, tokens: int) -> Tuple[Optional[str], float]:
+        """(api_key, 0) when a key was reserved, else (None, seconds until one may be free)"""
+        reserved, wait = self._ledger.reserve(list(self._keys_by_id), self._limits, tokens)
+        return (self._keys_by_id[reserved] if reserved else None), wait
+
+    def acquire(self, tokens: int, max_wait: float) -> str:
+        """Blocking acquire; raises QuotaExhausted if no key frees up within `max_wait`"""
+        deadline = time.monotonic() + max_wait
+        while True:
+            key, wait = self.try_acquire(tokens)
+            if key is not None:
+                return key
+            if time.monotonic() + wait > deadline:
+                raise QuotaExhausted(wait)
+            time.sleep(_jittered(wait))
+
+    async def acquire_async(self, tokens: int, max_wait: float) -> str:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_wait
+        while True:
+            key, wait = await run_io(self.try_acquire, tokens)
+            if key is not None:
+                return key
+            if loop.time() + wait > deadline:
+                raise QuotaExhausted(wait)
+            await asyncio.sleep(_jittered(wait))
+
+    def healthy_key_count(self, tokens: int) -> int:
+        """Keys that are not cooling down and have quota for a request of `tokens` now"""
+        return self._ledger.count_available(list(self._keys_by_id), self._limits, tokens)
+
+    def report_success(self, api_key: str, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        correction = (used_tokens - estimated_tokens) if used_tokens is not None else 0
+        self._ledger.record_success(key_id(api_key), self._limits, correction)
+
+    async def report_success_async(self, api_key: str, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        await run_io(self.report_success, api_key, estimated_tokens, used_tokens)
+
+    def report_rate_limited(self, api_key: str, retry_after: Optional[float]) -> float:
+        """Put the key into cool-down for every process; returns the cool-down in seconds"""
+        return self._ledger.record_rate_limited(key_id(api_key), self._limits, retry_after)
+
+    async def report_rate_limited_async(self, api_key: str, retry_after: Optional[float]) -> float:
+        return await run_io(self.report_rate_limited, api_key, retry_after)
+
+
+# ---- Error classification ----
+
+_RETRY_DELAY_PATTERNS = (
+    re.compile(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s"),  # google.genai (JSON error details)
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),  # google.generativeai (protobuf text)
+)
+
+
+def error_status_code(error: Exception) -> Optional[int]:
+    """HTTP status of a GenAI SDK error (google.genai APIError / google.api_core exceptions)"""
+    code = getattr(error, "code", None)
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Server-requested delay from a Retry-After header or the RetryInfo error detail"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    message = str(error)
+    for pattern in _RETRY_DELAY_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
@@ -1,13 +1,27 @@
+import asyncio
+import base64
 import os
 import json
 import logging
+import random
+import threading
 import time
+from typing import Callable, Optional
+
+from config import settings
+from executors import run_io
+from genai_quota import (
+    COOLDOWN_BASE_SECONDS, COOLDOWN_JITTER, COOLDOWN_MAX_SECONDS, QuotaLimits, QuotaScheduler,
+    error_status_code, key_id, make_quota_ledger, retry_after_seconds
+)
 
 try:
     import google.genai as genai_new
+    from google.genai import types as genai_types
     HAS_GENAI_NEW = True
 except Exception:
     genai_new = None
+    genai_types = None
     HAS_GENAI_NEW = False
 
 try:
@@ -19,99 +33,69 @@ except Exception:
 
 logger = logging.getLogger(__name__)
 
-# Global state for API key rotation
+# 一時的なサーバー側エラー（キーを替えずにバックオフして再試行）
+_TRANSIENT_STATUS_CODES = (500, 502, 503, 504)
+
+# 画像1枚あたりの入力トークン数の見積もり（実際の消費量は応答の usage_metadata で補正する）
+IMAGE_TOKEN_ESTIMATE = 1290
+
 _API_KEYS = []
-_CURRENT_KEY_INDEX = 0
-_FAILED_KEYS = set()  # Track keys that have failed
+_SCHEDULER: Optional[QuotaScheduler] = None
+
+# Gemini calls in flight in this process. A batch request fans out to several
+# calls, so admission control (one slot per request) alone does not bound them.
+_CALL_SLOTS = asyncio.Semaphore(max(1, settings.GEMINI_MAX_CONCURRENT_CALLS))
 
 
 def set_api_keys(api_keys: list[str]):
-    """Set multiple API keys for rotation."""
-    global _API_KEYS, _CURRENT_KEY_INDEX, _FAILED_KEYS
+    """Set API keys; each call is routed to the key with the most quota headroom."""
+    global _API_KEYS, _SCHEDULER
     _API_KEYS = [key for key in api_keys if key]
-    _CURRENT_KEY_INDEX = 0
-    _FAILED_KEYS = set()
+    limits = QuotaLimits(settings.GEMINI_RPM, settings.GEMINI_TPM, settings.GEMINI_RPD)
+    # 残量は台帳（既定はPostgresのテーブル）に置き、全ワーカーで共有する
+    _SCHEDULER = QuotaScheduler(_API_KEYS, limits, make_quota_ledger()) if _API_KEYS else None
     print(f"[DEBUG genai_wrapper] Loaded {len(_API_KEYS)} API keys for rotation")
 
 
-def get_next_api_key() -> str:
-    """Get next available API key, skipping failed ones."""
-    global _CURRENT_KEY_INDEX
-    
-    if not _API_KEYS:
-        raise RuntimeError("No API keys configured")
-    
-    # Try all keys once
-    attempts = 0
-    while attempts < len(_API_KEYS):
-        key = _API_KEYS[_CURRENT_KEY_INDEX]
-        
-        # Skip failed keys if we haven't exhausted all options
-        if key not in _FAILED_KEYS or attempts >= len(_API_KEYS) - len(_FAILED_KEYS):
-            return key
-        
-        _CURRENT_KEY_INDEX = (_CURRENT_KEY_INDEX + 1) % len(_API_KEYS)
-        attempts += 1
-    
-    # All keys have failed, clear failed set and try again
-    print("[WARN genai_wrapper] All API keys have failed, resetting failed key tracking")
-    _FAILED_KEYS.clear()
-    return _API_KEYS[_CURRENT_KEY_INDEX]
-
-
-def mark_key_as_failed(api_key: str):
-    """Mark an API key as failed."""
-    global _CURRENT_KEY_INDEX
-    _FAILED_KEYS.add(api_key)
-    print(f"[WARN genai_wrapper] Marked API key ...{api_key[-10:]} as failed ({len(_FAILED_KEYS)}/{len(_API_KEYS)} failed)")
-    
-    # Move to next key
-    _CURRENT_KEY_INDEX = (_CURRENT_KEY_INDEX + 1) % len(_API_KEYS)
-
-
-def is_quota_exceeded_error(error: Exception) -> bool:
-    """Check if error is due to quota/rate limit exceeded."""
-    error_str = str(error).lower()
-    quota_keywords = [
-        "quota",
-        "rate limit",
-        "resource exhausted",
-        "429",
-        "too many requests",
-        "limit exceeded",
-    ]
-    return any(keyword in error_str for keyword in quota_keywords)
-
-
-def configure(api_key: str):
-    """Configure available GenAI client. Prefer new `google.genai` if installed.
-
-    If neither package is installed, this function is a no-op and later calls
-    will raise a clear error.
-    """
-    # Always override GOOGLE_API_KEY environment variable to ensure consistent API key usage
-    if api_key:
-        os.environ["GOOGLE_API_KEY"] = api_key
-        os.environ["GEMINI_API_KEY"] = api_key  # Also set GEMINI_API_KEY for consistency
-        print(f"[DEBUG genai_wrapper] Set GOOGLE_API_KEY and GEMINI_API_KEY to ...{api_key[-10:]}")
-    
-    if HAS_GENAI_NEW:
-        # also try to create a client instance if the SDK exposes Client
+async def healthy_key_count(prompt: str = "") -> int:
+    """Number of API keys that can take a call right now (0 when no keys are configured)."""
+    if _SCHEDULER is None:
+        return 0
+    return await run_io(_SCHEDULER.healthy_key_count, _estimate_tokens(prompt))
+
+
+# One persistent client per API key. google.genai clients keep their own
+# HTTP connection pools (sync and async), so reusing them keeps connections warm.
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+# google.generativeai (legacy) keeps the API key in process-global state
+_LEGACY_LOCK = threading.Lock()
+
+
+def get_client(api_key: str):
+    """Return the shared google.genai Client for `api_key`, creating it once."""
+    if not HAS_GENAI_NEW:
+        raise RuntimeError("google.genai is not installed")
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(api_key)
+        if client is None:
+            client = genai_new.Client(api_key=api_key)
+            _CLIENTS[api_key] = client
+            print(f"[DEBUG genai_wrapper] Initialized google.genai Client for key ...{api_key[-10:]}")
+        return client
+
+
+async def close_clients():
+    """Close pooled clients and their HTTP connections (application shutdown)."""
+    with _CLIENTS_LOCK:
+        clients = list(_CLIENTS.values())
+        _CLIENTS.clear()
+    for client in clients:
         try:
-            global _GENAI_CLIENT
-            _GENAI_CLIENT = genai_new.Client(api_key=api_key)
-            print("[DEBUG genai_wrapper] Initialized google.genai Client")
+            await client.aio.aclose()
+            client.close()
         except Exception as e:
-            _GENAI_CLIENT = None
-            print(f"[DEBUG genai_wrapper] google.genai Client init failed: {e}, will use environment-based auth")
-    
-    # Always configure legacy SDK if available (since we prefer it in generate_content_with_image)
-    if HAS_GENAI_LEGACY:
-        genai_legacy.configure(api_key=api_key)
-        print(f"[DEBUG genai_wrapper] Configured google.generativeai (legacy) with key ending ...{api_key[-10:]}")
-    
-    if not HAS_GENAI_NEW and not HAS_GENAI_LEGACY:
-        print("[DEBUG genai_wrapper] No GenAI SDK installed!")
+            print(f"[WARN genai_wrapper] Failed to close client: {e}")
 
 
 class GenAIResponse:
@@ -119,118 +103,155 @@ class GenAIResponse:
         self.text = text
 
 
-def generate_content_with_image(model_name: str, prompt: str, image_b64: str, max_retries: int = None):
+def _image_contents(prompt: str, image_bytes: bytes, mime_type: str):
+    return [prompt, genai_types.Part.from_bytes(data=image_bytes, mime_type=mime_type)]
+
+
+def _generate_legacy(api_key: str, model_name: str, prompt: str, image_bytes: bytes, mime_type: str):
+    with _LEGACY_LOCK:
+        genai_legacy.configure(api_key=api_key)
+        model = genai_legacy.GenerativeModel(model_name)
+        return model.generate_content([prompt, {"mime_type": mime_type, "data": image_bytes}])
+
+
+def _estimate_tokens(prompt: str) -> int:
+    # 日本語は概ね1文字1トークン
+    return len(prompt) + IMAGE_TOKEN_ESTIMATE
+
+
+def _used_tokens(resp) -> Optional[int]:
+    usage = getattr(resp, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None)
+
+
+def _max_attempts(max_retries: Optional[int]) -> int:
+    if max_retries is not None:
+        return max(1, max_retries)
+    return len(_API_KEYS) + 2 if _API_KEYS else 1
+
+
+def _backoff_seconds(attempt: int) -> float:
+    return min(COOLDOWN_MAX_SECONDS, COOLDOWN_BASE_SECONDS * 2 ** attempt) * (1 + random.uniform(0, COOLDOWN_JITTER))
+
+
+def _retry_delay(error: Exception, api_key: Optional[str], attempt: int, max_attempts: int) -> float:
+    """Seconds to wait before the next attempt; raises if `error` is final."""
+    status = error_status_code(error)
+    last_attempt = attempt >= max_attempts - 1
+    if status == 429 and not last_attempt:
+        if api_key:
+            # The key is cooling down; the scheduler moves on to another key,
+            # or waits until one has quota again
+            return 0.0
+        return max(retry_after_seconds(error) or 0.0, _backoff_seconds(attempt))
+    if status == 429:
+        raise error
+    if status in _TRANSIENT_STATUS_CODES and not last_attempt:
+        delay = _backoff_seconds(attempt)
+        logger.warning(f"GenAI call failed with {status}, retrying in {delay:.1f}s")
+        return delay
+    logger.exception("GenAI call failed")
+    raise RuntimeError(f"GenAI call failed: {error}") from error
+
+
+def _log_cooldown(api_key: str, cooldown: float):
+    logger.warning(f"Rate limited on API key ...{api_key[-10:]}, cooling down for {cooldown:.1f}s")
+
+
+def _require_sdk():
+    if not HAS_GENAI_NEW and not HAS_GENAI_LEGACY:
+        raise RuntimeError("No supported GenAI SDK installed (google.genai or google.generativeai).")
+
+
+def _client_for(api_key: Optional[str]):
+    return get_client(api_key or os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"))
+
+
+def generate_content_with_image(model_name: str, prompt: str, image_b64: str, max_retries: int = None,
+                                mime_type: str = "image/jpeg"):
     """Generate content using available GenAI SDK with automatic API key rotation.
 
     Returns a GenAIResponse-like object with `.text` containing the model output.
-    The function attempts multiple common client interfaces and normalizes
-    the returned text. It raises a clear error if no supported SDK is found.
-    
-    If max_retries is None, will try all available API keys once.
+    Blocking; async callers should use generate_content_with_image_async.
+
+    If max_retries is None, allows one attempt per key plus two. Raises
+    QuotaExhausted when no key has quota within GEMINI_MAX_QUOTA_WAIT_SECONDS.
+    """
+    _require_sdk()
+    image_bytes = base64.b64decode(image_b64)
+    tokens = _estimate_tokens(prompt)
+    max_attempts = _max_attempts(max_retries)
+    for attempt in range(max_attempts):
+        current_key = None
+        if _SCHEDULER is not None:
+            current_key = _SCHEDULER.acquire(tokens, settings.GEMINI_MAX_QUOTA_WAIT_SECONDS)
+        try:
+            if HAS_GENAI_NEW:
+                resp = _client_for(current_key).models.generate_content(
+                    model=model_name, contents=_image_contents(prompt, image_bytes, mime_type)
+                )
+                result = GenAIResponse(text=_extract_text_from_response(resp))
+            else:
+                resp = result = _generate_legacy(current_key, model_name, prompt, image_bytes, mime_type)
+        except Exception as e:
+            if current_key and error_status_code(e) == 429:
+                _log_cooldown(current_key, _SCHEDULER.report_rate_limited(current_key, retry_after_seconds(e)))
+            delay = _retry_delay(e, current_key, attempt, max_attempts)
+            if delay:
+                time.sleep(delay)
+            continue
+        if current_key:
+            _SCHEDULER.report_success(current_key, tokens, _used_tokens(resp))
+        return result
+    raise RuntimeError("All API keys exhausted")
+
+
+async def generate_content_with_image_async(model_name: str, prompt: str, image_bytes: bytes,
+                                            max_retries: int = None, mime_type: str = "image/jpeg",
+                                            on_event: Optional[Callable[..., None]] = None):
+    """Async variant of generate_content_with_image on the SDK's native async client.
+
+    Takes raw image bytes. Concurrent calls share the pooled client (and its
+    warm connections) of each key. The legacy SDK, which has no async API,
+    runs on the I/O executor.
+
+    on_event(event, **data), if given, is called with "key_selected" before each
+    attempt and "rate_limited" when a key answers 429 (keys appear as key_id).
+    At most GEMINI_MAX_CONCURRENT_CALLS calls run at once; the others wait for a slot.
     """
-    if max_retries is None:
-        max_retries = len(_API_KEYS) if _API_KEYS else 1
-    
-    last_error = None
-    
-    for attempt in range(max_retries):
+    _require_sdk()
+    tokens = _estimate_tokens(prompt)
+    max_attempts = _max_attempts(max_retries)
+    for attempt in range(max_attempts):
+        current_key = None
+        if _SCHEDULER is not None:
+            current_key = await _SCHEDULER.acquire_async(tokens, settings.GEMINI_MAX_QUOTA_WAIT_SECONDS)
+        if on_event and current_key:
+            on_event("key_selected", key=key_id(current_key), attempt=attempt + 1)
         try:
-            # Get current API key
-            if _API_KEYS:
-                current_key = get_next_api_key()
-                configure(current_key)
-                print(f"[DEBUG genai_wrapper] Attempt {attempt + 1}/{max_retries} with key ...{current_key[-10:]}")
-            
-            # Prefer legacy SDK (more stable) until google.genai API is confirmed working
-            if HAS_GENAI_LEGACY and genai_legacy is not None:
-                try:
-                    model = genai_legacy.GenerativeModel(model_name)
-                    response = model.generate_content([
-                        prompt,
-                        {
-                            "mime_type": "image/jpeg",
-                            "data": image_b64,
-                        },
-                    ])
-                    print(f"[DEBUG genai_wrapper] Successfully generated content with key ...{current_key[-10:]}")
-                    return response
-                except Exception as e:
-                    # Check if this is a quota error
-                    if is_quota_exceeded_error(e):
-                        logger.warning(f"Quota exceeded for API key ...{current_key[-10:]}, trying next key")
-                        mark_key_as_failed(current_key)
-                        last_error = e
-                        
-                        # If this was the last retry, raise the error
-                        if attempt >= max_retries - 1:
-                            raise
-                        
-                        # Wait a bit before retrying with next key
-                        time.sleep(1)
-                        continue
-                    else:
-                        # Non-quota error, raise immediately
-                        logger.exception("google.generativeai call failed")
-                        raise RuntimeError(f"google.generativeai call failed: {e}")
-
-            # Try new SDK if legacy not available
-            if HAS_GENAI_NEW and genai_new is not None:
-                try:
-                    # decode base64 image to bytes
-                    import base64 as _b64
-                    image_bytes = _b64.b64decode(image_b64)
-
-                    # use existing client if configured, else create one
-                    client = globals().get("_GENAI_CLIENT")
-                    if client is None:
-                        try:
-                            client = genai_new.Client(api_key=os.environ.get("GOOGLE_API_KEY"))
-                        except Exception:
-                            client = genai_new.Client()
-
-                    # Call the recommended generate API: model + input with text and image
-                    if hasattr(client, "generate"):
-                        resp = client.generate(model=model_name, input=[{"content": prompt}, {"image": {"image_bytes": image_bytes}}])
-                    elif hasattr(client, "generate_text"):
-                        # Some versions separate text generation; fallback to text-only call
-                        resp = client.generate_text(model=model_name, input=prompt)
-                    else:
-                        raise RuntimeError("google.genai client does not expose a supported generate method")
-
-                    text = _extract_text_from_response(resp)
-                    print(f"[DEBUG genai_wrapper] Successfully generated content with key ...{current_key[-10:]}")
-                    return GenAIResponse(text=text)
-                except Exception as e:
-                    # Check if this is a quota error
-                    if is_quota_exceeded_error(e):
-                        logger.warning(f"Quota exceeded for API key ...{current_key[-10:]}, trying next key")
-                        mark_key_as_failed(current_key)
-                        last_error = e
-                        
-                        # If this was the last retry, raise the error
-                        if attempt >= max_retries - 1:
-                            raise
-                        
-                        # Wait a bit before retrying with next key
-                        time.sleep(1)
-                        continue
-                    else:
-                        # Non-quota error, raise immediately
-                        logger.exception("google.genai call failed")
-                        raise RuntimeError(f"google.genai call failed: {e}")
-            
-            # If we get here without SDK, raise error
-            raise RuntimeError("No supported GenAI SDK installed (google.genai or google.generativeai).")
-            
+            async with _CALL_SLOTS:
+                if HAS_GENAI_NEW:
+                    resp = await _client_for(current_key).aio.models.generate_content(
+                        model=model_name, contents=_image_contents(prompt, image_bytes, mime_type)
+                    )
+                    result = GenAIResponse(text=_extract_text_from_response(resp))
+                else:
+                    resp = result = await run_io(
+                        _generate_legacy, current_key, model_name, prompt, image_bytes, mime_type
+                    )
         except Exception as e:
-            # If not a quota error or last attempt, raise
-            if not is_quota_exceeded_error(e) or attempt >= max_retries - 1:
-                raise
-            last_error = e
-    
-    # If all retries exhausted, raise last error
-    if last_error:
-        raise last_error
+            if current_key and error_status_code(e) == 429:
+                cooldown = await _SCHEDULER.report_rate_limited_async(current_key, retry_after_seconds(e))
+                _log_cooldown(current_key, cooldown)
+                if on_event:
+                    on_event("rate_limited", key=key_id(current_key), cooldown_seconds=round(cooldown, 1))
+            delay = _retry_delay(e, current_key, attempt, max_attempts)
+            if delay:
+                await asyncio.sleep(delay)
+            continue
+        if current_key:
+            await _SCHEDULER.report_success_async(current_key, tokens, _used_tokens(resp))
+        return result
     raise RuntimeError("All API keys exhausted")
 
 
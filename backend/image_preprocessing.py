@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""納品書画像を Gemini に送る前の前処理
+
+スマホの写真（12MP・数MB）をそのまま送ると、アップロードも入力トークンも
+手書きの納品書を読むのに必要な量より大きくなる。送信前に
+EXIF の向きを反映 → 長辺を IMAGE_MAX_LONG_EDGE まで縮小 → グレースケール化 →
+JPEG で再圧縮 する。Pillow が無い、または前処理が無効のときは元の画像を
+実際の形式（マジックバイトで判定）のまま送る。
+
+CPU を使う処理なので executors.run_cpu から呼ぶ。
+"""
+import io
+import math
+from typing import NamedTuple, Optional
+
+from config import settings
+
+try:
+    from PIL import Image, ImageOps
+    HAS_PIL = True
+except Exception:
+    Image = None
+    ImageOps = None
+    HAS_PIL = False
+
+# EXIF の Orientation タグ（1 = 回転なし）
+_EXIF_ORIENTATION = 0x0112
+
+# Gemini の画像トークン: 384px 以下は 258 トークン、それより大きい画像はタイル単位で 258 トークンずつ
+_SMALL_IMAGE_EDGE = 384
+_TOKENS_PER_TILE = 258
+
+_MAGIC_NUMBERS = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    mime_type: str
+    original_bytes: int
+    original_tokens: Optional[int]
+    tokens: Optional[int]
+    steps: tuple
+
+    def summary(self) -> dict:
+        """Byte/token savings, for logs, diagnostics and progress events"""
+        saved_tokens = None
+        if self.original_tokens is not None and self.tokens is not None:
+            saved_tokens = self.original_tokens - self.tokens
+        return {
+            "bytes": len(self.data),
+            "original_bytes": self.original_bytes,
+            "saved_bytes": self.original_bytes - len(self.data),
+            "mime_type": self.mime_type,
+            "tokens": self.tokens,
+            "original_tokens": self.original_tokens,
+            "saved_tokens": saved_tokens,
+            "steps": list(self.steps),
+        }
+
+
+def detect_mime_type(data: bytes, default: str = "image/jpeg") -> str:
+    """MIME type from the file's magic number (the upload's Content-Type is not trusted)"""
+    for magic, mime_type in _MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp":
+        brand = data[8:12]
+        if brand in (b"heic", b"heix", b"heim", b"heis"):
+            return "image/heic"
+        if brand in (b"mif1", b"msf1"):
+            return "image/heif"
+    return default
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Input tokens Gemini charges for an image of this size"""
+    if width <= _SMALL_IMAGE_EDGE and height <= _SMALL_IMAGE_EDGE:
+        return _TOKENS_PER_TILE
+    tile = max(256, min(768, min(width, height) / 1.5))
+    return _TOKENS_PER_TILE * math.ceil(width / tile) * math.ceil(height / tile)
+
+
+def _unprocessed(data: bytes, tokens: Optional[int], step: str) -> PreparedImage:
+    return PreparedImage(data, detect_mime_type(data), len(data), tokens, tokens, (step,))
+
+
+def preprocess_image(data: bytes) -> PreparedImage:
+    """Image to send to Gemini; falls back to the original bytes on any failure"""
+    if not settings.IMAGE_PREPROCESS_ENABLED:
+        return _unprocessed(data, None, "disabled")
+    if not HAS_PIL:
+        return _unprocessed(data, None, "pillow_missing")
+
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            original_tokens = estimate_image_tokens(*original.size)
+            steps = []
+            image = original
+            if original.getexif().get(_EXIF_ORIENTATION, 1) != 1:
+                image = ImageOps.exif_transpose(original)
+                steps.append("exif_orientation")
+
+            long_edge = settings.IMAGE_MAX_LONG_EDGE
+            if long_edge > 0 and max(image.size) > long_edge:
+                if image is original:
+                    image = original.copy()
+                image.thumbnail((long_edge, long_edge), Image.Resampling.LANCZOS)
+                steps.append(f"resize_{image.width}x{image.height}")
+
+            if settings.IMAGE_GRAYSCALE and image.mode != "L":
+                image = image.convert("L")
+                steps.append("grayscale")
+            elif image.mode not in ("L", "RGB"):
+                image = image.convert("RGB")
+
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=settings.IMAGE_JPEG_QUALITY, optimize=True)
+            steps.append(f"jpeg_q{settings.IMAGE_JPEG_QUALITY}")
+            tokens = estimate_image_tokens(*image.size)
+    except Exception as e:
+        print(f"[image_preprocessing] Could not process image, sending original: {e}")
+        return _unprocessed(data, None, "unreadable")
+
+    processed = buffer.getvalue()
+    if len(processed) >= len(data) and tokens >= original_tokens and "exif_orientation" not in steps:
+        # 既に小さい画像は再圧縮しても得がない
+        return _unprocessed(data, original_tokens, "kept_original")
+    return PreparedImage(processed, "image/jpeg", len(data), original_tokens, tokens, tuple(steps))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""認識前の画像品質チェック（Gemini を呼ぶ前に数ミリ秒で判定する）
+
+ぼやけた・暗すぎる・真っ白・小さすぎる写真は Gemini に送っても 5〜10 秒後に
+success: false が返り、クォータだけ消費する。縮小デコードした画像で
+- 解像度（短辺）
+- 露出（平均輝度）とコントラスト（輝度の標準偏差。ほぼ無地なら納品書ではない）
+- 鮮鋭度（ラプラシアンの分散）
+を調べ、IMAGE_QUALITY_GATE=reject なら送信せずに失敗を返す。
+
+さらに知覚ハッシュ（dHash）で直近に認識した画像とほぼ同じ写真かを調べる。
+同じ納品書の撮り直し・二重登録の可能性として警告するだけで、拒否はしない。
+
+CPU を使う処理なので executors.run_cpu から呼ぶ。
+"""
+import io
+import threading
+import time
+from collections import deque
+from typing import NamedTuple, Optional
+
+from config import settings
+
+try:
+    from PIL import Image, ImageFilter, ImageOps, ImageStat
+    HAS_PIL = True
+except Exception:
+    Image = None
+    ImageFilter = None
+    ImageOps = None
+    ImageStat = None
+    HAS_PIL = False
+
+# 判定用に縮小する長辺（JPEG は draft で縮小デコードされるので 12MP でも速い）
+_ANALYSIS_EDGE = 1024
+# 平均輝度（0-255）がこの範囲外なら露出不良
+_MIN_BRIGHTNESS = 40
+_MAX_BRIGHTNESS = 240
+# 輝度の標準偏差がこれ未満ならほぼ無地
+_MIN_CONTRAST = 12
+
+_LAPLACIAN = (0, 1, 0, 1, -4, 1, 0, 1, 0)
+
+
+class ImageQuality(NamedTuple):
+    width: int
+    height: int
+    brightness: float
+    contrast: float
+    sharpness: float
+    phash: int
+    issues: tuple
+
+    def summary(self) -> dict:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "brightness": round(self.brightness, 1),
+            "contrast": round(self.contrast, 1),
+            "sharpness": round(self.sharpness, 1),
+            "issues": list(self.issues),
+        }
+
+
+def _dhash(image) -> int:
+    """64-bit difference hash of a grayscale image"""
+    small = image.resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def assess_image_quality(data: bytes) -> Optional[ImageQuality]:
+    """Quality measurements for an uploaded image (None when Pillow is missing or the image is unreadable)"""
+    if not HAS_PIL:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            width, height = original.size
+            original.draft("L", (_ANALYSIS_EDGE, _ANALYSIS_EDGE))
+            image = ImageOps.exif_transpose(original.convert("L"))
+            if max(image.size) > _ANALYSIS_EDGE:
+                image.thumbnail((_ANALYSIS_EDGE, _ANALYSIS_EDGE), Image.Resampling.BILINEAR)
+    except Exception as e:
+        print(f"[image_quality] Could not read image: {e}")
+        return None
+
+    stat = ImageStat.Stat(image)
+    brightness = stat.mean[0]
+    contrast = stat.stddev[0]
+    # オフセット 128 のラプラシアン。分散が小さいほど輪郭がぼやけている
+    edges = image.filter(ImageFilter.Kernel((3, 3), _LAPLACIAN, scale=1, offset=128))
+    # 画像の外周はフィルタの端の処理で値が跳ねるので除く
+    edges = edges.crop((1, 1, edges.width - 1, edges.height - 1))
+    sharpness = ImageStat.Stat(edges).var[0]
+
+    issues = []
+    if min(width, height) < settings.IMAGE_MIN_SHORT_EDGE:
+        issues.append("low_resolution")
+    if brightness < _MIN_BRIGHTNESS:
+        issues.append("too_dark")
+    elif brightness > _MAX_BRIGHTNESS:
+        issues.append("too_bright")
+    elif contrast < _MIN_CONTRAST:
+        issues.append("blank")
+    elif sharpness < settings.IMAGE_MIN_SHARPNESS:
+        issues.append("blurry")
+
+    return ImageQuality(width, height, brightness, contrast, sharpness, _dhash(image), tuple(issues))
+
+
+# 品質不良時に返す failureReason
+QUALITY_ISSUE_MESSAGES = {
+    "low_resolution": "画像の解像度が低すぎます",
+    "blank": "納品書が写っていないようです",
+    "too_dark": "画像が暗すぎます",
+    "too_bright": "画像が明るすぎます（白飛び）",
+    "blurry": "画像がぼやけています",
+}
+
+
+def quality_failure_reason(issues) -> str:
+    messages = [QUALITY_ISSUE_MESSAGES.get(issue, issue) for issue in issues]
+    return "、".join(messages) + "。撮り直してください"
+
+
+class RecentImageHashes:
+    """Perceptual hashes of recently recognized images, for near-duplicate warnings"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._entries = deque(maxlen=max_entries)
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+    def find(self, phash: int, max_distance: int) -> Optional[dict]:
+        """Closest recent image within `max_distance` bits, as {"filename", "distance"}"""
+        now = time.monotonic()
+        best = None
+        with self._lock:
+            for stored_at, stored_hash, filename in self._entries:
+                if now - stored_at > self._ttl_seconds:
+                    continue
+                distance = bin(phash ^ stored_hash).count("1")
+                if distance <= max_distance and (best is None or distance < best["distance"]):
+                    best = {"filename": filename, "distance": distance}
+        return best
+
+    def add(self, phash: int, filename: Optional[str]) -> None:
+        with self._lock:
+            self._entries.append((time.monotonic(), phash, filename))
+
+
+# 直近 1 日・最大 500 枚
+recent_image_hashes = RecentImageHashes(500, 24 * 3600)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""請求金額の計算（割引・消費税・合計）
+
+DBアクセスも副作用もない純粋関数のみ。金額は円単位の整数、率は
+ベーシスポイント（1% = 100bp）の整数で扱い、端数は切り捨てる。
+複数の請求書はまとめて calculate_invoices に渡せる。
+"""
+from decimal import Decimal
+from typing import List, NamedTuple, Optional, Sequence
+
+BASIS_POINTS = 10000
+
+
+class InvoiceAmounts(NamedTuple):
+    """Computed amounts of one invoice (all integer yen)"""
+    quota_subtotal: int
+    quota_discount_amount: int
+    quota_total: int
+    non_quota_subtotal: int
+    non_quota_discount_amount: int
+    non_quota_total: int
+    total_amount_ex_tax: int
+    tax_amount: int
+    total_amount_inc_tax: int
+
+
+def rate_to_basis_points(raw_rate) -> int:
+    """Convert a stored rate to basis points
+
+    Rates are stored either as a percentage (10 = 10%) or as a fraction
+    (0.10 = 10%); values >= 1 are treated as percentages. The conversion
+    goes through Decimal so DECIMAL(4, 2) values stay exact.
+    """
+    if raw_rate is None:
+        return 0
+    value = Decimal(str(raw_rate))
+    if value >= 1:
+        value = value * 100
+    else:
+        value = value * BASIS_POINTS
+    return int(value.to_integral_value())
+
+
+def basis_points_to_fraction(rate_bp: int) -> float:
+    """Rate as a fraction for API responses (2000bp -> 0.2)"""
+    return rate_bp / BASIS_POINTS
+
+
+def basis_points_to_percent(rate_bp: int) -> float:
+    """Rate as a percentage for display (2000bp -> 20.0)"""
+    return rate_bp / 100
+
+
+def normalize_rate(raw_rate) -> float:
+    """Convert a stored rate to a fraction (10 = 10% and 0.10 = 10% both become 0.10)"""
+    return basis_points_to_fraction(rate_to_basis_points(raw_rate))
+
+
+def apply_rate(amount: int, rate_bp: int) -> int:
+    """amount x rate, rounded down to whole yen"""
+    return amount * rate_bp // BASIS_POINTS
+
+
+def calculate_invoice(
+    quota_subtotal: int,
+    non_quota_subtotal: int,
+    discount_rate_bp: int,
+    tax_rate_bp: int,
+    non_discountable_amount: int = 0
+) -> InvoiceAmounts:
+    """Discount, tax and totals of one invoice"""
+    quota_discount_amount = apply_rate(quota_subtotal, discount_rate_bp)
+    non_quota_discount_amount = apply_rate(non_quota_subtotal, discount_rate_bp)
+    quota_total = quota_subtotal - quota_discount_amount
+    non_quota_total = non_quota_subtotal - non_quota_discount_amount
+    total_amount_ex_tax = quota_total + non_quota_total + non_discountable_amount
+    tax_amount = apply_rate(total_amount_ex_tax, tax_rate_bp)
+    return InvoiceAmounts(
+        quota_subtotal=quota_subtotal,
+        quota_discount_amount=quota_discount_amount,
+        quota_total=quota_total,
+        non_quota_subtotal=non_quota_subtotal,
+        non_quota_discount_amount=non_quota_discount_amount,
+        non_quota_total=non_quota_total,
+        total_amount_ex_tax=total_amount_ex_tax,
+        tax_amount=tax_amount,
+        total_amount_inc_tax=total_amount_ex_tax + tax_amount
+    )
+
+
+def calculate_invoices(
+    quota_subtotals: Sequence[int],
+    non_quota_subtotals: Sequence[int],
+    discount_rate_bps: Sequence[int],
+    tax_rate_bp: int,
+    non_discountable_amounts: Optional[Sequence[int]] = None
+) -> List[InvoiceAmounts]:
+    """Batch version of calculate_invoice over parallel sequences
+
+    All sequences are indexed by invoice; the tax rate is shared by the batch.
+    Each step runs as one column pass over the whole batch (discounts, then
+    totals, then tax) instead of one calculate_invoice call per invoice;
+    the results are identical.
+    """
+    count = len(quota_subtotals)
+    if len(non_quota_subtotals) != count or len(discount_rate_bps) != count:
+        raise ValueError("quota_subtotals, non_quota_subtotals and discount_rate_bps must have the same length")
+    if non_discountable_amounts is None:
+        non_discountable_amounts = [0] * count
+    elif len(non_discountable_amounts) != count:
+        raise ValueError("non_discountable_amounts must have the same length as quota_subtotals")
+
+    quota_discounts = [q * bp // BASIS_POINTS for q, bp in zip(quota_subtotals, discount_rate_bps)]
+    non_quota_discounts = [n * bp // BASIS_POINTS for n, bp in zip(non_quota_subtotals, discount_rate_bps)]
+    quota_totals = [q - d for q, d in zip(quota_subtotals, quota_discounts)]
+    non_quota_totals = [n - d for n, d in zip(non_quota_subtotals, non_quota_discounts)]
+    totals_ex_tax = [q + n + x for q, n, x in zip(quota_totals, non_quota_totals, non_discountable_amounts)]
+    taxes = [total * tax_rate_bp // BASIS_POINTS for total in totals_ex_tax]
+
+    return list(map(
+        InvoiceAmounts._make,
+        zip(
+            quota_subtotals, quota_discounts, quota_totals,
+            non_quota_subtotals, non_quota_discounts, non_quota_totals,
+            totals_ex_tax, taxes, [total + tax for total, tax in zip(totals_ex_tax, taxes)]
+        )
+    ))
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""販売員請求書の一括生成エンジン
+
+締め期間内の全対象販売員の納品書明細を集計（通常の21日〜20日締めは
+delivery_note_period_totals から、それ以外は1回のGROUP BYクエリ）し、
+請求書と明細を1トランザクションでまとめて登録・更新する。
+"""
+from datetime import date
+from typing import Dict, List, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import func, insert, update
+from sqlalchemy.orm import Session
+
+from models import (
+    SalesInvoice,
+    SalesInvoiceDetail,
+    DeliveryNote,
+    DeliveryNoteDetail,
+    Product,
+    SalesPerson
+)
+from invoice_calculation import calculate_invoices, normalize_rate, rate_to_basis_points
+from master_cache import get_master_data
+from period_totals import delivery_date_in_period, is_standard_period, load_period_totals, sales_persons_with_notes
+
+DEFAULT_INVOICE_NUMBER = "T5810180900550"
+
+# 既存請求書の再生成モード
+# diff: 変更のあった明細だけを更新・追加・削除（変更なしなら書き込みなし）
+# replace: 明細を全削除して再登録
+REGENERATION_MODE_DIFF = "diff"
+REGENERATION_MODE_REPLACE = "replace"
+
+
+def calculate_period_start(closing_date: date) -> date:
+    """締め日から集計開始日（前月21日）を計算"""
+    if closing_date.day >= 21:
+        # If closing date is >= 21st, start from same month 21st
+        return closing_date.replace(day=21)
+    # If closing date is < 21st, start from previous month 21st
+    if closing_date.month == 1:
+        return closing_date.replace(year=closing_date.year - 1, month=12, day=21)
+    return closing_date.replace(month=closing_date.month - 1, day=21)
+
+
+def insert_invoice_details(rows: List[dict], db: Session) -> List[int]:
+    """Insert SalesInvoiceDetail rows with one multi-row INSERT ... RETURNING
+
+    Rows can span several invoices (a whole bulk run). Returns the new ids
+    in the same order as `rows`.
+    """
+    if not rows:
+        return []
+    result = db.execute(
+        insert(SalesInvoiceDetail).returning(SalesInvoiceDetail.id, sort_by_parameter_order=True),
+        rows
+    )
+    return [row.id for row in result]
+
+
+def _load_stored_details(invoice_ids: List[int], db: Session) -> Dict[int, list]:
+    """Stored detail lines of the given invoices, grouped by invoice id"""
+    stored: Dict[int, list] = {}
+    rows = db.query(
+        SalesInvoiceDetail.id,
+        SalesInvoiceDetail.sales_invoice_id,
+        SalesInvoiceDetail.product_id,
+        SalesInvoiceDetail.total_quantity,
+        SalesInvoiceDetail.unit_price,
+        SalesInvoiceDetail.amount
+    ).filter(
+        SalesInvoiceDetail.sales_invoice_id.in_(invoice_ids)
+    ).order_by(SalesInvoiceDetail.id).all()
+    for row in rows:
+        stored.setdefault(row.sales_invoice_id, []).append(row)
+    return stored
+
+
+def diff_invoice_details(stored_rows: Sequence, invoice_details: List[dict]) -> Tuple[List[dict], List[dict], List[int]]:
+    """Compare stored detail rows with freshly aggregated lines
+
+    Lines are matched on (product_id, unit_price). Matched lines keep their
+    row id (written into the line dict). Returns (updates, inserts,
+    delete_ids): updates are {id, total_quantity, amount} dicts for rows
+    whose numbers changed, inserts are the lines without a stored row and
+    delete_ids are stored rows that no longer have a line.
+    """
+    stored_by_key: Dict[tuple, list] = {}
+    for row in stored_rows:
+        stored_by_key.setdefault((row.product_id, row.unit_price), []).append(row)
+
+    updates = []
+    inserts = []
+    for detail_data in invoice_details:
+        candidates = stored_by_key.get((detail_data['product_id'], detail_data['unit_price']))
+        if not candidates:
+            inserts.append(detail_data)
+            continue
+        row = candidates.pop(0)
+        detail_data['id'] = row.id
+        if row.total_quantity != detail_data['total_quantity'] or row.amount != detail_data['amount']:
+            updates.append({
+                'id': row.id,
+                'total_quantity': detail_data['total_quantity'],
+                'amount': detail_data['amount']
+            })
+
+    delete_ids = [row.id for rows in stored_by_key.values() for row in rows]
+    return updates, inserts, delete_ids
+
+
+def _aggregate_period(
+    sales_person_ids: List[int],
+    start_date: date,
+    end_date: date,
+    db: Session
+) -> Dict[int, list]:
+    """Aggregate delivery note details per sales person, product and unit price
+
+    A standard 21st-to-20th period is read from the delivery_note_period_totals
+    rollup. Any other range falls back to one grouped query over the raw
+    details. Either way sales persons whose delivery notes have no detail
+    lines are kept, so they still get a (zero) invoice like the per-person
+    generator did.
+    """
+    if is_standard_period(start_date, end_date):
+        aggregated: Dict[int, list] = {
+            sales_person_id: []
+            for sales_person_id in sales_persons_with_notes(sales_person_ids, start_date, end_date, db)
+        }
+        for row in load_period_totals(sales_person_ids, end_date, db):
+            aggregated.setdefault(row.sales_person_id, []).append(row)
+        return aggregated
+
+    rows = db.query(
+        DeliveryNote.sales_person_id,
+        DeliveryNoteDetail.product_id,
+        Product.name.label('product_name'),
+        Product.quota_target_flag,
+        DeliveryNoteDetail.unit_price,
+        func.sum(DeliveryNoteDetail.quantity).label('total_quantity')
+    ).outerjoin(
+        DeliveryNoteDetail, DeliveryNoteDetail.delivery_note_id == DeliveryNote.id
+    ).outerjoin(
+        Product, DeliveryNoteDetail.product_id == Product.id
+    ).filter(
+        DeliveryNote.sales_person_id.in_(sales_person_ids),
+        *delivery_date_in_period(start_date, end_date)
+    ).group_by(
+        DeliveryNote.sales_person_id,
+        DeliveryNoteDetail.product_id,
+        Product.name,
+        Product.quota_target_flag,
+        DeliveryNoteDetail.unit_price
+    ).order_by(
+        DeliveryNote.sales_person_id,
+        DeliveryNoteDetail.product_id,
+        DeliveryNoteDetail.unit_price
+    ).all()
+
+    aggregated = {}
+    for row in rows:
+        lines = aggregated.setdefault(row.sales_person_id, [])
+        # Delivery note without details (or with a missing product): person is
+        # in scope but contributes no line
+        if row.product_id is None or row.product_name is None:
+            continue
+        lines.append(row)
+    return aggregated
+
+
+def bulk_generate_invoices(
+    sales_persons: Sequence[SalesPerson],
+    start_date: date,
+    end_date: date,
+    db: Session,
+    regeneration_mode: str = REGENERATION_MODE_DIFF
+) -> Tuple[List[dict], List[str]]:
+    """Generate or regenerate invoices for many sales persons in one transaction
+
+    Returns (invoices, skipped_person_names). Each invoice is a dict shaped
+    like InvoiceResponse. Sales persons without delivery notes in the period
+    are skipped. Existing invoices for the period are regenerated according
+    to `regeneration_mode` (see REGENERATION_MODE_*).
+    """
+    if not sales_persons:
+        return [], []
+
+    sales_person_ids = [sp.id for sp in sales_persons]
+    aggregated = _aggregate_period(sales_person_ids, start_date, end_date, db)
+
+    targets = [sp for sp in sales_persons if sp.id in aggregated]
+    skipped_persons = [sp.name for sp in sales_persons if sp.id not in aggregated]
+    if not targets:
+        return [], skipped_persons
+
+    # Tax rate and discount tiers come from the master cache
+    masters = get_master_data(db)
+    tax_rate = masters.current_tax_rate
+    if not tax_rate:
+        raise HTTPException(status_code=404, detail="Tax rate not found")
+    tax_rate_bp = rate_to_basis_points(tax_rate.rate)
+
+    discount_tiers = masters.customer_discount_tiers
+
+    # Existing invoices for the same period (first one wins, as before)
+    existing_invoices: Dict[int, SalesInvoice] = {}
+    for invoice in db.query(SalesInvoice).filter(
+        SalesInvoice.sales_person_id.in_([sp.id for sp in targets]),
+        SalesInvoice.start_date == start_date,
+        SalesInvoice.end_date == end_date
+    ).order_by(SalesInvoice.id).all():
+        existing_invoices.setdefault(invoice.sales_person_id, invoice)
+
+    # 請求日 = 締め日と同じ / 領収日 = 請求日当月の25日
+    invoice_date = end_date
+    receipt_date = end_date.replace(day=25)
+
+    # 1st pass: line items, subtotals and discount tier per sales person
+    collected = []
+    for sales_person in targets:
+        quota_subtotal = 0
+        non_quota_subtotal = 0
+        invoice_details = []
+        for item in aggregated[sales_person.id]:
+            amount = item.total_quantity * item.unit_price
+            if item.quota_target_flag:
+                quota_subtotal += amount
+            else:
+                non_quota_subtotal += amount
+            invoice_details.append({
+                'product_id': item.product_id,
+                'product_name': item.product_name,
+                'total_quantity': item.total_quantity,
+                'unit_price': item.unit_price,
+                'amount': amount
+            })
+
+        discount_rate = discount_tiers.lookup(quota_subtotal + non_quota_subtotal)
+        if not discount_rate:
+            raise HTTPException(status_code=404, detail="Discount rate not found")
+        collected.append((sales_person, discount_rate, quota_subtotal, non_quota_subtotal, invoice_details))
+
+    # 2nd pass: amounts of the whole batch in integer arithmetic
+    # A batch uses only a handful of tiers: convert each tier's rate once
+    tier_bps = {tier.id: rate_to_basis_points(tier.rate) for tier in {entry[1] for entry in collected}}
+    amounts = calculate_invoices(
+        [entry[2] for entry in collected],
+        [entry[3] for entry in collected],
+        [tier_bps[entry[1].id] for entry in collected],
+        tax_rate_bp
+    )
+
+    plans = []
+    new_invoices = []
+    for (sales_person, discount_rate, _, _, invoice_details), invoice_amounts in zip(collected, amounts):
+        values = dict(
+            discount_rate_id=discount_rate.id,
+            invoice_date=invoice_date,
+            receipt_date=receipt_date,
+            **invoice_amounts._asdict()
+        )
+
+        invoice = existing_invoices.get(sales_person.id)
+        if invoice:
+            for key, value in values.items():
+                # Only touch changed columns so identical regenerations emit no UPDATE
+                if getattr(invoice, key) != value:
+                    setattr(invoice, key, value)
+        else:
+            invoice = SalesInvoice(
+                sales_person_id=sales_person.id,
+                invoice_number=DEFAULT_INVOICE_NUMBER,
+                start_date=start_date,
+                end_date=end_date,
+                **values
+            )
+            new_invoices.append(invoice)
+
+        plans.append((sales_person, invoice, normalize_rate(discount_rate.rate), invoice_details))
+
+    try:
+        detail_updates: List[dict] = []
+        delete_detail_ids: List[int] = []
+        # (detail_data, invoice) pairs that need a fresh row
+        pending_inserts = []
+
+        if existing_invoices and regeneration_mode == REGENERATION_MODE_DIFF:
+            stored_details = _load_stored_details([inv.id for inv in existing_invoices.values()], db)
+        else:
+            stored_details = {}
+            # Delete old details of every regenerated invoice in one statement
+            if existing_invoices:
+                db.query(SalesInvoiceDetail).filter(
+                    SalesInvoiceDetail.sales_invoice_id.in_([inv.id for inv in existing_invoices.values()])
+                ).delete(synchronize_session=False)
+
+        for sales_person, invoice, _, invoice_details in plans:
+            if sales_person.id in existing_invoices and regeneration_mode == REGENERATION_MODE_DIFF:
+                updates, inserts, delete_ids = diff_invoice_details(
+                    stored_details.get(invoice.id, []), invoice_details
+                )
+                detail_updates.extend(updates)
+                delete_detail_ids.extend(delete_ids)
+                pending_inserts.extend((detail_data, invoice) for detail_data in inserts)
+            else:
+                pending_inserts.extend((detail_data, invoice) for detail_data in invoice_details)
+
+        if delete_detail_ids:
+            db.query(SalesInvoiceDetail).filter(
+                SalesInvoiceDetail.id.in_(delete_detail_ids)
+            ).delete(synchronize_session=False)
+        if detail_updates:
+            # ORM bulk UPDATE by primary key (executemany)
+            db.execute(update(SalesInvoiceDetail), detail_updates)
+
+        db.add_all(new_invoices)
+        db.flush()
+
+        detail_rows = [
+            dict(
+                sales_invoice_id=invoice.id,
+                product_id=detail_data['product_id'],
+                total_quantity=detail_data['total_quantity'],
+                unit_price=detail_data['unit_price'],
+                amount=detail_data['amount']
+            )
+            for detail_data, invoice in pending_inserts
+        ]
+        detail_ids = insert_invoice_details(detail_rows, db)
+        for (detail_data, _), detail_id in zip(pending_inserts, detail_ids):
+            detail_data['id'] = detail_id
+
+        # Build the payload before commit so expired attributes are not reloaded
+        generated_invoices = [
+            {
+                "id": invoice.id,
+                "sales_person_id": sales_person.id,
+                "sales_person_name": sales_person.name or "",
+                "invoice_number": invoice.invoice_number,
+                "start_date": invoice.start_date,
+                "end_date": invoice.end_date,
+                "invoice_date": invoice.invoice_date,
+                "receipt_date": invoice.receipt_date,
+                "discount_rate_id": invoice.discount_rate_id,
+                "discount_rate": discount_rate_value,
+                "quota_subtotal": invoice.quota_subtotal,
+                "quota_discount_amount": invoice.quota_discount_amount,
+                "quota_total": invoice.quota_total,
+                "non_quota_subtotal": invoice.non_quota_subtotal,
+                "non_quota_discount_amount": invoice.non_quota_discount_amount,
+                "non_quota_total": invoice.non_quota_total,
+                "total_amount_ex_tax": invoice.total_amount_ex_tax,
+                "tax_amount": invoice.tax_amount,
+                "total_amount_inc_tax": invoice.total_amount_inc_tax,
+                "details": invoice_details
+            }
+            for sales_person, invoice, discount_rate_value, invoice_details in plans
+        ]
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return generated_invoices, skipped_persons
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""請求書一括生成のバックグラウンドジョブ
+
+POST /sales-invoices/bulk-generate はジョブを登録してすぐにジョブIDを返し、
+実際の生成はワーカースレッドで行う。ジョブの状態は invoice_generation_jobs
+テーブルに保存するので、進捗・結果はどのワーカー・マシンからでも取得できる。
+対象販売員はチャンクに分割し、INVOICE_GENERATION_WORKERS 本のスレッドで
+並列に処理する（チャンクごとに専用セッション・トランザクション）。
+
+ジョブを実行しているプロセスは heartbeat_at を定期的に更新する。再起動などで
+更新が JOB_STALE_SECONDS 止まった未完了のジョブは失敗として返す。
+"""
+import threading
+import time
+import traceback
+import math
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, update
+from sqlalchemy.orm import Session
+
+from config import settings
+from database import SessionLocal
+from invoice_generator import REGENERATION_MODE_DIFF, bulk_generate_invoices
+from models import InvoiceGenerationJob, SalesPerson
+
+# 1トランザクションで処理する販売員数の上限（失敗時はこの単位で1人ずつ再実行）
+JOB_CHUNK_SIZE = 20
+# 完了したジョブを保持する秒数
+JOB_RETENTION_SECONDS = 60 * 60
+# 実行中・待機中のジョブの heartbeat_at を更新する間隔
+JOB_HEARTBEAT_SECONDS = 30
+# heartbeat_at がこれより古い未完了のジョブは、実行していたプロセスが止まったとみなす
+JOB_STALE_SECONDS = 5 * 60
+JOB_INTERRUPTED_ERROR = "Job was interrupted: the server running it stopped before it finished"
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_COMPLETED = "completed"
+JOB_STATUS_FAILED = "failed"
+
+PERSON_STATUS_PENDING = "pending"
+PERSON_STATUS_GENERATED = "generated"
+PERSON_STATUS_SKIPPED = "skipped"
+PERSON_STATUS_FAILED = "failed"
+
+SalesPersonRef = namedtuple("SalesPersonRef", ["id", "name"])
+
+# Jobs queued or running in this process, kept alive by the heartbeat thread
+_ACTIVE_JOBS: Dict[str, "BulkInvoiceJob"] = {}
+_LOCK = threading.Lock()
+_heartbeat_thread: Optional[threading.Thread] = None
+# Closing runs of this process are executed one at a time so two runs never race on the same period
+_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bulk-invoice")
+# 同期エンジンの接続のうち、チャンク以外（ジョブ行の保存・ハートビート・Geminiクォータ台帳）に残す本数
+SYNC_CONNECTIONS_RESERVED = 2
+# Chunks of one run are spread over this pool; each chunk holds a sync engine connection,
+# so the pool is capped at the sync pool budget minus the reserved connections
+_SYNC_POOL_BUDGET = settings.DB_SYNC_POOL_SIZE + settings.DB_SYNC_MAX_OVERFLOW
+_WORKER_COUNT = max(1, min(settings.INVOICE_GENERATION_WORKERS, _SYNC_POOL_BUDGET - SYNC_CONNECTIONS_RESERVED))
+if _WORKER_COUNT < settings.INVOICE_GENERATION_WORKERS:
+    print(
+        f"[WARN] INVOICE_GENERATION_WORKERS={settings.INVOICE_GENERATION_WORKERS} exceeds the sync DB pool "
+        f"({_SYNC_POOL_BUDGET} connections, {SYNC_CONNECTIONS_RESERVED} reserved); using {_WORKER_COUNT} workers"
+    )
+_CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=_WORKER_COUNT, thread_name_prefix="bulk-invoice-chunk")
+
+
+class BulkInvoiceJob:
+    """State of one bulk generation run"""
+
+    def __init__(self, sales_persons: List[SalesPerson], start_date: date, end_date: date, regeneration_mode: str):
+        self.id = uuid.uuid4().hex
+        self.status = JOB_STATUS_QUEUED
+        self.start_date = start_date
+        self.end_date = end_date
+        self.regeneration_mode = regeneration_mode
+        self.persons: Dict[int, dict] = {
+            sp.id: {
+                "sales_person_id": sp.id,
+                "sales_person_name": sp.name,
+                "status": PERSON_STATUS_PENDING,
+                "error": None
+            }
+            for sp in sales_persons
+        }
+        self._order = {sp.id: index for index, sp in enumerate(sales_persons)}
+        self.invoices: List[dict] = []
+        self.error: Optional[str] = None
+        self.created_at = _utcnow()
+        self.finished_at: Optional[datetime] = None
+        # Serializes writes of this job's row so an older state never overwrites a newer one
+        self._save_lock = threading.Lock()
+
+    @classmethod
+    def from_row(cls, row: InvoiceGenerationJob) -> "BulkInvoiceJob":
+        """Job state as stored by the process that runs it"""
+        job = cls.__new__(cls)
+        job.id = row.id
+        job.status = row.status
+        job.start_date = row.start_date
+        job.end_date = row.end_date
+        job.regeneration_mode = row.regeneration_mode
+        job.persons = {person["sales_person_id"]: dict(person) for person in row.sales_persons}
+        job._order = {person["sales_person_id"]: index for index, person in enumerate(row.sales_persons)}
+        job.invoices = list(row.invoices)
+        job.error = row.error
+        job.created_at = row.created_at
+        job.finished_at = row.finished_at
+        job._save_lock = threading.Lock()
+        if not job.finished and _utcnow() - row.heartbeat_at > timedelta(seconds=JOB_STALE_SECONDS):
+            job.status = JOB_STATUS_FAILED
+            job.error = JOB_INTERRUPTED_ERROR
+        return job
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_STATUS_COMPLETED, JOB_STATUS_FAILED)
+
+    def _count(self, status: str) -> int:
+        return sum(1 for person in self.persons.values() if person["status"] == status)
+
+    def _period(self) -> dict:
+        return {
+            "start_date": self.start_date.isoformat(),
+            "end_date": self.end_date.isoformat()
+        }
+
+    def snapshot(self) -> dict:
+        """Progress payload for the status endpoint"""
+        with _LOCK:
+            generated = self._count(PERSON_STATUS_GENERATED)
+            skipped = self._count(PERSON_STATUS_SKIPPED)
+            failed = self._count(PERSON_STATUS_FAILED)
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "total_count": len(self.persons),
+                "processed_count": generated + skipped + failed,
+                "generated_count": generated,
+                "skipped_count": skipped,
+                "failed_count": failed,
+                "sales_persons": [dict(person) for person in self.persons.values()],
+                "error": self.error,
+                "period": self._period()
+            }
+
+    def result(self) -> dict:
+        """Final payload, same shape as the former synchronous bulk-generate response"""
+        with _LOCK:
+            return {
+                "success": self.status == JOB_STATUS_COMPLETED and self._count(PERSON_STATUS_FAILED) == 0,
+                "job_id": self.id,
+                "generated_count": len(self.invoices),
+                "skipped_count": self._count(PERSON_STATUS_SKIPPED),
+                "skipped_persons": [
+                    p["sales_person_name"] for p in self.persons.values() if p["status"] == PERSON_STATUS_SKIPPED
+                ],
+                "failed_count": self._count(PERSON_STATUS_FAILED),
+                "failed_persons": [
+                    {"sales_person_name": p["sales_person_name"], "error": p["error"]}
+                    for p in self.persons.values() if p["status"] == PERSON_STATUS_FAILED
+                ],
+                # Workers finish in any order; keep the sales person order of the request
+                "invoices": sorted(self.invoices, key=lambda invoice: self._order[invoice["sales_person_id"]]),
+                "error": self.error,
+                "period": self._period()
+            }
+
+    def _record(self, chunk_ids: List[int], invoices: List[dict]):
+        with _LOCK:
+            self.invoices.extend(invoices)
+            generated_ids = {invoice["sales_person_id"] for invoice in invoices}
+            for sales_person_id in chunk_ids:
+                self.persons[sales_person_id]["status"] = (
+                    PERSON_STATUS_GENERATED if sales_person_id in generated_ids else PERSON_STATUS_SKIPPED
+                )
+
+    def _fail(self, sales_person_id: int, error: Exception):
+        with _LOCK:
+            person = self.persons[sales_person_id]
+            person["status"] = PERSON_STATUS_FAILED
+            person["error"] = _error_message(error)
+
+    def _save(self, db: Optional[Session] = None) -> None:
+        """Write the current state to the job's row (on `db`, or a session of its own)"""
+        own_session = db is None
+        if own_session:
+            db = SessionLocal()
+        try:
+            with self._save_lock:
+                with _LOCK:
+                    values = dict(
+                        status=self.status,
+                        sales_persons=[dict(person) for person in self.persons.values()],
+                        # dates -> ISO strings; InvoiceResponse parses them back
+                        invoices=jsonable_encoder(self.invoices),
+                        error=self.error,
+                        heartbeat_at=_utcnow(),
+                        finished_at=self.finished_at
+                    )
+                row = db.get(InvoiceGenerationJob, self.id)
+                if row is None:
+                    db.add(InvoiceGenerationJob(
+                        id=self.id,
+                        start_date=self.start_date,
+                        end_date=self.end_date,
+                        regeneration_mode=self.regeneration_mode,
+                        created_at=self.created_at,
+                        **values
+                    ))
+                else:
+                    for name, value in values.items():
+                        setattr(row, name, value)
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            if own_session:
+                db.close()
+
+    def _save_progress(self, db: Optional[Session] = None) -> None:
+        """_save for a running job: pollers only see stale progress if the write fails"""
+        try:
+            self._save(db)
+        except Exception as e:
+            print(f"[WARN] Failed to store progress of bulk invoice job {self.id}: {e}")
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _error_message(error: Exception) -> str:
+    return getattr(error, "detail", None) or str(error)
+
+
+def _run_chunk(job: BulkInvoiceJob, sales_persons: List[SalesPersonRef], db) -> None:
+    invoices, _ = bulk_generate_invoices(
+        sales_persons, job.start_date, job.end_date, db,
+        regeneration_mode=job.regeneration_mode
+    )
+    job._record([sp.id for sp in sales_persons], invoices)
+
+
+def _run_chunk_in_session(job: BulkInvoiceJob, chunk: List[SalesPersonRef]) -> None:
+    """Process one chunk on its own session and transaction"""
+    db = SessionLocal()
+    try:
+        try:
+            _run_chunk(job, chunk, db)
+        except Exception:
+            db.rollback()
+            # Retry one by one so a single bad sales person does not fail the chunk
+            for sales_person in chunk:
+                try:
+                    _run_chunk(job, [sales_person], db)
+                except Exception as e:
+                    db.rollback()
+                    print(f"[bulk-invoice] Sales person {sales_person.id} failed: {e}")
+                    job._fail(sales_person.id, e)
+        job._save_progress(db)
+    finally:
+        db.close()
+
+
+def _split_chunks(sales_persons: List[SalesPersonRef]) -> List[List[SalesPersonRef]]:
+    """Spread sales persons evenly over the workers, at most JOB_CHUNK_SIZE per chunk"""
+    if not sales_persons:
+        return []
+    size = min(JOB_CHUNK_SIZE, math.ceil(len(sales_persons) / _WORKER_COUNT))
+    return [sales_persons[i:i + size] for i in range(0, len(sales_persons), size)]
+
+
+def _run_job(job: BulkInvoiceJob) -> None:
+    try:
+        with _LOCK:
+            job.status = JOB_STATUS_RUNNING
+        job._save_progress()
+
+        # Plain (id, name) records: ORM instances would expire and reload after every chunk commit
+        sales_persons = [
+            SalesPersonRef(person["sales_person_id"], person["sales_person_name"])
+            for person in job.persons.values()
+        ]
+
+        futures = [
+            _CHUNK_EXECUTOR.submit(_run_chunk_in_session, job, chunk)
+            for chunk in _split_chunks(sales_persons)
+        ]
+        for future in futures:
+            future.result()
+
+        with _LOCK:
+            job.status = JOB_STATUS_COMPLETED
+    except Exception as e:
+        print(f"[bulk-invoice] Job {job.id} failed: {e}\n{traceback.format_exc()}")
+        with _LOCK:
+            job.status = JOB_STATUS_FAILED
+            job.error = _error_message(e)
+    finally:
+        with _LOCK:
+            job.finished_at = _utcnow()
+        job._save_progress()
+        with _LOCK:
+            _ACTIVE_JOBS.pop(job.id, None)
+
+
+def _heartbeat_loop() -> None:
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        with _LOCK:
+            job_ids = list(_ACTIVE_JOBS)
+        if not job_ids:
+            continue
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(InvoiceGenerationJob)
+                .where(InvoiceGenerationJob.id.in_(job_ids), InvoiceGenerationJob.finished_at.is_(None))
+                .values(heartbeat_at=_utcnow())
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"[WARN] Failed to update bulk invoice job heartbeat: {e}")
+        finally:
+            db.close()
+
+
+def _start_heartbeat() -> None:
+    global _heartbeat_thread
+    with _LOCK:
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(
+                target=_heartbeat_loop, name="bulk-invoice-heartbeat", daemon=True
+            )
+            _heartbeat_thread.start()
+
+
+def _prune_jobs(db: Session) -> None:
+    """Delete jobs that finished (or stopped heartbeating) over JOB_RETENTION_SECONDS ago"""
+    cutoff = _utcnow() - timedelta(seconds=JOB_RETENTION_SECONDS)
+    db.execute(delete(InvoiceGenerationJob).where(InvoiceGenerationJob.heartbeat_at < cutoff))
+    db.commit()
+
+
+def submit_bulk_job(
+    sales_persons: List[SalesPerson],
+    start_date: date,
+    end_date: date,
+    db: Session,
+    regeneration_mode: str = REGENERATION_MODE_DIFF
+) -> BulkInvoiceJob:
+    """Register a bulk generation job and queue it on this process's worker"""
+    job = BulkInvoiceJob(sales_persons, start_date, end_date, regeneration_mode)
+    _prune_jobs(db)
+    job._save(db)
+    _start_heartbeat()
+    with _LOCK:
+        _ACTIVE_JOBS[job.id] = job
+    _EXECUTOR.submit(_run_job, job)
+    return job
+
+
+def get_job(job_id: str, db: Session) -> Optional[BulkInvoiceJob]:
+    """Job as last stored by whichever process runs it"""
+    row = db.get(InvoiceGenerationJob, job_id)
+    return BulkInvoiceJob.from_row(row) if row is not None else None
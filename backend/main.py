@@ -1,14 +1,24 @@
+import asyncio
 import os
 import sys
 sys.path.insert(0, os.path.dirname(__file__))
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from admission_control import AdmissionControlMiddleware
 from routers import auth_router, masters_router, delivery_notes_router
 from routers.sales_invoices import router as sales_invoices_router
+from cache_invalidation import start_invalidation_listener, stop_invalidation_listener
+from config import settings
+from database import keep_pool_alive, warm_up_pool
+from executors import shutdown_executors
+from genai_wrapper import close_clients as close_genai_clients
 
 app = FastAPI(title="Invoice Management API", version="1.0.0")
 
+# ルート種別ごとの同時実行制御（CORSより内側に置き、拒否レスポンスにもCORSヘッダーを付ける）
+app.add_middleware(AdmissionControlMiddleware)
+
 # CORS設定
 app.add_middleware(
     CORSMiddleware,
@@ -21,6 +31,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Retry-After"],  # 請求書一覧のキーセットページング用・混雑時の再試行間隔
 )
 
 app.include_router(auth_router, prefix="/api")
@@ -28,6 +39,33 @@ app.include_router(masters_router, prefix="/api")
 app.include_router(delivery_notes_router, prefix="/api")
 app.include_router(sales_invoices_router, prefix="/api")
 
+@app.on_event("startup")
+def start_background_listeners():
+    # 他ワーカーからのキャッシュ無効化通知を受け取る
+    start_invalidation_listener(settings.CACHE_INVALIDATION_DATABASE_URL)
+
+@app.on_event("startup")
+async def prepare_db_pool():
+    # 最初のリクエストで接続確立を待たないよう事前に接続し、アイドル中も接続を維持する
+    await warm_up_pool()
+    app.state.db_keepalive = asyncio.create_task(keep_pool_alive())
+
+@app.on_event("shutdown")
+def stop_background_listeners():
+    stop_invalidation_listener()
+
+@app.on_event("shutdown")
+async def stop_db_keepalive():
+    app.state.db_keepalive.cancel()
+
+@app.on_event("shutdown")
+async def close_genai_connections():
+    await close_genai_clients()
+
+@app.on_event("shutdown")
+def stop_executors():
+    shutdown_executors()
+
 @app.get("/")
 async def root():
     return {"message": "Invoice Management API"}
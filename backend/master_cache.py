@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""マスタデータのプロセス内キャッシュ
+
+販売員・商品・税率・割引率をIDをキーにした辞書（値は変更不可のレコード）として保持する。
+マスタを変更したら（他ワーカーでの変更は cache_invalidation 経由で）
+バージョンが上がり、次の参照時に作り直す。
+スクリプト等で直接DBを書き換えた場合に備え、一定時間で再読込もする。
+"""
+import hashlib
+import threading
+import time
+from decimal import Decimal
+from types import MappingProxyType
+from typing import List, Mapping, NamedTuple, Optional
+
+from sqlalchemy.orm import Session
+
+from cache_invalidation import SCOPE_MASTERS, subscribe
+from discount_tiers import DiscountTier, DiscountTierIndex
+from models import DiscountRate, Product, SalesPerson, TaxRate
+
+# キャッシュの最大保持秒数（アプリ外からの変更を拾うための保険）
+MASTER_CACHE_TTL_SECONDS = 300
+
+
+class SalesPersonRecord(NamedTuple):
+    id: int
+    name: str
+    deleted_flag: bool
+
+
+class ProductRecord(NamedTuple):
+    id: int
+    name: str
+    price: int
+    discount_exclusion_flag: bool
+    quota_exclusion_flag: bool
+    quota_target_flag: bool
+    deleted_flag: bool
+    display_order: int
+
+
+class TaxRateRecord(NamedTuple):
+    id: int
+    rate: Decimal
+    display_name: str
+    deleted_flag: bool
+
+
+class MasterData:
+    """One immutable snapshot of the master tables
+
+    The id-indexed mappings include logically deleted rows so existing
+    invoices can still resolve them; the active_* lists do not.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        sales_persons: List[SalesPersonRecord],
+        products: List[ProductRecord],
+        tax_rates: List[TaxRateRecord],
+        discount_rates: List[DiscountTier]
+    ):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.sales_persons: Mapping[int, SalesPersonRecord] = MappingProxyType({r.id: r for r in sales_persons})
+        self.products: Mapping[int, ProductRecord] = MappingProxyType({r.id: r for r in products})
+        self.tax_rates: Mapping[int, TaxRateRecord] = MappingProxyType({r.id: r for r in tax_rates})
+        self.discount_rates: Mapping[int, DiscountTier] = MappingProxyType({r.id: r for r in discount_rates})
+
+        self.active_sales_persons = tuple(r for r in sales_persons if not r.deleted_flag)
+        self.active_products = tuple(r for r in products if not r.deleted_flag)
+        self.active_tax_rates = tuple(r for r in tax_rates if not r.deleted_flag)
+        active_discount_rates = [r for r in discount_rates if not r.deleted_flag]
+        self.customer_discount_tiers = DiscountTierIndex([r for r in active_discount_rates if r.customer_flag])
+        self.contractor_discount_tiers = DiscountTierIndex([r for r in active_discount_rates if not r.customer_flag])
+        # 有効なマスタの内容ハッシュ（version と違いプロセス・再起動をまたいで同じ値になる）
+        self.fingerprint = hashlib.sha256(repr((
+            self.active_sales_persons, self.active_products, self.active_tax_rates, active_discount_rates
+        )).encode("utf-8")).hexdigest()[:16]
+
+    @property
+    def current_tax_rate(self) -> Optional[TaxRateRecord]:
+        """The tax rate applied to invoices (first active one)"""
+        return self.active_tax_rates[0] if self.active_tax_rates else None
+
+
+_VERSION = 0
+_SNAPSHOT: Optional[MasterData] = None
+_LOCK = threading.Lock()
+
+
+def master_version() -> int:
+    return _VERSION
+
+
+def bump_master_version() -> int:
+    """Mark the cached masters stale
+
+    Called for every SCOPE_MASTERS invalidation event, whether published by
+    this process or received from another worker.
+    """
+    global _VERSION
+    with _LOCK:
+        _VERSION += 1
+        return _VERSION
+
+
+subscribe(SCOPE_MASTERS, lambda ids: bump_master_version())
+
+
+def _load(version: int, db: Session) -> MasterData:
+    sales_persons = [
+        SalesPersonRecord(row.id, row.name, bool(row.deleted_flag))
+        for row in db.query(SalesPerson.id, SalesPerson.name, SalesPerson.deleted_flag).order_by(SalesPerson.id)
+    ]
+    products = [
+        ProductRecord(
+            row.id, row.name, row.price,
+            bool(row.discount_exclusion_flag), bool(row.quota_exclusion_flag), bool(row.quota_target_flag),
+            bool(row.deleted_flag), row.display_order or 0
+        )
+        for row in db.query(
+            Product.id, Product.name, Product.price,
+            Product.discount_exclusion_flag, Product.quota_exclusion_flag, Product.quota_target_flag,
+            Product.deleted_flag, Product.display_order
+        ).order_by(Product.id)
+    ]
+    tax_rates = [
+        TaxRateRecord(row.id, Decimal(str(row.rate)), row.display_name, bool(row.deleted_flag))
+        for row in db.query(TaxRate.id, TaxRate.rate, TaxRate.display_name, TaxRate.deleted_flag).order_by(TaxRate.id)
+    ]
+    discount_rates = [
+        DiscountTier(
+            row.id, Decimal(str(row.rate)), row.threshold_amount or 0,
+            bool(row.customer_flag), bool(row.deleted_flag)
+        )
+        for row in db.query(
+            DiscountRate.id, DiscountRate.rate, DiscountRate.threshold_amount,
+            DiscountRate.customer_flag, DiscountRate.deleted_flag
+        ).order_by(DiscountRate.id)
+    ]
+    return MasterData(version, sales_persons, products, tax_rates, discount_rates)
+
+
+def _is_fresh(snapshot: Optional[MasterData]) -> bool:
+    return (
+        snapshot is not None
+        and snapshot.version == _VERSION
+        and time.monotonic() - snapshot.loaded_at < MASTER_CACHE_TTL_SECONDS
+    )
+
+
+def get_master_data(db: Session) -> MasterData:
+    """Current snapshot; rebuilt with `db` when the version changed or the TTL expired
+
+    The load runs without holding _LOCK: under AsyncSession.run_sync each
+    query yields to the event loop, and another coroutine taking the thread
+    lock on the loop thread would deadlock the worker. Concurrent cold reads
+    may load twice; only a load of the still-current version is kept.
+    """
+    global _SNAPSHOT
+    snapshot = _SNAPSHOT
+    if _is_fresh(snapshot):
+        return snapshot
+
+    version = _VERSION
+    snapshot = _load(version, db)
+    with _LOCK:
+        # 読み込み中にマスタが変わった場合は古い内容を保持しない（呼び出し元には返す）
+        if version == _VERSION:
+            _SNAPSHOT = snapshot
+    return snapshot
+
+
+def customer_discount_tiers(db: Session) -> DiscountTierIndex:
+    """販売員向け割引率"""
+    return get_master_data(db).customer_discount_tiers
+
+
+def contractor_discount_tiers(db: Session) -> DiscountTierIndex:
+    """委託先向け割引率"""
+    return get_master_data(db).contractor_discount_tiers
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DECIMAL, TIMESTAMP, Text, func, ForeignKey, JSON, Date
+from sqlalchemy import Column, Integer, String, Boolean, DECIMAL, TIMESTAMP, Text, func, ForeignKey, JSON, Date, Index, UniqueConstraint, Float, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -106,6 +106,26 @@ class DeliveryNoteDetail(Base):
     delivery_note = relationship("DeliveryNote", back_populates="details")
     product = relationship("Product")
 
+# 納品書明細の締め期間別集計（納品書の登録・更新・削除と同一トランザクションで更新）
+class DeliveryNotePeriodTotal(Base):
+    __tablename__ = "delivery_note_period_totals"
+
+    id = Column(Integer, primary_key=True, index=True)
+    sales_person_id = Column(Integer, ForeignKey("sales_persons.id"), nullable=False)
+    period_end = Column(Date, nullable=False)  # 締め日（21日〜翌月20日の20日）
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    unit_price = Column(Integer, nullable=False)
+    total_quantity = Column(Integer, default=0, nullable=False)
+    total_amount = Column(Integer, default=0, nullable=False)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    product = relationship("Product")
+
+    __table_args__ = (
+        UniqueConstraint("sales_person_id", "period_end", "product_id", "unit_price", name="uq_delivery_note_period_totals_key"),
+        Index("ix_delivery_note_period_totals_period_sales_person", "period_end", "sales_person_id"),
+    )
+
 # 請求書テーブル
 class SalesInvoice(Base):
     __tablename__ = "sales_invoices"
@@ -138,13 +158,22 @@ class SalesInvoice(Base):
     tax_amount = Column(Integer, default=0, nullable=False)
     total_amount_inc_tax = Column(Integer, default=0, nullable=False)
     
-    created_at = Column(TIMESTAMP, server_default=func.now())
+    created_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
     updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
     
     sales_person = relationship("SalesPerson")
     discount_rate = relationship("DiscountRate")
     details = relationship("SalesInvoiceDetail", back_populates="sales_invoice", cascade="all, delete-orphan")
 
+    # 一覧のキーセットページング・絞り込み用インデックス
+    __table_args__ = (
+        # 一覧の並び (created_at desc, id desc) と同じ向き
+        Index("ix_sales_invoices_created_at_id", text("created_at DESC"), text("id DESC")),
+        Index("ix_sales_invoices_sales_person_period", "sales_person_id", "start_date", "end_date"),
+        Index("ix_sales_invoices_period", "start_date", "end_date"),
+        Index("ix_sales_invoices_total_amount_inc_tax", "total_amount_inc_tax"),
+    )
+
 class SalesInvoiceDetail(Base):
     __tablename__ = "sales_invoice_details"
     
@@ -163,4 +192,41 @@ class SalesInvoiceDetail(Base):
 class ContractorInvoice(Base):
     __tablename__ = "contractor_invoices"
     id = Column(Integer, primary_key=True, index=True)
-    # 詳細は後で定義
\ No newline at end of file
+    # 詳細は後で定義
+
+# Gemini APIキーごとのクォータ残量（全ワーカー・全マシンで共有、genai_quota.py）
+class GenAIKeyQuota(Base):
+    __tablename__ = "genai_key_quotas"
+
+    key_id = Column(String(16), primary_key=True)  # APIキーのSHA-256先頭16桁（キー自体は保存しない）
+    minute_requests = Column(Float, nullable=False)  # トークンバケットの残量
+    minute_tokens = Column(Float, nullable=False)
+    day_requests = Column(Float, nullable=False)
+    refilled_at = Column(Float, nullable=False)  # 残量を最後に計算した時刻（UNIX秒）
+    cooldown_until = Column(Float, default=0, nullable=False)  # 429後の休止期限（UNIX秒）
+    consecutive_rate_limits = Column(Integer, default=0, nullable=False)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+# 納品書画像の認識結果キャッシュ（画像・マスタ・プロンプトが同じなら再利用、recognition_cache.py）
+class RecognitionCacheEntry(Base):
+    __tablename__ = "recognition_cache_entries"
+
+    cache_key = Column(String(64), primary_key=True)  # SHA-256(画像ハッシュ, マスタ, プロンプト版, モデル)
+    result = Column(JSON, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False, index=True)  # UTC
+
+# 請求書一括生成ジョブの状態（invoice_jobs.py）。どのワーカー・マシンからでも進捗を取得できるようDBに保持
+class InvoiceGenerationJob(Base):
+    __tablename__ = "invoice_generation_jobs"
+
+    id = Column(String(32), primary_key=True)  # uuid4 hex
+    status = Column(String(20), nullable=False)  # queued / running / completed / failed
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+    regeneration_mode = Column(String(20), nullable=False)
+    sales_persons = Column(JSON, nullable=False)  # 販売員ごとの状態（リクエストの順）
+    invoices = Column(JSON, nullable=False)  # 生成した請求書（result の invoices）
+    error = Column(Text)
+    created_at = Column(TIMESTAMP, nullable=False)  # UTC
+    heartbeat_at = Column(TIMESTAMP, nullable=False, index=True)  # UTC。実行中のプロセスが定期的に更新
+    finished_at = Column(TIMESTAMP)  # UTC
@@ -8,9 +8,13 @@ from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.colors import black, white
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
+from typing import List, Tuple
 import os
+import threading
 
-from models import SalesInvoice, SalesInvoiceDetail, Product, SalesPerson, DiscountRate
+from models import SalesInvoice, SalesInvoiceDetail
+from invoice_calculation import apply_rate, basis_points_to_percent, rate_to_basis_points
+from master_cache import MasterData, get_master_data
 
 # 会社情報（固定値）
 COMPANY_INFO = {
@@ -33,8 +37,20 @@ BANK_INFO = {
 }
 
 
+_FONT_LOCK = threading.Lock()
+_FONT_NAME = None
+
+
 def setup_japanese_font():
-    """日本語フォントの設定"""
+    """日本語フォントの設定（初回のみ登録。PDFはワーカースレッドで並行生成されるためロックする）"""
+    global _FONT_NAME
+    with _FONT_LOCK:
+        if _FONT_NAME is None:
+            _FONT_NAME = _register_japanese_font()
+        return _FONT_NAME
+
+
+def _register_japanese_font():
     font_name = 'Helvetica'
     try:
         # Windows環境: MS ゴシック
@@ -68,6 +84,14 @@ def setup_japanese_font():
     return font_name
 
 
+def load_sales_invoice_pdf_data(invoice: SalesInvoice, db: Session) -> Tuple[List[SalesInvoiceDetail], MasterData]:
+    """PDFに必要なDBデータを取得（明細・マスタキャッシュ）"""
+    details = db.query(SalesInvoiceDetail).filter(
+        SalesInvoiceDetail.sales_invoice_id == invoice.id
+    ).all()
+    return details, get_master_data(db)
+
+
 def generate_sales_invoice_pdf(invoice: SalesInvoice, db: Session) -> BytesIO:
     """販売員請求書PDF生成（販売員請求書鏡テンプレート準拠）
     
@@ -78,18 +102,15 @@ def generate_sales_invoice_pdf(invoice: SalesInvoice, db: Session) -> BytesIO:
     Returns:
         BytesIO: PDF データ
     """
-    # データ取得
-    sales_person = db.query(SalesPerson).filter(
-        SalesPerson.id == invoice.sales_person_id
-    ).first()
-    
-    discount_rate = db.query(DiscountRate).filter(
-        DiscountRate.id == invoice.discount_rate_id
-    ).first()
-    
-    details = db.query(SalesInvoiceDetail).filter(
-        SalesInvoiceDetail.sales_invoice_id == invoice.id
-    ).all()
+    details, masters = load_sales_invoice_pdf_data(invoice, db)
+    return render_sales_invoice_pdf(invoice, details, masters)
+
+
+def render_sales_invoice_pdf(invoice: SalesInvoice, details: List[SalesInvoiceDetail], masters: MasterData) -> BytesIO:
+    """取得済みデータからPDFを描画（DBにアクセスしないのでワーカースレッドで実行できる）"""
+    # 販売員・割引率・商品はマスタキャッシュから
+    sales_person = masters.sales_persons.get(invoice.sales_person_id)
+    discount_rate = masters.discount_rates.get(invoice.discount_rate_id)
     
     # PDF生成
     buffer = BytesIO()
@@ -238,18 +259,8 @@ def generate_sales_invoice_pdf(invoice: SalesInvoice, db: Session) -> BytesIO:
     
     # 割引率の取得
     # rateが1以上ならパーセント値（例：20=20%）、1未満なら小数値（例：0.20=20%）として扱う
-    raw_rate = float(discount_rate.rate) if discount_rate else 0
-    print(f"[DEBUG PDF] raw_rate from DB: {raw_rate}, type: {type(discount_rate.rate) if discount_rate else None}")
-    if raw_rate >= 1:
-        # パーセント値として保存されている場合（例：20 = 20%）
-        discount_rate_percent = raw_rate
-        discount_rate_decimal = raw_rate / 100
-        print(f"[DEBUG PDF] Using as percent value: percent={discount_rate_percent}, decimal={discount_rate_decimal}")
-    else:
-        # 小数値として保存されている場合（例：0.20 = 20%）
-        discount_rate_percent = raw_rate * 100
-        discount_rate_decimal = raw_rate
-        print(f"[DEBUG PDF] Using as decimal value: percent={discount_rate_percent}, decimal={discount_rate_decimal}")
+    discount_rate_bp = rate_to_basis_points(discount_rate.rate) if discount_rate else 0
+    discount_rate_percent = basis_points_to_percent(discount_rate_bp)
     
     # 明細データ
     row_height = 6*mm
@@ -257,7 +268,7 @@ def generate_sales_invoice_pdf(invoice: SalesInvoice, db: Session) -> BytesIO:
     
     for detail in details:
         y -= row_height
-        product = db.query(Product).filter(Product.id == detail.product_id).first()
+        product = masters.products.get(detail.product_id)
         
         # 行の描画
         pdf.rect(table_left, y, table_width, row_height, stroke=1, fill=0)
@@ -296,7 +307,7 @@ def generate_sales_invoice_pdf(invoice: SalesInvoice, db: Session) -> BytesIO:
         else:
             # 割引適用
             item_discount_rate = discount_rate_percent
-            item_discount_amount = int(amount * discount_rate_decimal)
+            item_discount_amount = apply_rate(amount, discount_rate_bp)
             item_after_discount = amount - item_discount_amount
             pdf.drawCentredString(col_positions[4] + col_widths[4] / 2, row_text_y, f"{item_discount_rate:.0f}%")
             pdf.drawRightString(col_positions[5] + col_widths[5] - 1*mm, row_text_y, f"¥{item_discount_amount:,}")
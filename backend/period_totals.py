@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""納品書明細の締め期間別集計（ロールアップ）
+
+delivery_note_period_totals に (販売員, 締め日, 商品, 単価) ごとの数量・金額の合計を保持する。
+納品書の作成・更新・削除と同じトランザクションで差分を反映し、
+請求書生成は明細全件ではなくこの集計行を読む。
+"""
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import DeliveryNote, DeliveryNoteDetail, DeliveryNotePeriodTotal, Product
+
+# ON CONFLICT DO UPDATE に対応した方言ごとの insert（SQLite は開発・ローカル用）
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+# 締め日（毎月20日締め、21日〜翌月20日）
+CLOSING_DAY = 20
+
+# (sales_person_id, period_end, product_id, unit_price) -> [quantity, amount]
+PeriodTotalDeltas = Dict[Tuple[int, date, int, int], List[int]]
+
+
+def period_end_for(delivery_date) -> date:
+    """Closing date (20th) of the billing period a delivery date belongs to"""
+    if isinstance(delivery_date, datetime):
+        delivery_date = delivery_date.date()
+    if delivery_date.day <= CLOSING_DAY:
+        return delivery_date.replace(day=CLOSING_DAY)
+    if delivery_date.month == 12:
+        return delivery_date.replace(year=delivery_date.year + 1, month=1, day=CLOSING_DAY)
+    return delivery_date.replace(month=delivery_date.month + 1, day=CLOSING_DAY)
+
+
+def is_standard_period(start_date: date, end_date: date) -> bool:
+    """True when [start_date, end_date] is exactly one 21st-to-20th billing period"""
+    if end_date.day != CLOSING_DAY:
+        return False
+    return start_date == period_end_for(end_date - timedelta(days=40)) + timedelta(days=1)
+
+
+def delivery_date_in_period(start_date: date, end_date: date) -> list:
+    """Filter for notes delivered from start_date through the whole of end_date
+
+    delivery_date is a TIMESTAMP: `<= end_date` would stop at 00:00 on the
+    closing day, while the rollup (period_end_for) counts the entire day.
+    """
+    return [
+        DeliveryNote.delivery_date >= start_date,
+        DeliveryNote.delivery_date < end_date + timedelta(days=1)
+    ]
+
+
+def add_delivery_note_deltas(
+    deltas: PeriodTotalDeltas,
+    sales_person_id: int,
+    delivery_date,
+    details: Iterable,
+    sign: int = 1
+) -> PeriodTotalDeltas:
+    """Accumulate the contribution of one delivery note's details into `deltas`
+
+    Use sign=1 for rows being added and sign=-1 for rows being removed.
+    `details` items need product_id, unit_price and quantity attributes.
+    """
+    if sales_person_id is None or delivery_date is None:
+        return deltas
+    period_end = period_end_for(delivery_date)
+    for detail in details:
+        if detail.product_id is None:
+            continue
+        key = (sales_person_id, period_end, detail.product_id, detail.unit_price)
+        totals = deltas.setdefault(key, [0, 0])
+        totals[0] += sign * detail.quantity
+        totals[1] += sign * detail.quantity * detail.unit_price
+    return deltas
+
+
+def apply_period_total_deltas(deltas: PeriodTotalDeltas, db: Session) -> None:
+    """Apply accumulated deltas with one upsert; does not commit
+
+    Keys whose totals drop to zero are removed.
+    """
+    rows = [
+        dict(
+            sales_person_id=sales_person_id,
+            period_end=period_end,
+            product_id=product_id,
+            unit_price=unit_price,
+            total_quantity=quantity,
+            total_amount=amount
+        )
+        for (sales_person_id, period_end, product_id, unit_price), (quantity, amount) in deltas.items()
+        if quantity or amount
+    ]
+    if not rows:
+        return
+
+    dialect = db.get_bind().dialect.name
+    insert = _UPSERT_INSERTS.get(dialect)
+    if insert is None:
+        raise RuntimeError(f"Period totals upsert is not supported on {dialect}")
+    stmt = insert(DeliveryNotePeriodTotal).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["sales_person_id", "period_end", "product_id", "unit_price"],
+        set_={
+            "total_quantity": DeliveryNotePeriodTotal.total_quantity + stmt.excluded.total_quantity,
+            "total_amount": DeliveryNotePeriodTotal.total_amount + stmt.excluded.total_amount,
+            "updated_at": func.now()
+        }
+    )
+    db.execute(stmt)
+
+    # Only removals can bring a key down to zero
+    shrinking = [row for row in rows if row["total_quantity"] < 0 or row["total_amount"] < 0]
+    if not shrinking:
+        return
+    db.query(DeliveryNotePeriodTotal).filter(
+        or_(*[
+            and_(
+                DeliveryNotePeriodTotal.sales_person_id == row["sales_person_id"],
+                DeliveryNotePeriodTotal.period_end == row["period_end"],
+                DeliveryNotePeriodTotal.product_id == row["product_id"],
+                DeliveryNotePeriodTotal.unit_price == row["unit_price"]
+            )
+            for row in shrinking
+        ]),
+        DeliveryNotePeriodTotal.total_quantity == 0,
+        DeliveryNotePeriodTotal.total_amount == 0
+    ).delete(synchronize_session=False)
+
+
+def rebuild_period_totals(db: Session, period_end: Optional[date] = None) -> int:
+    """Recompute the rollup from delivery_note_details; commits
+
+    Rebuilds every period, or only the period closing on `period_end`.
+    Returns the number of rollup rows written.
+    """
+    delete_query = db.query(DeliveryNotePeriodTotal)
+    notes_filter = []
+    if period_end is not None:
+        delete_query = delete_query.filter(DeliveryNotePeriodTotal.period_end == period_end)
+        period_start = period_end_for(period_end - timedelta(days=40)) + timedelta(days=1)
+        notes_filter = delivery_date_in_period(period_start, period_end)
+
+    try:
+        delete_query.delete(synchronize_session=False)
+
+        rows = db.query(
+            DeliveryNote.sales_person_id,
+            DeliveryNote.delivery_date,
+            DeliveryNoteDetail.product_id,
+            DeliveryNoteDetail.unit_price,
+            func.sum(DeliveryNoteDetail.quantity).label('quantity')
+        ).join(
+            DeliveryNoteDetail, DeliveryNoteDetail.delivery_note_id == DeliveryNote.id
+        ).filter(
+            DeliveryNote.sales_person_id.isnot(None),
+            DeliveryNoteDetail.product_id.isnot(None),
+            *notes_filter
+        ).group_by(
+            DeliveryNote.sales_person_id,
+            DeliveryNote.delivery_date,
+            DeliveryNoteDetail.product_id,
+            DeliveryNoteDetail.unit_price
+        ).all()
+
+        deltas: PeriodTotalDeltas = {}
+        for row in rows:
+            add_delivery_note_deltas(deltas, row.sales_person_id, row.delivery_date, [row])
+        apply_period_total_deltas(deltas, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return len(deltas)
+
+
+def load_period_totals(
+    sales_person_ids: List[int],
+    period_end: date,
+    db: Session
+) -> list:
+    """Rollup rows of one period joined with the product name and quota flag"""
+    return db.query(
+        DeliveryNotePeriodTotal.sales_person_id,
+        DeliveryNotePeriodTotal.product_id,
+        Product.name.label('product_name'),
+        Product.quota_target_flag,
+        DeliveryNotePeriodTotal.unit_price,
+        DeliveryNotePeriodTotal.total_quantity
+    ).join(
+        Product, DeliveryNotePeriodTotal.product_id == Product.id
+    ).filter(
+        DeliveryNotePeriodTotal.sales_person_id.in_(sales_person_ids),
+        DeliveryNotePeriodTotal.period_end == period_end
+    ).order_by(
+        DeliveryNotePeriodTotal.sales_person_id,
+        DeliveryNotePeriodTotal.product_id,
+        DeliveryNotePeriodTotal.unit_price
+    ).all()
+
+
+def sales_persons_with_notes(
+    sales_person_ids: List[int],
+    start_date: date,
+    end_date: date,
+    db: Session
+) -> List[int]:
+    """Sales persons having at least one delivery note in the period"""
+    rows = db.execute(
+        select(DeliveryNote.sales_person_id).where(
+            DeliveryNote.sales_person_id.in_(sales_person_ids),
+            *delivery_date_in_period(start_date, end_date)
+        ).distinct()
+    ).all()
+    return [row.sales_person_id for row in rows]
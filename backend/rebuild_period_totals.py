@@ -0,0 +1,38 @@
+"""締め期間別集計（delivery_note_period_totals）の再構築スクリプト
+
+使い方:
+    python rebuild_period_totals.py               # 全期間を再構築
+    python rebuild_period_totals.py 2026-01-20    # 指定した締め日の期間のみ再構築
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from datetime import date
+
+from database import SessionLocal
+from period_totals import CLOSING_DAY, rebuild_period_totals
+
+
+def main():
+    period_end = None
+    if len(sys.argv) > 1:
+        period_end = date.fromisoformat(sys.argv[1])
+        if period_end.day != CLOSING_DAY:
+            print(f"締め日は{CLOSING_DAY}日を指定してください: {period_end}")
+            sys.exit(1)
+
+    db = SessionLocal()
+    try:
+        count = rebuild_period_totals(db, period_end)
+        target = f"締め日 {period_end}" if period_end else "全期間"
+        print(f"{target}の集計を再構築しました（{count}行）")
+    except Exception as e:
+        print(f"エラーが発生しました: {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""納品書画像の認識結果キャッシュ
+
+同じ写真の再アップロード（応答が遅いときの再送、スマホとPCの両方から等）で
+Gemini を呼び直さないよう、成功した認識結果を
+SHA-256(画像) + マスタの内容ハッシュ + プロンプト版 + モデル名 をキーに保存する。
+マスタやプロンプトが変わればキーが変わるので、古い結果は使われない。
+
+- プロセス内: LRU（件数上限）＋ TTL
+- DB: recognition_cache_entries（再起動後・他ワーカーでもヒットする）。TTL を過ぎた行は保存時に削除
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from models import RecognitionCacheEntry
+
+# DBから期限切れの行を削除する間隔（保存何回ごとか）
+_PRUNE_EVERY = 50
+
+
+def recognition_cache_key(image_bytes: bytes, master_fingerprint: str, prompt_version: str, model_name: str) -> str:
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    return hashlib.sha256(
+        f"{image_hash}:{master_fingerprint}:{prompt_version}:{model_name}".encode("utf-8")
+    ).hexdigest()
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class _LRUCache:
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, result = entry
+            if time.monotonic() - stored_at > self._ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    def put(self, key: str, result: dict, stored_at: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (stored_at if stored_at is not None else time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+_MEMORY = _LRUCache(settings.RECOGNITION_CACHE_MAX_ENTRIES, settings.RECOGNITION_CACHE_TTL_SECONDS)
+_stores = 0
+
+
+async def get_cached_recognition(db: AsyncSession, cache_key: str) -> Optional[dict]:
+    """Cached recognition_result for the key, from memory or the DB"""
+    result = _MEMORY.get(cache_key)
+    if result is not None:
+        return result
+
+    entry = await db.get(RecognitionCacheEntry, cache_key)
+    if entry is None:
+        return None
+    # store_recognition が同じキーで新しい行を add できるようセッションから外す
+    db.expunge(entry)
+    age = (_utcnow() - entry.created_at).total_seconds()
+    if age > settings.RECOGNITION_CACHE_TTL_SECONDS:
+        return None
+    # 残りの寿命をDBの行に合わせる
+    _MEMORY.put(cache_key, entry.result, time.monotonic() - age)
+    return entry.result
+
+
+async def store_recognition(db: AsyncSession, cache_key: str, result: dict) -> None:
+    """Remember a successful recognition; commits `db`"""
+    global _stores
+    _MEMORY.put(cache_key, result)
+    try:
+        db.add(RecognitionCacheEntry(cache_key=cache_key, result=result, created_at=_utcnow()))
+        await db.commit()
+    except IntegrityError:
+        # 期限切れの行が残っている、または同じ画像を別のリクエストが先に保存した
+        await db.rollback()
+        await db.execute(
+            update(RecognitionCacheEntry)
+            .where(RecognitionCacheEntry.cache_key == cache_key)
+            .values(result=result, created_at=_utcnow())
+        )
+        await db.commit()
+
+    _stores += 1
+    if _stores % _PRUNE_EVERY == 1:
+        cutoff = _utcnow() - timedelta(seconds=settings.RECOGNITION_CACHE_TTL_SECONDS)
+        await db.execute(delete(RecognitionCacheEntry).where(RecognitionCacheEntry.created_at < cutoff))
+        await db.commit()
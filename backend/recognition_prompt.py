@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""納品書認識プロンプトの組み立て
+
+プロンプト = 固定の指示文（テンプレート） + マスタ一覧ブロック。
+マスタ一覧ブロックはマスタの内容（MasterData.fingerprint）ごとに一度だけ組み立てて
+プロセス内に保持する。
+
+- full: 従来どおり 「ID: 名前」 を1行ずつ並べる
+- compact: 入力トークンを減らす形式
+    * ID をマスタごとに 1 から振り直した短いID にする（応答は decode() で実IDに戻す）
+    * 「ハイシャンプー 300ml」「ハイシャンプー 500ml」のような同じ系列の商品をまとめる
+    * 有効な商品だけ（full も同じ）
+
+recognition_prompt_version() は形式ごとの版番号（PROMPT_FORMAT_VERSIONS）とテンプレートから決まる版ID。
+認識結果キャッシュのキーに使うので、指示文や一覧の形式を変えると古い結果は使われなくなる。
+"""
+import hashlib
+import re
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from config import settings
+from master_cache import MasterData
+
+PROMPT_MODES = ("full", "compact")
+
+# マスタ一覧ブロックの形式の版。_full_block / _compact_block（_compact_products, _FAMILY_PATTERNS）の
+# 出力を変えたら該当する形式の番号を上げる（テンプレートの変更は自動で版IDに反映される）
+PROMPT_FORMAT_VERSIONS = {
+    "full": 1,
+    "compact": 1,
+}
+
+_TEMPLATE = """
+納品書の画像を解析して、以下のJSON形式で情報を抽出してください。
+
+【重要】IDは必ず数字のみで返してください。名前ではなくIDの数字を使用すること。
+
+【マスタデータ】
+{master_block}
+
+【商品名の読み取りルール】
+- 「"」や省略記号は直前の商品名を継承
+- 「シャンプー」→「ハイシャンプー」
+- 「リンス」→「リンス＆ヘアパック」
+- 画像から読み取った商品名に最も近いマスタの商品を選択し、そのIDを使用
+
+【数値の読み取りルール】
+- 数量: 整数
+- 単価: 円単位
+- 金額の整合性チェック必須
+
+【出力JSON形式】
+必ず以下の形式のJSONのみを出力してください。説明文は不要です。
+{{
+  "success": true,
+  "salesPersonId": 1,
+  "deliveryDate": "2026-01-15",
+  "taxRateId": 1,
+  "details": [
+    {{
+      "productId": 1,
+      "quantity": 2,
+      "unitPrice": 1000
+    }}
+  ]
+}}
+
+【注意事項】
+- salesPersonId, taxRateId, productIdは必ず数字（整数）で返すこと
+- 文字列ではなく数値型で返すこと
+- 販売員が特定できない場合はsalesPersonIdをnullにする
+- 商品が特定できない場合はその明細を除外する
+- 失敗時は {{"success": false, "failureReason": "理由"}} を返す
+"""
+
+# 「系列名 バリエーション」「系列名（バリエーション）」
+_FAMILY_PATTERNS = (
+    re.compile(r"^(?P<family>\S.*?)[ 　]+(?P<variant>\S.*)$"),
+    re.compile(r"^(?P<family>.+?)[(（](?P<variant>[^()（）]+)[)）]$"),
+)
+
+
+class RecognitionPrompt(NamedTuple):
+    text: str
+    version: str
+    # compact のみ: 短いID（1始まりの位置）→ 実ID。full では None
+    sales_person_ids: Optional[Tuple[int, ...]] = None
+    product_ids: Optional[Tuple[int, ...]] = None
+    tax_rate_ids: Optional[Tuple[int, ...]] = None
+
+    def decode(self, result: dict) -> dict:
+        """Recognition result with the prompt's ids translated back to master ids
+
+        Unknown short ids become None so validation reports them.
+        """
+        if self.product_ids is None or not isinstance(result, dict) or not result.get("success"):
+            return result
+        decoded = dict(result)
+        decoded["salesPersonId"] = _real_id(self.sales_person_ids, result.get("salesPersonId"))
+        decoded["taxRateId"] = _real_id(self.tax_rate_ids, result.get("taxRateId"))
+        if isinstance(result.get("details"), list):
+            decoded["details"] = [
+                {**detail, "productId": _real_id(self.product_ids, detail.get("productId"))}
+                if isinstance(detail, dict) else detail
+                for detail in result["details"]
+            ]
+        return decoded
+
+
+def _real_id(ids: Tuple[int, ...], short_id) -> Optional[int]:
+    if short_id is None:
+        return None
+    if isinstance(short_id, int) and 1 <= short_id <= len(ids):
+        return ids[short_id - 1]
+    return None
+
+
+def _split_family(name: str) -> Tuple[str, Optional[str]]:
+    for pattern in _FAMILY_PATTERNS:
+        m = pattern.match(name)
+        if m:
+            return m.group("family"), m.group("variant")
+    return name, None
+
+
+# 出力を変えたら PROMPT_FORMAT_VERSIONS["full"] を上げる
+def _full_block(masters: MasterData) -> str:
+    sales_person_list = [f"{sp.id}: {sp.name}" for sp in masters.active_sales_persons]
+    product_list = [f"{p.id}: {p.name} (¥{p.price})" for p in masters.active_products]
+    tax_rate_list = [f"{tr.id}: {tr.display_name} ({tr.rate}%)" for tr in masters.active_tax_rates]
+    return f"""販売員一覧（ID: 名前の形式）:
+{chr(10).join(sales_person_list)}
+
+商品一覧（ID: 商品名 (価格)の形式）:
+{chr(10).join(product_list)}
+
+税率一覧（ID: 表示名 (税率%)の形式）:
+{chr(10).join(tax_rate_list)}"""
+
+
+def _compact_products(products) -> str:
+    """Products grouped by family: `family: id=variant/price, ...`; singles as `id=name/price`"""
+    families: Dict[str, list] = {}
+    for short_id, product in enumerate(products, start=1):
+        family, variant = _split_family(product.name)
+        families.setdefault(family, []).append((short_id, product, variant))
+
+    lines = []
+    for family, members in families.items():
+        if len(members) == 1:
+            short_id, product, _ = members[0]
+            lines.append(f"{short_id}={product.name}/{product.price}")
+        else:
+            variants = ", ".join(
+                f"{short_id}={variant or '(無印)'}/{product.price}" for short_id, product, variant in members
+            )
+            lines.append(f"{family}: {variants}")
+    return "\n".join(lines)
+
+
+# 出力を変えたら PROMPT_FORMAT_VERSIONS["compact"] を上げる
+def _compact_block(masters: MasterData) -> str:
+    sales_persons = ", ".join(f"{i}={sp.name}" for i, sp in enumerate(masters.active_sales_persons, start=1))
+    tax_rates = ", ".join(
+        f"{i}={tr.display_name}" for i, tr in enumerate(masters.active_tax_rates, start=1)
+    )
+    return f"""販売員（ID=名前）: {sales_persons}
+税率（ID=表示名）: {tax_rates}
+商品（ID=商品名/価格円。「系列名: ID=種類/価格」は同じ系列の商品）:
+{_compact_products(masters.active_products)}"""
+
+
+_TEMPLATE_DIGEST = hashlib.sha256(_TEMPLATE.encode("utf-8")).hexdigest()[:12]
+
+
+def recognition_prompt_version(mode: Optional[str] = None) -> str:
+    """Version id of the prompt template and master block format, for recognition cache keys"""
+    mode = mode or settings.RECOGNITION_PROMPT_MODE
+    if mode not in PROMPT_FORMAT_VERSIONS:
+        raise ValueError(f"Unknown recognition prompt mode: {mode}")
+    return f"{mode}-v{PROMPT_FORMAT_VERSIONS[mode]}-{_TEMPLATE_DIGEST}"
+
+
+# (mode, MasterData.fingerprint) -> RecognitionPrompt。マスタが変わると fingerprint が変わる
+_PROMPTS: Dict[Tuple[str, str], RecognitionPrompt] = {}
+_PROMPTS_LOCK = threading.Lock()
+
+
+def build_recognition_prompt(masters: MasterData, mode: Optional[str] = None) -> RecognitionPrompt:
+    """Recognition prompt for the masters snapshot, built once per master version and mode"""
+    mode = mode or settings.RECOGNITION_PROMPT_MODE
+    if mode not in PROMPT_MODES:
+        raise ValueError(f"Unknown recognition prompt mode: {mode}")
+    key = (mode, masters.fingerprint)
+    prompt = _PROMPTS.get(key)
+    if prompt is not None:
+        return prompt
+
+    if mode == "compact":
+        prompt = RecognitionPrompt(
+            _TEMPLATE.format(master_block=_compact_block(masters)),
+            recognition_prompt_version(mode),
+            tuple(sp.id for sp in masters.active_sales_persons),
+            tuple(p.id for p in masters.active_products),
+            tuple(tr.id for tr in masters.active_tax_rates),
+        )
+    else:
+        prompt = RecognitionPrompt(_TEMPLATE.format(master_block=_full_block(masters)), recognition_prompt_version(mode))
+
+    with _PROMPTS_LOCK:
+        # 古いマスタのプロンプトは捨てる
+        for stale in [k for k in _PROMPTS if k[0] == mode]:
+            del _PROMPTS[stale]
+        _PROMPTS[key] = prompt
+    return prompt
@@ -1,8 +1,9 @@
 from datetime import timedelta
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 import auth
 from models import User
 import config
@@ -19,8 +20,8 @@ class TokenRefresh(BaseModel):
     refresh_token: str
 
 @router.post("/login", response_model=Token)
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await auth.authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -35,7 +36,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 @router.post("/refresh", response_model=Token)
-async def refresh_token(token_data: TokenRefresh, db: Session = Depends(get_db)):
+async def refresh_token(token_data: TokenRefresh, db: AsyncSession = Depends(get_async_db)):
     username = auth.verify_token(token_data.refresh_token)
     if username is None:
         raise HTTPException(
@@ -43,7 +44,7 @@ async def refresh_token(token_data: TokenRefresh, db: Session = Depends(get_db))
             detail="Invalid refresh token",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    user = db.query(User).filter(User.username == username).first()
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
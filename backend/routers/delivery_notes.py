@@ -1,21 +1,33 @@
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
-from sqlalchemy.orm import Session
-from database import get_db
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from database import AsyncSessionLocal, get_async_db
 from models import DeliveryNote, DeliveryNoteDetail
 from dependencies import get_current_user
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Callable, List, Optional
 from datetime import date
+import asyncio
 import shutil
+import time
 import os
-import base64
 import json
 import traceback
 import re
 from pathlib import Path
 from config import settings
-from genai_wrapper import configure as genai_configure, generate_content_with_image, set_api_keys
-import os
+from genai_wrapper import generate_content_with_image_async, healthy_key_count, set_api_keys
+from period_totals import add_delivery_note_deltas, apply_period_total_deltas
+from master_cache import MasterData, get_master_data
+from executors import run_cpu, run_io
+from image_preprocessing import preprocess_image
+from image_quality import (
+    QUALITY_ISSUE_MESSAGES, assess_image_quality, quality_failure_reason, recent_image_hashes
+)
+from recognition_cache import get_cached_recognition, recognition_cache_key, store_recognition
+from recognition_prompt import build_recognition_prompt, recognition_prompt_version
 
 router = APIRouter(prefix="/delivery-notes", tags=["delivery notes"])
 
@@ -26,94 +38,78 @@ if _api_keys:
     for i, key in enumerate(_api_keys):
         print(f"[DEBUG] API Key {i+1}: ...{key[-8:] if len(key) >= 8 else '***'}")
     set_api_keys(_api_keys)
-    # Configure with first key initially
-    genai_configure(_api_keys[0])
 else:
     print(f"[WARNING] No Gemini API keys found in environment")
     
+# 認識の進捗を受け取るコールバック: on_stage(stage, **data)
+StageCallback = Callable[..., None]
+
 MODEL_NAME = 'gemini-2.5-flash'  # 費用対効果と高スループット向けに最適化
 
-def recognize_delivery_note_image(image_path: str, db: Session) -> dict:
-    """Gemini APIを使って納品書画像を認識する"""
-    print(f"Starting recognition for image: {image_path}")
+def _ignore_stage(stage: str, **data):
+    pass
+
+def _parse_recognition_text(result_text: str) -> dict:
+    """Recognition JSON from the model output (code fences and surrounding text are tolerated)"""
+    # remove triple-backtick fences if present
+    if result_text.startswith('```') and '```' in result_text[3:]:
+        # remove leading fence
+        idx = result_text.find('\n')
+        if idx != -1:
+            result_text = result_text[idx+1:]
+        # remove trailing fence if present
+        if result_text.endswith('```'):
+            result_text = result_text[:-3]
+
+    # try direct JSON parse first
+    try:
+        result = json.loads(result_text)
+        print(f"Parsed result (direct JSON): {type(result)}")
+        if isinstance(result, dict):
+            return result
+    except Exception:
+        # try to extract JSON object using regex (first { ... } block)
+        try:
+            m = re.search(r"\{[\s\S]*\}", result_text)
+            if m:
+                json_text = m.group(0)
+                result = json.loads(json_text)
+                print("Parsed result (extracted JSON block)")
+                return result
+        except Exception as e_json:
+            print(f"JSON extraction failed: {e_json}")
+
+    # 最後の手段: そのまま文字列をエラー情報として返す
+    return {
+        "success": False,
+        "failureReason": "認識結果のパースに失敗しました",
+        "raw_response": result_text[:2000]
+    }
+
+async def recognize_delivery_note_image(image_data: bytes, masters: MasterData,
+                                        on_stage: StageCallback = _ignore_stage,
+                                        mime_type: str = "image/jpeg",
+                                        preprocessing: Optional[dict] = None) -> dict:
+    """Gemini APIを使って納品書画像を認識する
+
+    on_stage(stage, **data) is called as the call progresses
+    (key_selected, rate_limited, model_responded, parsed). `preprocessing`
+    (PreparedImage.summary()) is written to the diagnostics file.
+    """
+    print(f"Starting recognition for image: {len(image_data)} bytes ({mime_type})")
     
     try:
-        # マスタデータを取得
-        from models import SalesPerson, Product, TaxRate
-        
-        sales_persons = db.query(SalesPerson).filter(SalesPerson.deleted_flag == False).all()
-        products = db.query(Product).filter(Product.deleted_flag == False).all()
-        tax_rates = db.query(TaxRate).filter(TaxRate.deleted_flag == False).all()
+        # マスタ一覧を含むプロンプト（マスタの版ごとに組み立て済みのものを再利用）
+        prompt = build_recognition_prompt(masters)
         
-        print(f"Loaded {len(sales_persons)} sales persons, {len(products)} products, {len(tax_rates)} tax rates")
-        
-        # マスタデータをプロンプト用に整形
-        sales_person_list = [f"{sp.id}: {sp.name}" for sp in sales_persons]
-        product_list = [f"{p.id}: {p.name} (¥{p.price})" for p in products]
-        tax_rate_list = [f"{tr.id}: {tr.display_name} ({tr.rate}%)" for tr in tax_rates]
-        
-        # 画像をBase64エンコード
-        with open(image_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        print(f"Image encoded, size: {len(image_data)} chars")
-        
-        # Gemini APIプロンプト
-        prompt = f"""
-納品書の画像を解析して、以下のJSON形式で情報を抽出してください。
-
-【重要】IDは必ず数字のみで返してください。名前ではなくIDの数字を使用すること。
-
-【マスタデータ】
-販売員一覧（ID: 名前の形式）:
-{chr(10).join(sales_person_list)}
-
-商品一覧（ID: 商品名 (価格)の形式）:
-{chr(10).join(product_list)}
-
-税率一覧（ID: 表示名 (税率%)の形式）:
-{chr(10).join(tax_rate_list)}
-
-【商品名の読み取りルール】
-- 「"」や省略記号は直前の商品名を継承
-- 「シャンプー」→「ハイシャンプー」
-- 「リンス」→「リンス＆ヘアパック」
-- 画像から読み取った商品名に最も近いマスタの商品を選択し、そのIDを使用
-
-【数値の読み取りルール】
-- 数量: 整数
-- 単価: 円単位
-- 金額の整合性チェック必須
-
-【出力JSON形式】
-必ず以下の形式のJSONのみを出力してください。説明文は不要です。
-{{
-  "success": true,
-  "salesPersonId": 1,
-  "deliveryDate": "2026-01-15",
-  "taxRateId": 1,
-  "details": [
-    {{
-      "productId": 1,
-      "quantity": 2,
-      "unitPrice": 1000
-    }}
-  ]
-}}
-
-【注意事項】
-- salesPersonId, taxRateId, productIdは必ず数字（整数）で返すこと
-- 文字列ではなく数値型で返すこと
-- 販売員が特定できない場合はsalesPersonIdをnullにする
-- 商品が特定できない場合はその明細を除外する
-- 失敗時は {{"success": false, "failureReason": "理由"}} を返す
-"""
-        
-        print(f"Prompt length: {len(prompt)} chars")
+        print(f"Prompt length: {len(prompt.text)} chars ({prompt.version})")
         
         # Gemini / GenAI API呼び出し（wrapper経由）
         try:
-            response = generate_content_with_image(MODEL_NAME, prompt, image_data)
+            call_started = time.monotonic()
+            response = await generate_content_with_image_async(
+                MODEL_NAME, prompt.text, image_data, mime_type=mime_type, on_event=on_stage
+            )
             print("GenAI API call completed")
 
             # レスポンスを抽出
@@ -124,12 +120,16 @@ def recognize_delivery_note_image(image_path: str, db: Session) -> dict:
 
             result_text = str(result_text).strip()
             print(f"Raw response (preview): {result_text[:400]}...")
+            on_stage(
+                "model_responded",
+                chars=len(result_text),
+                elapsed_ms=int((time.monotonic() - call_started) * 1000)
+            )
 
             # 保存（診断用）
             try:
                 diag_dir = Path("uploads") / "genai_diagnostics"
                 diag_dir.mkdir(parents=True, exist_ok=True)
-                import time
                 ts = int(time.time())
                 diag_path = diag_dir / f"resp_{ts}.txt"
                 with open(diag_path, "w", encoding="utf-8") as f:
@@ -137,43 +137,17 @@ def recognize_delivery_note_image(image_path: str, db: Session) -> dict:
                     f.write(repr(response) + "\n\n")
                     f.write("=== text ===\n")
                     f.write(result_text + "\n")
+                    if preprocessing:
+                        f.write("\n=== preprocessing ===\n")
+                        f.write(json.dumps(preprocessing, ensure_ascii=False) + "\n")
                 print(f"Saved GenAI raw response to {diag_path}")
             except Exception as e:
                 print(f"Failed to save diagnostic response: {e}")
 
-            # remove triple-backtick fences if present
-            if result_text.startswith('```') and '```' in result_text[3:]:
-                # remove leading fence
-                idx = result_text.find('\n')
-                if idx != -1:
-                    result_text = result_text[idx+1:]
-                # remove trailing fence if present
-                if result_text.endswith('```'):
-                    result_text = result_text[:-3]
-
-            # try direct JSON parse first
-            try:
-                result = json.loads(result_text)
-                print(f"Parsed result (direct JSON): {type(result)}")
-                return result
-            except Exception:
-                # try to extract JSON object using regex (first { ... } block)
-                try:
-                    m = re.search(r"\{[\s\S]*\}", result_text)
-                    if m:
-                        json_text = m.group(0)
-                        result = json.loads(json_text)
-                        print("Parsed result (extracted JSON block)")
-                        return result
-                except Exception as e_json:
-                    print(f"JSON extraction failed: {e_json}")
-
-            # 最後の手段: そのまま文字列をエラー情報として返す
-            return {
-                "success": False,
-                "failureReason": "認識結果のパースに失敗しました",
-                "raw_response": result_text[:2000]
-            }
+            # compact 形式の短いIDをマスタのIDに戻す
+            result = prompt.decode(_parse_recognition_text(result_text))
+            on_stage("parsed", success=bool(result.get("success")))
+            return result
 
         except Exception as e:
             tb = traceback.format_exc()
@@ -182,7 +156,6 @@ def recognize_delivery_note_image(image_path: str, db: Session) -> dict:
             try:
                 diag_dir = Path("uploads") / "genai_diagnostics"
                 diag_dir.mkdir(parents=True, exist_ok=True)
-                import time
                 ts = int(time.time())
                 err_path = diag_dir / f"error_{ts}.txt"
                 with open(err_path, "w", encoding="utf-8") as f:
@@ -238,14 +211,52 @@ class DeliveryNoteResponse(DeliveryNoteBase):
     class Config:
         from_attributes = True
 
+async def _stored_detail_quantities(delivery_note_id: int, db: AsyncSession):
+    """Stored detail lines as plain rows (keeps DeliveryNote.details unloaded)"""
+    return (await db.execute(
+        select(
+            DeliveryNoteDetail.product_id,
+            DeliveryNoteDetail.unit_price,
+            DeliveryNoteDetail.quantity
+        ).where(DeliveryNoteDetail.delivery_note_id == delivery_note_id)
+    )).all()
+
+async def _lock_delivery_note(delivery_note_id: int, db: AsyncSession):
+    """DeliveryNote row locked until commit (FOR UPDATE)
+
+    Concurrent PUT/DELETE of the same note wait here, so each one subtracts
+    the details that are actually stored instead of the same old ones twice.
+    """
+    return (await db.execute(
+        select(DeliveryNote)
+        .where(DeliveryNote.id == delivery_note_id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )).scalar_one_or_none()
+
+async def _apply_period_total_deltas(deltas, db: AsyncSession):
+    """Run the synchronous rollup upsert on the async session's connection"""
+    await db.run_sync(lambda session: apply_period_total_deltas(deltas, session))
+
+async def _load_delivery_note(delivery_note_id: int, db: AsyncSession):
+    """DeliveryNote with details loaded (lazy loading is not available on AsyncSession)"""
+    return (await db.execute(
+        select(DeliveryNote)
+        .options(selectinload(DeliveryNote.details))
+        .where(DeliveryNote.id == delivery_note_id)
+        .execution_options(populate_existing=True)
+    )).scalars().first()
+
 # Delivery Note endpoints
 @router.get("/", response_model=List[DeliveryNoteResponse])
-async def get_delivery_notes(db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    delivery_notes = db.query(DeliveryNote).all()
+async def get_delivery_notes(db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    delivery_notes = (await db.execute(
+        select(DeliveryNote).options(selectinload(DeliveryNote.details))
+    )).scalars().all()
     return delivery_notes
 
 @router.post("/", response_model=DeliveryNoteResponse)
-async def create_delivery_note(delivery_note: DeliveryNoteCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+async def create_delivery_note(delivery_note: DeliveryNoteCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
     # Create delivery note
     db_delivery_note = DeliveryNote(
         sales_person_id=delivery_note.sales_person_id,
@@ -256,8 +267,8 @@ async def create_delivery_note(delivery_note: DeliveryNoteCreate, db: Session =
         remarks=delivery_note.remarks
     )
     db.add(db_delivery_note)
-    db.commit()
-    db.refresh(db_delivery_note)
+    await db.commit()
+    await db.refresh(db_delivery_note)
 
     # Create delivery note details
     for detail in delivery_note.details:
@@ -271,31 +282,41 @@ async def create_delivery_note(delivery_note: DeliveryNoteCreate, db: Session =
             remarks=detail.remarks
         )
         db.add(db_detail)
-    db.commit()
 
-    # Refresh to get details
-    db.refresh(db_delivery_note)
-    return db_delivery_note
+    # 締め期間別集計に反映（明細と同じトランザクション）
+    await _apply_period_total_deltas(add_delivery_note_deltas(
+        {}, delivery_note.sales_person_id, delivery_note.delivery_date, delivery_note.details
+    ), db)
+    await db.commit()
+
+    # Reload to get details
+    return await _load_delivery_note(db_delivery_note.id, db)
 
 @router.get("/{delivery_note_id}", response_model=DeliveryNoteResponse)
-async def get_delivery_note(delivery_note_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    delivery_note = db.query(DeliveryNote).filter(DeliveryNote.id == delivery_note_id).first()
+async def get_delivery_note(delivery_note_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    delivery_note = await _load_delivery_note(delivery_note_id, db)
     if delivery_note is None:
         raise HTTPException(status_code=404, detail="Delivery note not found")
     return delivery_note
 
 @router.put("/{delivery_note_id}", response_model=DeliveryNoteResponse)
-async def update_delivery_note(delivery_note_id: int, delivery_note: DeliveryNoteCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_delivery_note = db.query(DeliveryNote).filter(DeliveryNote.id == delivery_note_id).first()
+async def update_delivery_note(delivery_note_id: int, delivery_note: DeliveryNoteCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_delivery_note = await _lock_delivery_note(delivery_note_id, db)
     if db_delivery_note is None:
         raise HTTPException(status_code=404, detail="Delivery note not found")
 
+    # 更新前の明細を締め期間別集計から差し引く
+    deltas = add_delivery_note_deltas(
+        {}, db_delivery_note.sales_person_id, db_delivery_note.delivery_date,
+        await _stored_detail_quantities(delivery_note_id, db), sign=-1
+    )
+
     # Update delivery note
     for key, value in delivery_note.dict(exclude={'details'}).items():
         setattr(db_delivery_note, key, value)
 
     # Delete existing details
-    db.query(DeliveryNoteDetail).filter(DeliveryNoteDetail.delivery_note_id == delivery_note_id).delete()
+    await db.execute(delete(DeliveryNoteDetail).where(DeliveryNoteDetail.delivery_note_id == delivery_note_id))
 
     # Create new details
     for detail in delivery_note.details:
@@ -310,68 +331,344 @@ async def update_delivery_note(delivery_note_id: int, delivery_note: DeliveryNot
         )
         db.add(db_detail)
 
-    db.commit()
-    db.refresh(db_delivery_note)
-    return db_delivery_note
+    add_delivery_note_deltas(deltas, delivery_note.sales_person_id, delivery_note.delivery_date, delivery_note.details)
+    await _apply_period_total_deltas(deltas, db)
+
+    await db.commit()
+    return await _load_delivery_note(delivery_note_id, db)
 
 @router.delete("/{delivery_note_id}")
-async def delete_delivery_note(delivery_note_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_delivery_note = db.query(DeliveryNote).filter(DeliveryNote.id == delivery_note_id).first()
+async def delete_delivery_note(delivery_note_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_delivery_note = await _lock_delivery_note(delivery_note_id, db)
     if db_delivery_note is None:
         raise HTTPException(status_code=404, detail="Delivery note not found")
     
+    # 締め期間別集計から差し引く
+    await _apply_period_total_deltas(add_delivery_note_deltas(
+        {}, db_delivery_note.sales_person_id, db_delivery_note.delivery_date,
+        await _stored_detail_quantities(delivery_note_id, db), sign=-1
+    ), db)
+    
     # Delete all details first with synchronize_session
-    db.query(DeliveryNoteDetail).filter(
-        DeliveryNoteDetail.delivery_note_id == delivery_note_id
-    ).delete(synchronize_session=False)
+    await db.execute(
+        delete(DeliveryNoteDetail).where(
+            DeliveryNoteDetail.delivery_note_id == delivery_note_id
+        ).execution_options(synchronize_session=False)
+    )
     
     # Delete the delivery note
-    db.delete(db_delivery_note)
-    db.commit()
+    await db.delete(db_delivery_note)
+    await db.commit()
     return {"message": "Delivery note deleted"}
 
 # Image upload and recognition
+def _save_upload(file: UploadFile, file_path: str):
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+
+def _upload_path(filename: str) -> str:
+    upload_dir = "uploads"
+    os.makedirs(upload_dir, exist_ok=True)
+    return os.path.join(upload_dir, filename)
+
+def _validate_recognition(result: dict, masters: MasterData) -> List[str]:
+    """IDs in a recognition result that do not match an active master (empty when valid)"""
+    issues = []
+    sales_person_ids = {sp.id for sp in masters.active_sales_persons}
+    product_ids = {p.id for p in masters.active_products}
+    tax_rate_ids = {tr.id for tr in masters.active_tax_rates}
+    if result.get("salesPersonId") is not None and result["salesPersonId"] not in sales_person_ids:
+        issues.append(f"販売員ID {result['salesPersonId']} がマスタにありません")
+    if result.get("taxRateId") is not None and result["taxRateId"] not in tax_rate_ids:
+        issues.append(f"税率ID {result['taxRateId']} がマスタにありません")
+    for i, detail in enumerate(result.get("details") or []):
+        if not isinstance(detail, dict):
+            issues.append(f"明細{i + 1}: 形式が不正です")
+            continue
+        if detail.get("productId") is None:
+            issues.append(f"明細{i + 1}: 商品が特定できません")
+        elif detail.get("productId") not in product_ids:
+            issues.append(f"明細{i + 1}: 商品ID {detail.get('productId')} がマスタにありません")
+        for field in ("quantity", "unitPrice"):
+            if not isinstance(detail.get(field), int):
+                issues.append(f"明細{i + 1}: {field} が整数ではありません")
+    return issues
+
+async def _check_image_quality(image_data: bytes, on_stage: StageCallback):
+    """(quality, warnings) from the local quality gate, or (None, []) when it is off or cannot run"""
+    if settings.IMAGE_QUALITY_GATE == "off":
+        return None, []
+    quality = await run_cpu(assess_image_quality, image_data)
+    if quality is None:
+        return None, []
+    duplicate = recent_image_hashes.find(quality.phash, settings.IMAGE_DUPLICATE_MAX_DISTANCE)
+    on_stage("quality_checked", **quality.summary(), duplicate_of=duplicate)
+
+    warnings = [QUALITY_ISSUE_MESSAGES[issue] for issue in quality.issues]
+    if duplicate:
+        warnings.append(f"直近に認識した画像（{duplicate['filename']}）とほぼ同じ写真です。二重登録に注意してください")
+    return quality, warnings
+
+async def _recognize_with_cache(image_data: bytes, masters: MasterData,
+                                on_stage: StageCallback = _ignore_stage, filename: Optional[str] = None):
+    """(recognition_result, cached) for one image
+
+    Cache lookups use their own short sessions so no DB connection is held
+    while waiting for Gemini (and so batch tasks can run concurrently).
+    """
+    # 同じ画像・マスタ・プロンプトの認識結果があれば再利用
+    cache_key = await run_cpu(
+        recognition_cache_key, image_data, masters.fingerprint, recognition_prompt_version(), MODEL_NAME
+    )
+    # キャッシュは最善努力: DBエラー（マイグレーション未適用を含む）でも認識は続ける
+    try:
+        async with AsyncSessionLocal() as cache_db:
+            recognition_result = await get_cached_recognition(cache_db, cache_key)
+    except Exception as e:
+        print(f"[WARN] Recognition cache lookup failed, recognizing without cache: {e}")
+        recognition_result = None
+    cached = recognition_result is not None
+    on_stage("cache_hit" if cached else "cache_miss")
+
+    if not cached:
+        # ぼやけ・露出不良・解像度不足の画像は Gemini を呼ばずに返す（数ミリ秒で判定）
+        quality, warnings = await _check_image_quality(image_data, on_stage)
+        if quality is not None and quality.issues and settings.IMAGE_QUALITY_GATE == "reject":
+            print(f"Rejected by quality gate: {quality.summary()}")
+            return {
+                "success": False,
+                "failureReason": quality_failure_reason(quality.issues),
+                "quality": quality.summary()
+            }, False
+
+        # 向き補正・縮小・グレースケール化・再圧縮してから送る（キャッシュキーは元画像のまま）
+        prepared = await run_cpu(preprocess_image, image_data)
+        preprocessing = prepared.summary()
+        print(f"Preprocessed image: {preprocessing}")
+        on_stage("preprocessed", **preprocessing)
+
+        # GenAIで画像認識（非同期クライアントでAPI応答を待つ）
+        recognition_result = await recognize_delivery_note_image(
+            prepared.data, masters, on_stage, prepared.mime_type, preprocessing
+        )
+        if isinstance(recognition_result, dict) and recognition_result.get("success"):
+            try:
+                async with AsyncSessionLocal() as cache_db:
+                    await store_recognition(cache_db, cache_key, recognition_result)
+            except Exception as e:
+                # Gemini の結果は得られているので、保存できなくてもそのまま返す
+                print(f"[WARN] Failed to store recognition result in cache: {e}")
+            if quality is not None:
+                recent_image_hashes.add(quality.phash, filename)
+            if warnings:
+                # 警告はこの応答だけに付ける（キャッシュには保存しない）
+                recognition_result = {**recognition_result, "qualityWarnings": warnings}
+
+    if isinstance(recognition_result, dict) and recognition_result.get("success"):
+        issues = _validate_recognition(recognition_result, masters)
+        on_stage("validated", valid=not issues, issues=issues)
+    return recognition_result, cached
+
+async def _load_masters_for_recognition(db: AsyncSession) -> MasterData:
+    masters = await db.run_sync(get_master_data)
+    # マスタ読み込みで確保した接続を認識の待ち時間中に持ち続けない
+    await db.rollback()
+    return masters
+
 @router.post("/recognize-image")
 async def recognize_image(
     file: UploadFile = File(...), 
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user = Depends(get_current_user)
 ):
     """画像をアップロードしてGemini APIで認識"""
     print(f"Received file: {file.filename}, size: {file.size}")
     
     # Save uploaded file
-    upload_dir = "uploads"
-    os.makedirs(upload_dir, exist_ok=True)
-    file_path = os.path.join(upload_dir, file.filename)
+    file_path = _upload_path(file.filename)
     
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        image_data = await file.read()
+        await run_io(Path(file_path).write_bytes, image_data)
         
         print(f"File saved to: {file_path}")
         
-        # GenAIで画像認識
-        recognition_result = recognize_delivery_note_image(file_path, db)
+        masters = await _load_masters_for_recognition(db)
+        recognition_result, cached = await _recognize_with_cache(image_data, masters, filename=file.filename)
 
         # 認識結果のみを返す（DB登録はフロントエンドから明示的に行う）
         return {
             "file_path": file_path,
-            "recognition_result": recognition_result
+            "recognition_result": recognition_result,
+            "cached": cached
         }
         
     except Exception as e:
         print(f"Error in recognize_image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"画像処理エラー: {str(e)}")
 
+async def _batch_concurrency() -> int:
+    """Parallel recognitions for a batch: bounded by config and by keys that have quota now"""
+    healthy_keys = await healthy_key_count()
+    per_key = settings.RECOGNITION_CONCURRENCY_PER_KEY
+    return max(1, min(settings.RECOGNITION_BATCH_CONCURRENCY, healthy_keys * per_key))
+
+async def _read_uploads(files: List[UploadFile]):
+    """[(filename, file_path, image_data)] for the uploaded images, saved under uploads/"""
+    if not files:
+        raise HTTPException(status_code=400, detail="画像がありません")
+    if len(files) > settings.RECOGNITION_BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"一度に認識できる画像は{settings.RECOGNITION_BATCH_MAX_FILES}枚までです"
+        )
+
+    images = []
+    for file in files:
+        image_data = await file.read()
+        file_path = _upload_path(file.filename)
+        await run_io(Path(file_path).write_bytes, image_data)
+        images.append((file.filename, file_path, image_data))
+    return images
+
+async def _recognize_upload(index: int, filename: str, file_path: str, image_data: bytes,
+                            masters: MasterData, on_stage: StageCallback = _ignore_stage) -> dict:
+    """Result line for one image of a batch; errors are reported in the line, not raised"""
+    image_started = time.monotonic()
+    try:
+        recognition_result, cached = await _recognize_with_cache(image_data, masters, on_stage, filename)
+        line = {"recognition_result": recognition_result, "cached": cached}
+    except Exception as e:
+        print(f"Error in batch recognition ({filename}): {e}")
+        line = {"error": f"画像処理エラー: {str(e)}"}
+    return {
+        "index": index,
+        "filename": filename,
+        "file_path": file_path,
+        **line,
+        "elapsed_ms": int((time.monotonic() - image_started) * 1000)
+    }
+
+@router.post("/recognize-images")
+async def recognize_images(
+    files: List[UploadFile] = File(...),
+    db: AsyncSession = Depends(get_async_db),
+    current_user = Depends(get_current_user)
+):
+    """複数画像をまとめて認識（NDJSON: 1行に1画像、完了した順に返す）
+
+    最後の行は {"done": true, ...}。各行の index はアップロード順の位置。
+    """
+    images = await _read_uploads(files)
+    print(f"Received {len(images)} files for batch recognition")
+
+    masters = await _load_masters_for_recognition(db)
+    concurrency = await _batch_concurrency()
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+
+    async def recognize_one(index: int, filename: str, file_path: str, image_data: bytes) -> dict:
+        async with semaphore:
+            return await _recognize_upload(index, filename, file_path, image_data, masters)
+
+    async def stream():
+        tasks = [asyncio.create_task(recognize_one(i, *image)) for i, image in enumerate(images)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished, ensure_ascii=False) + "\n"
+            yield json.dumps({
+                "done": True,
+                "count": len(tasks),
+                "concurrency": concurrency,
+                "elapsed_ms": int((time.monotonic() - started) * 1000)
+            }) + "\n"
+        finally:
+            # クライアントが切断したら残りの認識を止める
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _recognition_event_stream(images, masters: MasterData, concurrency: int):
+    """Server-Sent Events for recognizing `images`
+
+    Per image: received, cache_hit / cache_miss, quality_checked, preprocessed, key_selected,
+    (rate_limited,) model_responded, parsed, validated, then a `result` event
+    with the same fields as a /recognize-images line. Every event carries the
+    image's index; the stream ends with a `done` event.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+
+    async def recognize_one(index: int, filename: str, file_path: str, image_data: bytes):
+        def on_stage(stage: str, **data):
+            queue.put_nowait((stage, {"index": index, **data}))
+
+        async with semaphore:
+            line = await _recognize_upload(index, filename, file_path, image_data, masters, on_stage)
+        queue.put_nowait(("result", line))
+
+    async def stream():
+        for index, (filename, file_path, image_data) in enumerate(images):
+            yield _sse("received", {"index": index, "filename": filename, "file_path": file_path,
+                                    "bytes": len(image_data)})
+        tasks = [asyncio.create_task(recognize_one(i, *image)) for i, image in enumerate(images)]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                event, data = await queue.get()
+                if event == "result":
+                    remaining -= 1
+                yield _sse(event, data)
+            yield _sse("done", {
+                "count": len(tasks),
+                "concurrency": concurrency,
+                "elapsed_ms": int((time.monotonic() - started) * 1000)
+            })
+        finally:
+            # クライアントが切断したら残りの認識を止める
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # プロキシにバッファリングさせず、イベントを即座に届ける
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/recognize-image/stream")
+async def recognize_image_stream(
+    file: UploadFile = File(...),
+    db: AsyncSession = Depends(get_async_db),
+    current_user = Depends(get_current_user)
+):
+    """画像認識の進捗をServer-Sent Eventsで返す（/recognize-image のストリーミング版）"""
+    images = await _read_uploads([file])
+    masters = await _load_masters_for_recognition(db)
+    return _recognition_event_stream(images, masters, 1)
+
+@router.post("/recognize-images/stream")
+async def recognize_images_stream(
+    files: List[UploadFile] = File(...),
+    db: AsyncSession = Depends(get_async_db),
+    current_user = Depends(get_current_user)
+):
+    """複数画像の認識進捗と結果をServer-Sent Eventsで返す（画像ごとに完了次第 result を送る）"""
+    images = await _read_uploads(files)
+    print(f"Received {len(images)} files for streamed batch recognition")
+    masters = await _load_masters_for_recognition(db)
+    return _recognition_event_stream(images, masters, await _batch_concurrency())
+
 # Legacy endpoint (deprecated)
 @router.post("/upload-image")
 async def upload_image(file: UploadFile = File(...), current_user = Depends(get_current_user)):
     # Save uploaded file
-    upload_dir = "uploads"
-    os.makedirs(upload_dir, exist_ok=True)
-    file_path = os.path.join(upload_dir, file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    file_path = _upload_path(file.filename)
+    await run_io(_save_upload, file, file_path)
 
     return {"file_path": file_path, "message": "Image uploaded successfully. Use /recognize-image for OCR."}
\ No newline at end of file
@@ -1,8 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 from models import SalesPerson, Product, Contractor, DiscountRate
 from dependencies import get_current_user
+from invoice_calculation import normalize_rate
+from cache_invalidation import SCOPE_MASTERS, publish_invalidation_async
 from pydantic import BaseModel
 from typing import List, Optional
 
@@ -48,125 +51,131 @@ class ContractorResponse(ContractorBase):
 
 # SalesPerson endpoints
 @router.get("/sales-persons", response_model=List[SalesPersonResponse])
-async def get_sales_persons(db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    sales_persons = db.query(SalesPerson).all()
+async def get_sales_persons(db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    sales_persons = (await db.execute(select(SalesPerson))).scalars().all()
     return sales_persons
 
 @router.post("/sales-persons", response_model=SalesPersonResponse)
-async def create_sales_person(sales_person: SalesPersonCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+async def create_sales_person(sales_person: SalesPersonCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
     db_sales_person = SalesPerson(**sales_person.dict())
     db.add(db_sales_person)
-    db.commit()
-    db.refresh(db_sales_person)
+    await publish_invalidation_async(db, SCOPE_MASTERS)
+    await db.commit()
+    await db.refresh(db_sales_person)
     return db_sales_person
 
 @router.get("/sales-persons/{sales_person_id}", response_model=SalesPersonResponse)
-async def get_sales_person(sales_person_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    sales_person = db.query(SalesPerson).filter(SalesPerson.id == sales_person_id).first()
+async def get_sales_person(sales_person_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    sales_person = await db.get(SalesPerson, sales_person_id)
     if sales_person is None:
         raise HTTPException(status_code=404, detail="Sales person not found")
     return sales_person
 
 @router.put("/sales-persons/{sales_person_id}", response_model=SalesPersonResponse)
-async def update_sales_person(sales_person_id: int, sales_person: SalesPersonCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_sales_person = db.query(SalesPerson).filter(SalesPerson.id == sales_person_id).first()
+async def update_sales_person(sales_person_id: int, sales_person: SalesPersonCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_sales_person = await db.get(SalesPerson, sales_person_id)
     if db_sales_person is None:
         raise HTTPException(status_code=404, detail="Sales person not found")
     for key, value in sales_person.dict().items():
         setattr(db_sales_person, key, value)
-    db.commit()
-    db.refresh(db_sales_person)
+    await publish_invalidation_async(db, SCOPE_MASTERS, [sales_person_id])
+    await db.commit()
+    await db.refresh(db_sales_person)
     return db_sales_person
 
 @router.delete("/sales-persons/{sales_person_id}")
-async def delete_sales_person(sales_person_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_sales_person = db.query(SalesPerson).filter(SalesPerson.id == sales_person_id).first()
+async def delete_sales_person(sales_person_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_sales_person = await db.get(SalesPerson, sales_person_id)
     if db_sales_person is None:
         raise HTTPException(status_code=404, detail="Sales person not found")
-    db.delete(db_sales_person)
-    db.commit()
+    await db.delete(db_sales_person)
+    await publish_invalidation_async(db, SCOPE_MASTERS, [sales_person_id])
+    await db.commit()
     return {"message": "Sales person deleted"}
 
 # Product endpoints
 @router.get("/products", response_model=List[ProductResponse])
-async def get_products(db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    products = db.query(Product).all()
+async def get_products(db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    products = (await db.execute(select(Product))).scalars().all()
     return products
 
 @router.post("/products", response_model=ProductResponse)
-async def create_product(product: ProductCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+async def create_product(product: ProductCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
     db_product = Product(**product.dict())
     db.add(db_product)
-    db.commit()
-    db.refresh(db_product)
+    await publish_invalidation_async(db, SCOPE_MASTERS)
+    await db.commit()
+    await db.refresh(db_product)
     return db_product
 
 @router.get("/products/{product_id}", response_model=ProductResponse)
-async def get_product(product_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    product = db.query(Product).filter(Product.id == product_id).first()
+async def get_product(product_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    product = await db.get(Product, product_id)
     if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
     return product
 
 @router.put("/products/{product_id}", response_model=ProductResponse)
-async def update_product(product_id: int, product: ProductCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_product = db.query(Product).filter(Product.id == product_id).first()
+async def update_product(product_id: int, product: ProductCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_product = await db.get(Product, product_id)
     if db_product is None:
         raise HTTPException(status_code=404, detail="Product not found")
     for key, value in product.dict().items():
         setattr(db_product, key, value)
-    db.commit()
-    db.refresh(db_product)
+    await publish_invalidation_async(db, SCOPE_MASTERS, [product_id])
+    await db.commit()
+    await db.refresh(db_product)
     return db_product
 
 @router.delete("/products/{product_id}")
-async def delete_product(product_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_product = db.query(Product).filter(Product.id == product_id).first()
+async def delete_product(product_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_product = await db.get(Product, product_id)
     if db_product is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    db.delete(db_product)
-    db.commit()
+    await db.delete(db_product)
+    await publish_invalidation_async(db, SCOPE_MASTERS, [product_id])
+    await db.commit()
     return {"message": "Product deleted"}
 
 # Contractor endpoints
 @router.get("/contractors", response_model=List[ContractorResponse])
-async def get_contractors(db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    contractors = db.query(Contractor).all()
+async def get_contractors(db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    contractors = (await db.execute(select(Contractor))).scalars().all()
     return contractors
 
 @router.post("/contractors", response_model=ContractorResponse)
-async def create_contractor(contractor: ContractorCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+async def create_contractor(contractor: ContractorCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
     db_contractor = Contractor(**contractor.dict())
     db.add(db_contractor)
-    db.commit()
-    db.refresh(db_contractor)
+    await db.commit()
+    await db.refresh(db_contractor)
     return db_contractor
 
 @router.get("/contractors/{contractor_id}", response_model=ContractorResponse)
-async def get_contractor(contractor_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    contractor = db.query(Contractor).filter(Contractor.id == contractor_id).first()
+async def get_contractor(contractor_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    contractor = await db.get(Contractor, contractor_id)
     if contractor is None:
         raise HTTPException(status_code=404, detail="Contractor not found")
     return contractor
 
 @router.put("/contractors/{contractor_id}", response_model=ContractorResponse)
-async def update_contractor(contractor_id: int, contractor: ContractorCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_contractor = db.query(Contractor).filter(Contractor.id == contractor_id).first()
+async def update_contractor(contractor_id: int, contractor: ContractorCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_contractor = await db.get(Contractor, contractor_id)
     if db_contractor is None:
         raise HTTPException(status_code=404, detail="Contractor not found")
     for key, value in contractor.dict().items():
         setattr(db_contractor, key, value)
-    db.commit()
-    db.refresh(db_contractor)
+    await db.commit()
+    await db.refresh(db_contractor)
     return db_contractor
 
 @router.delete("/contractors/{contractor_id}")
-async def delete_contractor(contractor_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    db_contractor = db.query(Contractor).filter(Contractor.id == contractor_id).first()
+async def delete_contractor(contractor_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_contractor = await db.get(Contractor, contractor_id)
     if db_contractor is None:
         raise HTTPException(status_code=404, detail="Contractor not found")
-    db.delete(db_contractor)
-    db.commit()
+    await db.delete(db_contractor)
+    await db.commit()
     return {"message": "Contractor deleted"}
 
 # Discount Rate endpoints
@@ -179,24 +188,65 @@ class DiscountRateResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class DiscountRateCreate(BaseModel):
+    rate: float
+    threshold_amount: int = 0
+    customer_flag: bool = True
+
+def _discount_rate_response(rate: DiscountRate) -> DiscountRateResponse:
+    # If rate >= 1, it's stored as percentage (10 = 10%), convert to decimal
+    return DiscountRateResponse(
+        id=rate.id,
+        rate=normalize_rate(rate.rate),
+        threshold_amount=rate.threshold_amount,
+        customer_flag=rate.customer_flag
+    )
+
 @router.get("/discount-rates", response_model=List[DiscountRateResponse])
-async def get_discount_rates(db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    rates = db.query(DiscountRate).filter(DiscountRate.deleted_flag == False).all()
-    print(f"[DEBUG] Returning {len(rates)} discount rates")
-    
-    # Convert rates: if stored as percentage (>=1), convert to decimal
-    result = []
-    for rate in rates:
-        raw_rate = float(rate.rate)
-        # If rate >= 1, it's stored as percentage (10 = 10%), convert to decimal
-        converted_rate = raw_rate / 100 if raw_rate >= 1 else raw_rate
-        print(f"[DEBUG]   ID={rate.id}, raw_rate={raw_rate}, converted_rate={converted_rate}")
-        
-        result.append(DiscountRateResponse(
-            id=rate.id,
-            rate=converted_rate,
-            threshold_amount=rate.threshold_amount,
-            customer_flag=rate.customer_flag
-        ))
-    
-    return result
+async def get_discount_rates(db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    rates = (await db.execute(
+        select(DiscountRate).where(DiscountRate.deleted_flag == False)
+    )).scalars().all()
+    return [_discount_rate_response(rate) for rate in rates]
+
+@router.post("/discount-rates", response_model=DiscountRateResponse)
+async def create_discount_rate(discount_rate: DiscountRateCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_discount_rate = DiscountRate(**discount_rate.dict())
+    db.add(db_discount_rate)
+    await publish_invalidation_async(db, SCOPE_MASTERS)
+    await db.commit()
+    await db.refresh(db_discount_rate)
+    return _discount_rate_response(db_discount_rate)
+
+@router.put("/discount-rates/{discount_rate_id}", response_model=DiscountRateResponse)
+async def update_discount_rate(discount_rate_id: int, discount_rate: DiscountRateCreate, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_discount_rate = (await db.execute(
+        select(DiscountRate).where(
+            DiscountRate.id == discount_rate_id,
+            DiscountRate.deleted_flag == False
+        )
+    )).scalars().first()
+    if db_discount_rate is None:
+        raise HTTPException(status_code=404, detail="Discount rate not found")
+    for key, value in discount_rate.dict().items():
+        setattr(db_discount_rate, key, value)
+    await publish_invalidation_async(db, SCOPE_MASTERS, [discount_rate_id])
+    await db.commit()
+    await db.refresh(db_discount_rate)
+    return _discount_rate_response(db_discount_rate)
+
+@router.delete("/discount-rates/{discount_rate_id}")
+async def delete_discount_rate(discount_rate_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user)):
+    db_discount_rate = (await db.execute(
+        select(DiscountRate).where(
+            DiscountRate.id == discount_rate_id,
+            DiscountRate.deleted_flag == False
+        )
+    )).scalars().first()
+    if db_discount_rate is None:
+        raise HTTPException(status_code=404, detail="Discount rate not found")
+    # 発行済み請求書が参照しているため論理削除
+    db_discount_rate.deleted_flag = True
+    await publish_invalidation_async(db, SCOPE_MASTERS, [discount_rate_id])
+    await db.commit()
+    return {"message": "Discount rate deleted"}
@@ -1,29 +1,45 @@
 # -*- coding: utf-8 -*-
 """販売員請求書API"""
-from datetime import date, timedelta
-from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import date, datetime, timedelta
+from typing import List, Literal, Optional
+import base64
+import json
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
 from pydantic import BaseModel
 
-from database import get_db
+from database import get_async_db
 from models import (
     SalesInvoice, 
-    SalesInvoiceDetail, 
-    DeliveryNote, 
-    DeliveryNoteDetail,
-    DiscountRate,
-    TaxRate,
-    Product,
-    SalesPerson
+    SalesInvoiceDetail
 )
 from dependencies import get_current_user
-from pdf_generator import generate_sales_invoice_pdf
+from pdf_generator import load_sales_invoice_pdf_data, render_sales_invoice_pdf
+from executors import run_cpu
+from invoice_jobs import get_job, submit_bulk_job
+from invoice_generator import (
+    REGENERATION_MODE_DIFF,
+    bulk_generate_invoices,
+    calculate_period_start
+)
+from discount_tiers import DiscountTier
+from master_cache import customer_discount_tiers, get_master_data
+from invoice_calculation import (
+    InvoiceAmounts,
+    basis_points_to_fraction,
+    calculate_invoice,
+    normalize_rate,
+    rate_to_basis_points
+)
 
 router = APIRouter()
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
 
 class InvoiceUpdateRequest(BaseModel):
     discount_rate_id: Optional[int] = None
@@ -31,7 +47,7 @@ class InvoiceUpdateRequest(BaseModel):
 
 
 # Helper function to calculate optimal discount rate
-def calculate_optimal_discount_rate(total_amount: int, db: Session) -> DiscountRate:
+def calculate_optimal_discount_rate(total_amount: int, db: Session) -> Optional[DiscountTier]:
     """Calculate optimal discount rate based on total amount
     
     Rules:
@@ -40,25 +56,13 @@ def calculate_optimal_discount_rate(total_amount: int, db: Session) -> DiscountR
     - >= 42,000: 20%
     - < 42,000: 0% (can be manually changed to 10% later)
     """
-    # Get all sales person discount rates ordered by threshold desc
-    discount_rates = db.query(DiscountRate).filter(
-        DiscountRate.customer_flag == True,
-        DiscountRate.deleted_flag == False
-    ).order_by(DiscountRate.threshold_amount.desc()).all()
-    
-    # Find the highest applicable rate
-    for rate in discount_rates:
-        if total_amount >= rate.threshold_amount and rate.rate > 0:
-            return rate
-    
-    # If no rate >= 20% applies, return 0% rate
-    zero_rate = db.query(DiscountRate).filter(
-        DiscountRate.customer_flag == True,
-        DiscountRate.rate == 0,
-        DiscountRate.deleted_flag == False
-    ).first()
-    
-    return zero_rate
+    return customer_discount_tiers(db).lookup(total_amount)
+
+
+def _apply_invoice_amounts(invoice: SalesInvoice, amounts: InvoiceAmounts) -> None:
+    """Copy recalculated amounts onto an invoice"""
+    for key, value in amounts._asdict().items():
+        setattr(invoice, key, value)
 
 
 class InvoiceGenerateRequest(BaseModel):
@@ -73,6 +77,7 @@ class BulkInvoiceGenerateRequest(BaseModel):
     """一括請求書生成リクエスト"""
     closing_date: date  # 締め日（必須）
     sales_person_ids: Optional[List[int]] = None  # None=全販売員、指定=特定販売員のみ
+    regeneration_mode: Literal["diff", "replace"] = REGENERATION_MODE_DIFF  # 既存請求書の再生成方法
 
 
 class DiscountRateUpdateRequest(BaseModel):
@@ -121,274 +126,95 @@ def generate_invoice_for_sales_person(
     db: Session
 ) -> Optional[InvoiceResponse]:
     """Generate invoice for a specific sales person"""
-    
-    # Get delivery notes for the period
-    delivery_notes = db.query(DeliveryNote).filter(
-        DeliveryNote.sales_person_id == sales_person_id,
-        DeliveryNote.delivery_date >= start_date,
-        DeliveryNote.delivery_date <= end_date
-    ).all()
-    
-    if not delivery_notes:
+    sales_person = get_master_data(db).sales_persons.get(sales_person_id)
+    if not sales_person:
+        return None
+
+    invoices, _ = bulk_generate_invoices([sales_person], start_date, end_date, db)
+    if not invoices:
         return None  # No delivery notes, skip this sales person
-    
-    # Get tax rate
-    tax_rate = db.query(TaxRate).filter(
-        TaxRate.deleted_flag == False
-    ).first()
-    if not tax_rate:
-        raise HTTPException(status_code=404, detail="Tax rate not found")
-    
-    delivery_note_ids = [dn.id for dn in delivery_notes]
-    
-    # Aggregate by product
-    aggregated_data = db.query(
-        DeliveryNoteDetail.product_id,
-        Product.quota_target_flag,
-        func.sum(DeliveryNoteDetail.quantity).label('total_quantity'),
-        DeliveryNoteDetail.unit_price
-    ).join(
-        Product, DeliveryNoteDetail.product_id == Product.id
-    ).filter(
-        DeliveryNoteDetail.delivery_note_id.in_(delivery_note_ids)
-    ).group_by(
-        DeliveryNoteDetail.product_id,
-        Product.quota_target_flag,
-        DeliveryNoteDetail.unit_price
-    ).all()
-    
-    quota_subtotal = 0
-    non_quota_subtotal = 0
-    invoice_details = []
-    
-    for item in aggregated_data:
-        amount = item.total_quantity * item.unit_price
-        
-        if item.quota_target_flag:
-            quota_subtotal += amount
-        else:
-            non_quota_subtotal += amount
-        
-        invoice_details.append({
-            'product_id': item.product_id,
-            'total_quantity': item.total_quantity,
-            'unit_price': item.unit_price,
-            'amount': amount
-        })
-    
-    # Calculate total for discount determination
-    total_subtotal = quota_subtotal + non_quota_subtotal
-    
-    # Auto-calculate optimal discount rate
-    discount_rate = calculate_optimal_discount_rate(total_subtotal, db)
-    
-    # Calculate discount
-    discount_rate_value = float(discount_rate.rate)
-    # If rate >= 1, it's stored as percentage (10 = 10%), convert to decimal
-    if discount_rate_value >= 1:
-        discount_rate_value = discount_rate_value / 100
-    
-    quota_discount_amount = int(quota_subtotal * discount_rate_value)
-    non_quota_discount_amount = int(non_quota_subtotal * discount_rate_value)
-    
-    quota_total = quota_subtotal - quota_discount_amount
-    non_quota_total = non_quota_subtotal - non_quota_discount_amount
-    
-    total_amount_ex_tax = quota_total + non_quota_total
-    
-    # Calculate tax (floor rounding) - apply to total amount excluding tax
-    tax_rate_value = float(tax_rate.rate)
-    # If tax rate >= 1, it's stored as percentage (10 = 10%), convert to decimal
-    if tax_rate_value >= 1:
-        tax_rate_value = tax_rate_value / 100
-    tax_amount = int(total_amount_ex_tax * tax_rate_value)
-    
-    total_amount_inc_tax = total_amount_ex_tax + tax_amount
-    
-    # Calculate invoice_date and receipt_date
-    # 請求日 = 締め日と同じ
-    invoice_date = end_date
-    # 領収日 = 請求日当月の25日
-    receipt_date = end_date.replace(day=25)
-    
-    # Check if invoice already exists for this sales person and period
-    existing_invoice = db.query(SalesInvoice).filter(
-        SalesInvoice.sales_person_id == sales_person_id,
-        SalesInvoice.start_date == start_date,
-        SalesInvoice.end_date == end_date
-    ).first()
-    
-    if existing_invoice:
-        # Update existing invoice
-        existing_invoice.discount_rate_id = discount_rate.id
-        existing_invoice.invoice_date = invoice_date
-        existing_invoice.receipt_date = receipt_date
-        existing_invoice.quota_subtotal = quota_subtotal
-        existing_invoice.quota_discount_amount = quota_discount_amount
-        existing_invoice.quota_total = quota_total
-        existing_invoice.non_quota_subtotal = non_quota_subtotal
-        existing_invoice.non_quota_discount_amount = non_quota_discount_amount
-        existing_invoice.non_quota_total = non_quota_total
-        existing_invoice.total_amount_ex_tax = total_amount_ex_tax
-        existing_invoice.tax_amount = tax_amount
-        existing_invoice.total_amount_inc_tax = total_amount_inc_tax
-        
-        # Delete old details
-        db.query(SalesInvoiceDetail).filter(
-            SalesInvoiceDetail.sales_invoice_id == existing_invoice.id
-        ).delete()
-        
-        invoice = existing_invoice
-    else:
-        # Create new invoice record
-        invoice = SalesInvoice(
-            sales_person_id=sales_person_id,
-            invoice_number="T5810180900550",
-            start_date=start_date,
-            end_date=end_date,
-            invoice_date=invoice_date,
-            receipt_date=receipt_date,
-            discount_rate_id=discount_rate.id,
-            quota_subtotal=quota_subtotal,
-            quota_discount_amount=quota_discount_amount,
-            quota_total=quota_total,
-            non_quota_subtotal=non_quota_subtotal,
-            non_quota_discount_amount=non_quota_discount_amount,
-            non_quota_total=non_quota_total,
-            total_amount_ex_tax=total_amount_ex_tax,
-            tax_amount=tax_amount,
-            total_amount_inc_tax=total_amount_inc_tax
-        )
-        db.add(invoice)
-    
-    db.commit()
-    db.refresh(invoice)
-    
-    # Create invoice details
-    detail_responses = []
-    for detail_data in invoice_details:
-        detail = SalesInvoiceDetail(
-            sales_invoice_id=invoice.id,
-            **detail_data
-        )
-        db.add(detail)
-        db.flush()
-        
-        product = db.query(Product).filter(Product.id == detail.product_id).first()
-        detail_responses.append(InvoiceDetailResponse(
-            id=detail.id,
-            product_id=detail.product_id,
-            product_name=product.name if product else "",
-            total_quantity=detail.total_quantity,
-            unit_price=detail.unit_price,
-            amount=detail.amount
-        ))
-    
-    db.commit()
-    
-    # Get sales person name
-    sales_person = db.query(SalesPerson).filter(
-        SalesPerson.id == sales_person_id
-    ).first()
-    
-    return InvoiceResponse(
-        id=invoice.id,
-        sales_person_id=invoice.sales_person_id,
-        sales_person_name=sales_person.name if sales_person else "",
-        invoice_number=invoice.invoice_number,
-        start_date=invoice.start_date,
-        end_date=invoice.end_date,
-        invoice_date=invoice.invoice_date,
-        receipt_date=invoice.receipt_date,
-        discount_rate_id=invoice.discount_rate_id,
-        discount_rate=discount_rate_value,
-        quota_subtotal=invoice.quota_subtotal,
-        quota_discount_amount=invoice.quota_discount_amount,
-        quota_total=invoice.quota_total,
-        non_quota_subtotal=invoice.non_quota_subtotal,
-        non_quota_discount_amount=invoice.non_quota_discount_amount,
-        non_quota_total=invoice.non_quota_total,
-        total_amount_ex_tax=invoice.total_amount_ex_tax,
-        tax_amount=invoice.tax_amount,
-        total_amount_inc_tax=invoice.total_amount_inc_tax,
-        details=detail_responses
-    )
+    return InvoiceResponse(**invoices[0])
 
 
-@router.post("/sales-invoices/bulk-generate")
+@router.post("/sales-invoices/bulk-generate", status_code=202)
 async def bulk_generate_sales_invoices(
     request: BulkInvoiceGenerateRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: dict = Depends(get_current_user)
 ):
     """Bulk generate sales invoices
     
     Generate invoices for all or selected sales persons for a specific closing date.
     Period is automatically calculated: (previous month 21st) to (closing date)
+    The work runs as a background job: this returns a job id immediately, poll
+    GET /sales-invoices/bulk-generate/jobs/{job_id} for progress and
+    GET /sales-invoices/bulk-generate/jobs/{job_id}/result for the payload.
     """
-    # Calculate start date (21st of previous month)
-    if request.closing_date.day >= 21:
-        # If closing date is >= 21st, start from same month 21st
-        start_date = request.closing_date.replace(day=21)
-    else:
-        # If closing date is < 21st, start from previous month 21st
-        if request.closing_date.month == 1:
-            start_date = request.closing_date.replace(year=request.closing_date.year - 1, month=12, day=21)
-        else:
-            prev_month = request.closing_date.month - 1
-            start_date = request.closing_date.replace(month=prev_month, day=21)
+    start_date = calculate_period_start(request.closing_date)
     
     # Get target sales persons
+    sales_persons = (await db.run_sync(get_master_data)).active_sales_persons
     if request.sales_person_ids:
-        sales_persons = db.query(SalesPerson).filter(
-            SalesPerson.id.in_(request.sales_person_ids),
-            SalesPerson.deleted_flag == False
-        ).all()
-    else:
-        sales_persons = db.query(SalesPerson).filter(
-            SalesPerson.deleted_flag == False
-        ).all()
+        requested_ids = set(request.sales_person_ids)
+        sales_persons = [sp for sp in sales_persons if sp.id in requested_ids]
     
     if not sales_persons:
         raise HTTPException(status_code=404, detail="No sales persons found")
     
-    # Generate invoices
-    generated_invoices = []
-    skipped_persons = []
-    
-    for sales_person in sales_persons:
-        invoice = generate_invoice_for_sales_person(
-            sales_person.id,
-            start_date,
-            request.closing_date,
-            db
-        )
-        if invoice:
-            generated_invoices.append(invoice)
-        else:
-            skipped_persons.append(sales_person.name)
+    job = await db.run_sync(lambda session: submit_bulk_job(
+        sales_persons,
+        start_date,
+        request.closing_date,
+        session,
+        regeneration_mode=request.regeneration_mode
+    ))
     
-    return {
-        "success": True,
-        "generated_count": len(generated_invoices),
-        "skipped_count": len(skipped_persons),
-        "skipped_persons": skipped_persons,
-        "invoices": generated_invoices,
-        "period": {
-            "start_date": start_date.isoformat(),
-            "end_date": request.closing_date.isoformat()
-        }
-    }
+    return job.snapshot()
+
+
+@router.get("/sales-invoices/bulk-generate/jobs/{job_id}")
+async def get_bulk_generate_job(
+    job_id: str,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Progress of a bulk generation job (per sales person status and counts)"""
+    job = await db.run_sync(lambda session: get_job(job_id, session))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.snapshot()
+
+
+@router.get("/sales-invoices/bulk-generate/jobs/{job_id}/result")
+async def get_bulk_generate_job_result(
+    job_id: str,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Final payload of a finished bulk generation job"""
+    job = await db.run_sync(lambda session: get_job(job_id, session))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not job.finished:
+        raise HTTPException(status_code=409, detail="Job is still running")
+    
+    result = job.result()
+    result["invoices"] = [InvoiceResponse(**invoice) for invoice in result["invoices"]]
+    return result
 
 
 @router.patch("/sales-invoices/{invoice_id}")
 async def update_invoice_fields(
     invoice_id: int,
     update_data: InvoiceUpdateRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: dict = Depends(get_current_user)
 ):
     """Update invoice fields like discount_rate_id and note"""
+    return await db.run_sync(_update_invoice_fields, invoice_id, update_data)
+
+
+def _update_invoice_fields(db: Session, invoice_id: int, update_data: InvoiceUpdateRequest) -> dict:
     invoice = db.query(SalesInvoice).filter(SalesInvoice.id == invoice_id).first()
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
@@ -396,30 +222,27 @@ async def update_invoice_fields(
     # Update fields if provided
     if update_data.discount_rate_id is not None:
         # 割引率を変更する場合は、金額も再計算
-        discount_rate = db.query(DiscountRate).filter(DiscountRate.id == update_data.discount_rate_id).first()
+        masters = get_master_data(db)
+        discount_rate = masters.discount_rates.get(update_data.discount_rate_id)
         if not discount_rate:
             raise HTTPException(status_code=404, detail="Discount rate not found")
         
         invoice.discount_rate_id = update_data.discount_rate_id
         
-        # 割引額と合計を再計算
-        discount_rate_value = float(discount_rate.rate)
-        if discount_rate_value >= 1:
-            discount_rate_value = discount_rate_value / 100
-        invoice.quota_discount_amount = int(invoice.quota_subtotal * discount_rate_value)
-        invoice.quota_total = invoice.quota_subtotal - invoice.quota_discount_amount
-        invoice.non_quota_discount_amount = int(invoice.non_quota_subtotal * discount_rate_value)
-        invoice.non_quota_total = invoice.non_quota_subtotal - invoice.non_quota_discount_amount
-        invoice.total_amount_ex_tax = invoice.quota_total + invoice.non_quota_total + (invoice.non_discountable_amount or 0)
-        
-        # 消費税を計算
-        tax_rate = db.query(TaxRate).filter(TaxRate.deleted_flag == False).first()
-        if tax_rate:
-            tax_rate_value = float(tax_rate.rate)
-            if tax_rate_value >= 1:
-                tax_rate_value = tax_rate_value / 100
-            invoice.tax_amount = int(invoice.total_amount_ex_tax * tax_rate_value)
-        invoice.total_amount_inc_tax = invoice.total_amount_ex_tax + invoice.tax_amount
+        # 割引額・合計・消費税を再計算（税率が見つからない場合は消費税額を据え置き）
+        tax_rate = masters.current_tax_rate
+        amounts = calculate_invoice(
+            invoice.quota_subtotal,
+            invoice.non_quota_subtotal,
+            rate_to_basis_points(discount_rate.rate),
+            rate_to_basis_points(tax_rate.rate) if tax_rate else 0,
+            invoice.non_discountable_amount or 0
+        )
+        tax_amount = amounts.tax_amount if tax_rate else (invoice.tax_amount or 0)
+        _apply_invoice_amounts(invoice, amounts._replace(
+            tax_amount=tax_amount,
+            total_amount_inc_tax=amounts.total_amount_ex_tax + tax_amount
+        ))
     
     if update_data.note is not None:
         invoice.note = update_data.note
@@ -428,8 +251,9 @@ async def update_invoice_fields(
     db.refresh(invoice)
     
     # 請求書データを取得して返す（JOINでリレーション情報も含める）
-    sales_person = db.query(SalesPerson).filter(SalesPerson.id == invoice.sales_person_id).first()
-    discount_rate = db.query(DiscountRate).filter(DiscountRate.id == invoice.discount_rate_id).first()
+    masters = get_master_data(db)
+    sales_person = masters.sales_persons.get(invoice.sales_person_id)
+    discount_rate = masters.discount_rates.get(invoice.discount_rate_id)
     details = db.query(SalesInvoiceDetail).filter(SalesInvoiceDetail.sales_invoice_id == invoice.id).all()
     
     return {
@@ -458,7 +282,7 @@ async def update_invoice_fields(
             {
                 "id": detail.id,
                 "product_id": detail.product_id,
-                "product_name": db.query(Product).filter(Product.id == detail.product_id).first().name,
+                "product_name": masters.products[detail.product_id].name if detail.product_id in masters.products else None,
                 "total_quantity": detail.total_quantity,
                 "unit_price": detail.unit_price,
                 "amount": detail.amount
@@ -472,59 +296,47 @@ async def update_invoice_fields(
 async def update_invoice_discount_rate(
     invoice_id: int,
     request: DiscountRateUpdateRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: dict = Depends(get_current_user)
 ):
     """Update discount rate of an existing invoice and recalculate amounts
     
     This is typically used to change 0% invoices to 10%.
     """
+    return await db.run_sync(_update_invoice_discount_rate, invoice_id, request)
+
+
+def _update_invoice_discount_rate(db: Session, invoice_id: int, request: DiscountRateUpdateRequest) -> dict:
     # Get invoice
     invoice = db.query(SalesInvoice).filter(SalesInvoice.id == invoice_id).first()
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
     # Get new discount rate
-    discount_rate = db.query(DiscountRate).filter(
-        DiscountRate.id == request.discount_rate_id,
-        DiscountRate.customer_flag == True,
-        DiscountRate.deleted_flag == False
-    ).first()
-    if not discount_rate:
+    masters = get_master_data(db)
+    discount_rate = masters.discount_rates.get(request.discount_rate_id)
+    if not discount_rate or not discount_rate.customer_flag or discount_rate.deleted_flag:
         raise HTTPException(status_code=404, detail="Discount rate not found")
     
-    # Recalculate with new discount rate
-    discount_rate_value = float(discount_rate.rate)
-    if discount_rate_value >= 1:
-        discount_rate_value = discount_rate_value / 100
-    quota_discount_amount = int(invoice.quota_subtotal * discount_rate_value)
-    non_quota_discount_amount = int(invoice.non_quota_subtotal * discount_rate_value)
-    
-    quota_total = invoice.quota_subtotal - quota_discount_amount
-    non_quota_total = invoice.non_quota_subtotal - non_quota_discount_amount
-    
-    total_amount_ex_tax = quota_total + non_quota_total
-    
     # Get tax rate
-    tax_rate = db.query(TaxRate).filter(
-        TaxRate.is_active == True
-    ).order_by(TaxRate.effective_date.desc()).first()
-    tax_rate_value = float(tax_rate.rate)
-    if tax_rate_value >= 1:
-        tax_rate_value = tax_rate_value / 100
-    tax_amount = int(total_amount_ex_tax * tax_rate_value)
+    tax_rate = masters.current_tax_rate
+    if not tax_rate:
+        raise HTTPException(status_code=404, detail="Tax rate not found")
     
-    total_amount_inc_tax = total_amount_ex_tax + tax_amount
+    # Recalculate with new discount rate
+    old_discount_rate = masters.discount_rates.get(invoice.discount_rate_id)
+    old_rate = normalize_rate(old_discount_rate.rate) if old_discount_rate else 0.0
+    discount_rate_bp = rate_to_basis_points(discount_rate.rate)
+    amounts = calculate_invoice(
+        invoice.quota_subtotal,
+        invoice.non_quota_subtotal,
+        discount_rate_bp,
+        rate_to_basis_points(tax_rate.rate)
+    )
     
     # Update invoice
     invoice.discount_rate_id = discount_rate.id
-    invoice.quota_discount_amount = quota_discount_amount
-    invoice.non_quota_discount_amount = non_quota_discount_amount
-    invoice.quota_total = quota_total
-    invoice.non_quota_total = non_quota_total
-    invoice.total_amount_ex_tax = total_amount_ex_tax
-    invoice.tax_amount = tax_amount
-    invoice.total_amount_inc_tax = total_amount_inc_tax
+    _apply_invoice_amounts(invoice, amounts)
     
     db.commit()
     db.refresh(invoice)
@@ -533,127 +345,37 @@ async def update_invoice_discount_rate(
         "success": True,
         "message": "Discount rate updated successfully",
         "invoice_id": invoice.id,
-        "old_rate": float(db.query(DiscountRate).filter(DiscountRate.id == invoice.discount_rate_id).first().rate),
-        "new_rate": discount_rate_value,
-        "new_total_amount_inc_tax": total_amount_inc_tax
+        "old_rate": old_rate,
+        "new_rate": basis_points_to_fraction(discount_rate_bp),
+        "new_total_amount_inc_tax": amounts.total_amount_inc_tax
     }
 
 
-@router.get("/sales-invoices", response_model=List[InvoiceResponse])
-async def get_sales_invoices(
-    sales_person_id: Optional[int] = None,
-    db: Session = Depends(get_db),
-    current_user: dict = Depends(get_current_user)
-):
-    """Get sales invoices list"""
-    query = db.query(SalesInvoice)
-    
-    if sales_person_id:
-        query = query.filter(SalesInvoice.sales_person_id == sales_person_id)
-    
-    invoices = query.order_by(SalesInvoice.created_at.desc()).all()
-    
-    result = []
-    for invoice in invoices:
-        details = db.query(SalesInvoiceDetail).filter(
-            SalesInvoiceDetail.sales_invoice_id == invoice.id
-        ).all()
-        
-        # Get discount rate
-        discount_rate = db.query(DiscountRate).filter(
-            DiscountRate.id == invoice.discount_rate_id
-        ).first()
-        
-        # Calculate discount rate value
-        if discount_rate:
-            raw_rate = float(discount_rate.rate)
-            # If rate >= 1, it's stored as percentage (10 = 10%), convert to decimal
-            discount_rate_value = raw_rate / 100 if raw_rate >= 1 else raw_rate
-        else:
-            # Fallback: discount_rate not found, default to 0
-            discount_rate_value = 0.0
-        
-        print(f"[DEBUG API] Invoice {invoice.id}: discount_rate_id={invoice.discount_rate_id}, raw_rate={raw_rate if discount_rate else 'N/A'}, discount_rate_value={discount_rate_value}")
-        
-        # Get sales person
-        sales_person = db.query(SalesPerson).filter(
-            SalesPerson.id == invoice.sales_person_id
-        ).first()
-        
-        detail_responses = []
-        for detail in details:
-            product = db.query(Product).filter(Product.id == detail.product_id).first()
-            detail_responses.append(InvoiceDetailResponse(
-                id=detail.id,
-                product_id=detail.product_id,
-                product_name=product.name if product else "",
-                total_quantity=detail.total_quantity,
-                unit_price=detail.unit_price,
-                amount=detail.amount
-            ))
-        
-        result.append(InvoiceResponse(
-            id=invoice.id,
-            sales_person_id=invoice.sales_person_id,
-            sales_person_name=sales_person.name if sales_person else "",
-            invoice_number=invoice.invoice_number,
-            start_date=invoice.start_date,
-            end_date=invoice.end_date,
-            invoice_date=invoice.invoice_date,
-            receipt_date=invoice.receipt_date,
-            discount_rate_id=invoice.discount_rate_id,
-            discount_rate=discount_rate_value,
-            quota_subtotal=invoice.quota_subtotal,
-            quota_discount_amount=invoice.quota_discount_amount,
-            quota_total=invoice.quota_total,
-            non_quota_subtotal=invoice.non_quota_subtotal,
-            non_quota_discount_amount=invoice.non_quota_discount_amount,
-            non_quota_total=invoice.non_quota_total,
-            total_amount_ex_tax=invoice.total_amount_ex_tax,
-            tax_amount=invoice.tax_amount,
-            total_amount_inc_tax=invoice.total_amount_inc_tax,
-            details=detail_responses
-        ))
-    
-    return result
+def _invoice_query():
+    """SalesInvoice select with every relation needed for InvoiceResponse eager-loaded"""
+    return select(SalesInvoice).options(
+        joinedload(SalesInvoice.sales_person),
+        joinedload(SalesInvoice.discount_rate),
+        selectinload(SalesInvoice.details).joinedload(SalesInvoiceDetail.product)
+    )
 
 
-@router.get("/sales-invoices/{invoice_id}", response_model=InvoiceResponse)
-async def get_sales_invoice(
-    invoice_id: int,
-    db: Session = Depends(get_db),
-    current_user: dict = Depends(get_current_user)
-):
-    """Get sales invoice detail"""
-    invoice = db.query(SalesInvoice).filter(SalesInvoice.id == invoice_id).first()
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    details = db.query(SalesInvoiceDetail).filter(
-        SalesInvoiceDetail.sales_invoice_id == invoice.id
-    ).all()
-    
-    # Get discount rate
-    discount_rate = db.query(DiscountRate).filter(
-        DiscountRate.id == invoice.discount_rate_id
-    ).first()
-    
-    # Get sales person
-    sales_person = db.query(SalesPerson).filter(
-        SalesPerson.id == invoice.sales_person_id
-    ).first()
+def _build_invoice_response(invoice: SalesInvoice) -> InvoiceResponse:
+    """Assemble InvoiceResponse from an invoice loaded by _invoice_query (no extra queries)"""
+    discount_rate = invoice.discount_rate
+    sales_person = invoice.sales_person
     
-    detail_responses = []
-    for detail in details:
-        product = db.query(Product).filter(Product.id == detail.product_id).first()
-        detail_responses.append(InvoiceDetailResponse(
+    detail_responses = [
+        InvoiceDetailResponse(
             id=detail.id,
             product_id=detail.product_id,
-            product_name=product.name if product else "",
+            product_name=detail.product.name if detail.product else "",
             total_quantity=detail.total_quantity,
             unit_price=detail.unit_price,
             amount=detail.amount
-        ))
+        )
+        for detail in invoice.details
+    ]
     
     return InvoiceResponse(
         id=invoice.id,
@@ -665,7 +387,8 @@ async def get_sales_invoice(
         invoice_date=invoice.invoice_date,
         receipt_date=invoice.receipt_date,
         discount_rate_id=invoice.discount_rate_id,
-        discount_rate=float(discount_rate.rate) if discount_rate else 0.0,
+        # Fallback: discount_rate not found, default to 0
+        discount_rate=normalize_rate(discount_rate.rate) if discount_rate else 0.0,
         quota_subtotal=invoice.quota_subtotal,
         quota_discount_amount=invoice.quota_discount_amount,
         quota_total=invoice.quota_total,
@@ -679,25 +402,110 @@ async def get_sales_invoice(
     )
 
 
+def _encode_cursor(invoice: SalesInvoice) -> str:
+    """Opaque keyset cursor pointing just after the given invoice"""
+    raw = json.dumps([invoice.created_at.isoformat(), invoice.id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor: str):
+    try:
+        created_at, invoice_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(created_at), int(invoice_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/sales-invoices", response_model=List[InvoiceResponse])
+async def get_sales_invoices(
+    response: Response,
+    sales_person_id: Optional[int] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    min_amount: Optional[int] = None,
+    max_amount: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get sales invoices list
+    
+    Filters:
+    - start_date / end_date: invoices whose closing period lies within the range
+    - sales_person_id
+    - min_amount / max_amount: total_amount_inc_tax range
+    
+    Paging (keyset, newest first): returns `limit` invoices (default
+    DEFAULT_PAGE_SIZE); pass the `X-Next-Cursor` response header back as
+    `cursor` to get the next page.
+    """
+    query = _invoice_query()
+    
+    if sales_person_id:
+        query = query.where(SalesInvoice.sales_person_id == sales_person_id)
+    if start_date:
+        query = query.where(SalesInvoice.start_date >= start_date)
+    if end_date:
+        query = query.where(SalesInvoice.end_date <= end_date)
+    if min_amount is not None:
+        query = query.where(SalesInvoice.total_amount_inc_tax >= min_amount)
+    if max_amount is not None:
+        query = query.where(SalesInvoice.total_amount_inc_tax <= max_amount)
+    
+    if cursor:
+        cursor_created_at, cursor_id = _decode_cursor(cursor)
+        # 行値の比較なので (created_at desc, id desc) のインデックスを範囲走査できる
+        query = query.where(
+            tuple_(SalesInvoice.created_at, SalesInvoice.id) < tuple_(cursor_created_at, cursor_id)
+        )
+    
+    query = query.order_by(SalesInvoice.created_at.desc(), SalesInvoice.id.desc())
+    
+    # Fetch one extra row to know whether a next page exists
+    invoices = (await db.execute(query.limit(limit + 1))).unique().scalars().all()
+    if len(invoices) > limit:
+        invoices = invoices[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(invoices[-1])
+    
+    return [_build_invoice_response(invoice) for invoice in invoices]
+
+
+@router.get("/sales-invoices/{invoice_id}", response_model=InvoiceResponse)
+async def get_sales_invoice(
+    invoice_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get sales invoice detail"""
+    invoice = (await db.execute(
+        _invoice_query().where(SalesInvoice.id == invoice_id)
+    )).unique().scalars().first()
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    
+    return _build_invoice_response(invoice)
+
+
 @router.delete("/sales-invoices/{invoice_id}")
 async def delete_sales_invoice(
     invoice_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: dict = Depends(get_current_user)
 ):
     """Delete sales invoice"""
-    invoice = db.query(SalesInvoice).filter(SalesInvoice.id == invoice_id).first()
+    invoice = await db.get(SalesInvoice, invoice_id)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
     # Delete invoice details first (cascade)
-    db.query(SalesInvoiceDetail).filter(
-        SalesInvoiceDetail.sales_invoice_id == invoice_id
-    ).delete()
+    await db.execute(
+        delete(SalesInvoiceDetail).where(SalesInvoiceDetail.sales_invoice_id == invoice_id)
+    )
     
     # Delete invoice
-    db.delete(invoice)
-    db.commit()
+    await db.delete(invoice)
+    await db.commit()
     
     return {
         "success": True,
@@ -709,20 +517,27 @@ async def delete_sales_invoice(
 @router.get("/sales-invoices/{invoice_id}/pdf")
 async def generate_invoice_pdf(
     invoice_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: dict = Depends(get_current_user)
 ):
     """Generate sales invoice PDF"""
-    invoice = db.query(SalesInvoice).filter(SalesInvoice.id == invoice_id).first()
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    pdf_buffer = generate_sales_invoice_pdf(invoice, db)
+    # DB読み込みはセッション上で、描画はCPUプールで（描画中もイベントループを塞がない）
+    invoice, details, masters = await db.run_sync(_load_invoice_pdf_data, invoice_id)
+    pdf_buffer = await run_cpu(render_sales_invoice_pdf, invoice, details, masters)
     
     return StreamingResponse(
         pdf_buffer,
         media_type="application/pdf",
         headers={
-            "Content-Disposition": f"attachment; filename=invoice_{invoice.id}.pdf"
+            "Content-Disposition": f"attachment; filename=invoice_{invoice_id}.pdf"
         }
     )
+
+
+def _load_invoice_pdf_data(db: Session, invoice_id: int):
+    invoice = db.query(SalesInvoice).filter(SalesInvoice.id == invoice_id).first()
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    
+    details, masters = load_sales_invoice_pdf_data(invoice, db)
+    return invoice, details, masters
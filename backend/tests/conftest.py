@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend のモジュールはフラットに import される（`from config import settings` など）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,58 @@
+from decimal import Decimal
+
+from discount_tiers import DiscountTier, DiscountTierIndex
+
+# 販売員向けの割引率テーブル（初期データと同じ）
+TIERS = [
+    DiscountTier(1, Decimal("0.00"), 0, True),
+    DiscountTier(2, Decimal("0.10"), 21000, True),
+    DiscountTier(3, Decimal("0.20"), 42000, True),
+    DiscountTier(4, Decimal("0.30"), 200000, True),
+    DiscountTier(5, Decimal("0.40"), 400000, True),
+]
+
+
+def test_lookup_at_exact_thresholds():
+    index = DiscountTierIndex(TIERS)
+
+    assert index.lookup(21000).id == 2
+    assert index.lookup(42000).id == 3
+    assert index.lookup(200000).id == 4
+    assert index.lookup(400000).id == 5
+
+
+def test_lookup_just_below_thresholds():
+    index = DiscountTierIndex(TIERS)
+
+    assert index.lookup(41999).id == 2
+    assert index.lookup(399999).id == 4
+
+
+def test_lookup_below_lowest_positive_tier_uses_zero_tier():
+    index = DiscountTierIndex(TIERS)
+
+    assert index.lookup(20999).id == 1
+    assert index.lookup(0).id == 1
+
+
+def test_lookup_below_lowest_tier_without_zero_tier():
+    index = DiscountTierIndex(TIERS[1:])
+
+    assert index.lookup(20999) is None
+    assert index.lookup(21000).id == 2
+
+
+def test_unsorted_input_and_highest_zero_tier():
+    tiers = [TIERS[3], TIERS[1], DiscountTier(6, Decimal("0"), 10000, True), TIERS[0]]
+    index = DiscountTierIndex(tiers)
+
+    assert len(index) == 3
+    assert index.lookup(199999).id == 2
+    assert index.lookup(5).id == 6
+
+
+def test_empty_index():
+    index = DiscountTierIndex([])
+
+    assert len(index) == 0
+    assert index.lookup(100000) is None
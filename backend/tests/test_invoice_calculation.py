@@ -0,0 +1,69 @@
+from decimal import Decimal
+
+import pytest
+
+from invoice_calculation import (
+    InvoiceAmounts, calculate_invoice, calculate_invoices, normalize_rate, rate_to_basis_points
+)
+
+
+@pytest.mark.parametrize("raw_rate, expected", [
+    (0.2, 2000),             # fraction
+    (20, 2000),              # percentage
+    (1, 100),                # 1 is a percentage (1%), not 100%
+    (Decimal("0.10"), 1000), # DECIMAL(4, 2) column
+    (Decimal("8.00"), 800),
+    (0, 0),
+    (None, 0),
+])
+def test_rate_to_basis_points(raw_rate, expected):
+    assert rate_to_basis_points(raw_rate) == expected
+
+
+def test_normalize_rate_accepts_both_storage_formats():
+    assert normalize_rate(10) == normalize_rate(0.1) == 0.1
+
+
+def test_calculate_invoice_rounds_discount_and_tax_down():
+    amounts = calculate_invoice(12345, 678, discount_rate_bp=1500, tax_rate_bp=1000)
+
+    assert amounts == InvoiceAmounts(
+        quota_subtotal=12345,
+        quota_discount_amount=1851,      # 1851.75
+        quota_total=10494,
+        non_quota_subtotal=678,
+        non_quota_discount_amount=101,   # 101.7
+        non_quota_total=577,
+        total_amount_ex_tax=11071,
+        tax_amount=1107,                 # 1107.1
+        total_amount_inc_tax=12178,
+    )
+
+
+def test_calculate_invoice_reduced_tax_rate():
+    amounts = calculate_invoice(11071, 0, discount_rate_bp=0, tax_rate_bp=800)
+
+    assert amounts.tax_amount == 885    # 885.68
+    assert amounts.total_amount_inc_tax == 11956
+
+
+def test_calculate_invoice_non_discountable_amount_is_taxed_but_not_discounted():
+    amounts = calculate_invoice(1000, 0, discount_rate_bp=2000, tax_rate_bp=1000, non_discountable_amount=500)
+
+    assert amounts.quota_discount_amount == 200
+    assert amounts.total_amount_ex_tax == 1300
+    assert amounts.tax_amount == 130
+
+
+def test_calculate_invoices_matches_single_calculation():
+    batch = calculate_invoices([12345, 999], [678, 0], [1500, 1000], 1000, [0, 1])
+
+    assert batch == [
+        calculate_invoice(12345, 678, 1500, 1000),
+        calculate_invoice(999, 0, 1000, 1000, 1),
+    ]
+
+
+def test_calculate_invoices_rejects_mismatched_lengths():
+    with pytest.raises(ValueError):
+        calculate_invoices([100, 200], [0], [0, 0], 1000)
@@ -64,6 +64,9 @@ export default function InvoicesPage() {
   const [salesPersons, setSalesPersons] = useState<SalesPerson[]>([]);
   const [discountRates, setDiscountRates] = useState<DiscountRate[]>([]);
   const [loading, setLoading] = useState(true);
+  // 一覧はページ単位（新しい順）で取得し、「さらに読み込む」で続きを追加する
+  const [nextCursor, setNextCursor] = useState<string | undefined>(undefined);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [generating, setGenerating] = useState(false);
   const [showBulkDialog, setShowBulkDialog] = useState(false);
   const [showDiscountDialog, setShowDiscountDialog] = useState(false);
@@ -94,6 +97,7 @@ export default function InvoicesPage() {
   const fetchInvoices = async () => {
     try {
       const response = await apiClient.getSalesInvoices();
+      setNextCursor(response.nextCursor);
       if (response.data) {
         console.log('[DEBUG] Invoices from API:', response.data);
         const invoicesData = response.data as SalesInvoice[];
@@ -109,6 +113,25 @@ export default function InvoicesPage() {
     }
   };
 
+  const loadMoreInvoices = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const response = await apiClient.getSalesInvoices({ cursor: nextCursor });
+      if (response.data) {
+        const page = response.data as SalesInvoice[];
+        setInvoices(prev => [...prev, ...page]);
+        setNextCursor(response.nextCursor);
+      } else {
+        alert(response.error || '請求書の取得に失敗しました');
+      }
+    } catch (error) {
+      console.error('Failed to fetch more invoices:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const fetchSalesPersons = async () => {
     try {
       const response = await apiClient.getSalesPersons();
@@ -460,6 +483,17 @@ export default function InvoicesPage() {
             ))}
           </div>
         )}
+
+        {nextCursor && (
+          <Button
+            variant="outline"
+            onClick={loadMoreInvoices}
+            disabled={loadingMore}
+            className="w-full h-11 mt-4"
+          >
+            {loadingMore ? '読み込み中...' : 'さらに読み込む'}
+          </Button>
+        )}
       </div>
 
       {/* Bulk Generation Dialog */}
@@ -1,5 +1,8 @@
 const API_BASE_URL = 'https://bizpilot-backend.fly.dev/api';
 
+// 請求書一括生成ジョブの完了を待つ上限
+const BULK_GENERATE_TIMEOUT_MS = 10 * 60 * 1000;
+
 interface LoginRequest {
   username: string;
   password: string;
@@ -14,6 +17,7 @@ interface LoginResponse {
 interface ApiResponse<T> {
   data?: T;
   error?: string;
+  nextCursor?: string;
 }
 
 class ApiClient {
@@ -75,7 +79,7 @@ class ApiClient {
           });
           if (retryResponse.ok) {
             const data = await retryResponse.json();
-            return { data };
+            return { data, nextCursor: retryResponse.headers.get('X-Next-Cursor') ?? undefined };
           }
         } else {
           // Refresh failed, clear tokens and redirect to login
@@ -94,7 +98,7 @@ class ApiClient {
       }
 
       const data = await response.json();
-      return { data };
+      return { data, nextCursor: response.headers.get('X-Next-Cursor') ?? undefined };
     } catch (error) {
       return { error: error instanceof Error ? error.message : 'Network error' };
     }
@@ -275,11 +279,44 @@ class ApiClient {
   async bulkGenerateSalesInvoices(data: {
     closing_date: string;
     sales_person_ids?: number[];
-  }) {
-    return this.request('/sales-invoices/bulk-generate', {
+  }): Promise<ApiResponse<unknown>> {
+    // 一括生成はバックグラウンドジョブ: 完了までポーリングして結果を返す
+    const job = await this.request<{ job_id: string }>('/sales-invoices/bulk-generate', {
       method: 'POST',
       body: JSON.stringify(data),
     });
+    if (!job.data) {
+      return job;
+    }
+
+    const jobId = job.data.job_id;
+    const deadline = Date.now() + BULK_GENERATE_TIMEOUT_MS;
+    let state = '';
+    while (state !== 'completed' && state !== 'failed') {
+      if (Date.now() > deadline) {
+        return { error: '請求書の一括生成がタイムアウトしました。しばらくしてから請求書一覧を確認してください' };
+      }
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+      const status = await this.getBulkGenerateJob(jobId);
+      if (!status.data) {
+        return status;
+      }
+      state = (status.data as { status: string }).status;
+    }
+
+    const result = await this.request<{ error?: string | null }>(`/sales-invoices/bulk-generate/jobs/${jobId}/result`, {
+      method: 'GET',
+    });
+    if (state === 'failed') {
+      return { error: result.data?.error || result.error || '請求書の一括生成に失敗しました' };
+    }
+    return result;
+  }
+
+  async getBulkGenerateJob(jobId: string) {
+    return this.request(`/sales-invoices/bulk-generate/jobs/${jobId}`, {
+      method: 'GET',
+    });
   }
 
   async updateInvoiceDiscountRate(invoiceId: number, discountRateId: number) {
@@ -301,9 +338,14 @@ class ApiClient {
     });
   }
 
-  async getSalesInvoices(salesPersonId?: number) {
-    const params = salesPersonId ? `?sales_person_id=${salesPersonId}` : '';
-    return this.request(`/sales-invoices${params}`, {
+  async getSalesInvoices(options: { salesPersonId?: number; limit?: number; cursor?: string } = {}) {
+    // 1ページ分（新しい順）。続きは戻り値の nextCursor を cursor に渡して取得する
+    const params = new URLSearchParams();
+    if (options.salesPersonId) params.set('sales_person_id', String(options.salesPersonId));
+    if (options.limit) params.set('limit', String(options.limit));
+    if (options.cursor) params.set('cursor', options.cursor);
+    const query = params.toString();
+    return this.request<unknown[]>(`/sales-invoices${query ? `?${query}` : ''}`, {
       method: 'GET',
     });
   }